@@ -0,0 +1,245 @@
+'''
+batch_visibility.py - Vectorized up and hour angle intervals for many sidereal targets at once.
+
+rise_set computes the rise and set times of a sidereal target one day at a time, with several
+slalib calls per day, and does this separately for every target. Sidereal (ICRS) targets make up
+most of the request pool, so here the altitude and hour angle of a whole batch of targets are
+evaluated with numpy on a time grid shared by every target at a site. Constraint crossings are
+located on the grid and then refined with a few Newton iterations. The moon distance constraint
+is evaluated over the same 30 minute chunks that rise_set uses, against the moon positions
+cached in the site's SiteEphemeris.
+
+The only per target slalib work left is finding the apparent place of each target at a handful of
+nodes across the date range, which is then linearly interpolated. Rise and set times agree with
+rise_set to within a few tens of seconds, except where rise_set clips an interval at a day boundary.
+'''
+from datetime import timedelta
+import logging
+
+import numpy as np
+from rise_set.angle import Angle
+from rise_set.astrometry import mean_to_apparent, date_to_tdb, calc_apparent_sidereal_time, apply_refraction_to_horizon
+from rise_set.visibility import set_airmass_limit
+
+from adaptive_scheduler.site_ephemeris import get_site_ephemeris, LUNAR_CHUNK_SIZE
+
+log = logging.getLogger(__name__)
+
+# Spacing of the time grid that altitudes and hour angles are evaluated on
+GRID_STEP = timedelta(minutes=10)
+# Spacing of the nodes at which the apparent sidereal time is computed with slalib
+SIDEREAL_TIME_NODE_STEP = timedelta(hours=1)
+# Spacing of the nodes at which each target's apparent place is computed with slalib. Precession, nutation
+# and aberration move a target by well under an arcsecond between nodes this far apart.
+APPARENT_PLACE_NODE_STEP = timedelta(days=10)
+# Number of targets evaluated together, which bounds the size of the (time x target) arrays
+BATCH_SIZE = 128
+# Rate of change of hour angle, in radians per second of UT
+SIDEREAL_RATE = 2.0 * np.pi * 1.002737909350 / 86400.0
+NEWTON_ITERATIONS = 3
+TWO_PI = 2.0 * np.pi
+
+
+def _node_offsets(total_seconds, step_seconds):
+    '''Offsets in seconds of nodes every step_seconds which cover [0, total_seconds] with a node either side.'''
+    n_nodes = int(np.ceil(total_seconds / step_seconds)) + 3
+    return (np.arange(n_nodes) - 1) * step_seconds
+
+
+def _interpolate(node_offsets, node_values, offsets):
+    '''Linearly interpolates node_values (nodes x columns) at each of offsets, returning (offsets x columns).'''
+    step = node_offsets[1] - node_offsets[0]
+    position = (offsets - node_offsets[0]) / step
+    index = np.clip(np.floor(position).astype(int), 0, len(node_offsets) - 2)
+    weight = (position - index)[:, np.newaxis]
+    return node_values[index] * (1.0 - weight) + node_values[index + 1] * weight
+
+
+def _interpolate_pointwise(node_offsets, node_values, offsets, columns):
+    '''Linearly interpolates node_values (nodes x columns) at offsets[k] for the column columns[k].'''
+    step = node_offsets[1] - node_offsets[0]
+    position = (offsets - node_offsets[0]) / step
+    index = np.clip(np.floor(position).astype(int), 0, len(node_offsets) - 2)
+    weight = position - index
+    return node_values[index, columns] * (1.0 - weight) + node_values[index + 1, columns] * weight
+
+
+def _wrap(angle):
+    '''Wraps an angle in radians into [-pi, pi).'''
+    return (angle + np.pi) % TWO_PI - np.pi
+
+
+def _crossings_to_bounds(inside_at_start, crossings, total_seconds):
+    '''Turns an ordered array of crossing offsets into an (intervals x 2) array of start and end offsets.'''
+    boundaries = list(crossings)
+    if inside_at_start:
+        boundaries.insert(0, 0.0)
+    if len(boundaries) % 2 == 1:
+        boundaries.append(total_seconds)
+    bounds = np.array(boundaries, dtype=float).reshape(-1, 2)
+    return bounds[bounds[:, 0] < bounds[:, 1]]
+
+
+def _bounds_to_intervals(start_date, bounds):
+    '''Converts an (intervals x 2) array of offsets in seconds into a list of (start, end) datetime tuples.'''
+    microseconds = np.round(bounds * 1e6).astype(np.int64).astype('timedelta64[us]')
+    return [tuple(interval) for interval in (np.datetime64(start_date, 'us') + microseconds).tolist()]
+
+
+class SiderealVisibilityBatch(object):
+    ''' Computes rise_set style up intervals and hour angle intervals for lists of sidereal targets, for the site
+        and date range of a rise_set Visibility.
+    '''
+
+    def __init__(self, visibility, grid_step=GRID_STEP):
+        self.visibility = visibility
+        self.start_date = visibility.start_date
+        self.total_seconds = (visibility.end_date - visibility.start_date).total_seconds()
+        self.latitude = visibility.site['latitude'].in_radians()
+        self.longitude = visibility.site['longitude'].in_radians()
+        step_seconds = grid_step.total_seconds()
+        self.grid_offsets = np.append(np.arange(0.0, self.total_seconds, step_seconds), self.total_seconds)
+
+        self.sidereal_node_offsets = _node_offsets(self.total_seconds, SIDEREAL_TIME_NODE_STEP.total_seconds())
+        gast = [calc_apparent_sidereal_time(self._offset_to_date(offset)).in_radians()
+                for offset in self.sidereal_node_offsets]
+        self.sidereal_node_values = np.unwrap(gast)[:, np.newaxis]
+        self.grid_local_sidereal_time = self.local_sidereal_time(self.grid_offsets)[:, 0]
+
+        self.apparent_node_offsets = _node_offsets(self.total_seconds, APPARENT_PLACE_NODE_STEP.total_seconds())
+        self.apparent_node_tdbs = [date_to_tdb(self._offset_to_date(offset)) for offset in self.apparent_node_offsets]
+
+        # Hour angle limits, which are flipped for sites in the southern hemisphere, as they are in rise_set
+        ha_neg, ha_pos = visibility.ha_limit_neg, visibility.ha_limit_pos
+        if visibility.site['latitude'].in_degrees() < 0:
+            ha_neg, ha_pos = -visibility.ha_limit_pos, -visibility.ha_limit_neg
+        self.ha_centre = np.radians((ha_neg + ha_pos) / 2.0 * 15.0)
+        self.ha_half_width = np.radians((ha_pos - ha_neg) / 2.0 * 15.0)
+
+    def _offset_to_date(self, offset):
+        return self.start_date + timedelta(seconds=float(offset))
+
+    def local_sidereal_time(self, offsets):
+        return _interpolate(self.sidereal_node_offsets, self.sidereal_node_values, offsets) + self.longitude
+
+    def _apparent_places(self, targets):
+        '''Apparent ra and dec in radians at each apparent place node, as (nodes x targets) arrays.'''
+        ra = np.empty((len(self.apparent_node_tdbs), len(targets)))
+        dec = np.empty_like(ra)
+        for j, target in enumerate(targets):
+            for i, tdb in enumerate(self.apparent_node_tdbs):
+                app_ra, app_dec = mean_to_apparent(target, tdb)
+                ra[i, j] = app_ra.in_radians()
+                dec[i, j] = app_dec.in_radians()
+        return np.unwrap(ra, axis=0), dec
+
+    def get_intervals(self, targets, airmass=None, min_lunar_distance=0.0):
+        ''' Returns a list with an (up_intervals, ha_intervals) tuple for each target, where each is a list of
+            (start, end) datetime tuples like those returned by Visibility.get_target_intervals(target, up=True,
+            airmass=airmass) and Visibility.get_ha_intervals(target). If min_lunar_distance (in degrees) is set,
+            the up intervals are also limited to the 30 minute chunks where the target is at least that far from
+            the moon, as with Visibility.get_moon_distance_intervals.
+        '''
+        effective_horizon = set_airmass_limit(airmass, self.visibility.horizon.in_degrees())
+        horizon = apply_refraction_to_horizon(Angle(degrees=effective_horizon)).in_radians()
+        ephemeris = get_site_ephemeris(self.visibility) if min_lunar_distance > 0.0 else None
+        results = []
+        for batch_start in range(0, len(targets), BATCH_SIZE):
+            results.extend(self._get_batch_intervals(targets[batch_start:batch_start + BATCH_SIZE], horizon,
+                                                     min_lunar_distance, ephemeris))
+        return results
+
+    def _get_batch_intervals(self, targets, horizon, min_lunar_distance, ephemeris):
+        ra_nodes, dec_nodes = self._apparent_places(targets)
+        sin_horizon = np.sin(horizon)
+        sin_lat, cos_lat = np.sin(self.latitude), np.cos(self.latitude)
+        n_targets = len(targets)
+
+        # Evaluate altitude and hour angle for every target on the shared grid
+        ra_grid = _interpolate(self.apparent_node_offsets, ra_nodes, self.grid_offsets)
+        dec_grid = _interpolate(self.apparent_node_offsets, dec_nodes, self.grid_offsets)
+        hour_angle = self.grid_local_sidereal_time[:, np.newaxis] - ra_grid
+        altitude_margin = sin_lat * np.sin(dec_grid) + cos_lat * np.cos(dec_grid) * np.cos(hour_angle) - sin_horizon
+        is_up = altitude_margin > 0.0
+        ha_from_centre = _wrap(hour_angle - self.ha_centre)
+        in_ha_limits = np.abs(ha_from_centre) <= self.ha_half_width
+
+        # Grid steps where the up state changes contain a rise or set. Refine each with Newton's method.
+        step_index, step_column = np.nonzero(is_up[1:] != is_up[:-1])
+        lower = self.grid_offsets[step_index]
+        upper = self.grid_offsets[step_index + 1]
+        margin_lower = altitude_margin[step_index, step_column]
+        margin_upper = altitude_margin[step_index + 1, step_column]
+        crossing = lower + (upper - lower) * margin_lower / (margin_lower - margin_upper)
+        for _ in range(NEWTON_ITERATIONS):
+            ra = _interpolate_pointwise(self.apparent_node_offsets, ra_nodes, crossing, step_column)
+            dec = _interpolate_pointwise(self.apparent_node_offsets, dec_nodes, crossing, step_column)
+            ha = self.local_sidereal_time(crossing)[:, 0] - ra
+            margin = sin_lat * np.sin(dec) + cos_lat * np.cos(dec) * np.cos(ha) - sin_horizon
+            slope = -cos_lat * np.cos(dec) * np.sin(ha) * SIDEREAL_RATE
+            slope = np.where(slope == 0.0, np.finfo(float).eps, slope)
+            crossing = np.clip(crossing - margin / slope, lower, upper)
+        up_crossings = self._split_by_column(crossing, step_column, n_targets)
+        up_bounds = [_crossings_to_bounds(is_up[0, column], up_crossings[column], self.total_seconds)
+                     for column in range(n_targets)]
+        if min_lunar_distance > 0.0:
+            up_bounds = self._apply_moon_distance(up_bounds, ra_nodes, dec_nodes, min_lunar_distance, ephemeris)
+
+        # Hour angle advances linearly, so limit crossings can be solved for directly within a grid step
+        ha_crossings = [[] for _ in targets]
+        if self.ha_half_width < np.pi:
+            step_index, step_column = np.nonzero(in_ha_limits[1:] != in_ha_limits[:-1])
+            entering = in_ha_limits[step_index + 1, step_column]
+            limit = np.where(entering, -self.ha_half_width, self.ha_half_width)
+            to_limit = (limit - ha_from_centre[step_index, step_column]) % TWO_PI
+            lower = self.grid_offsets[step_index]
+            upper = self.grid_offsets[step_index + 1]
+            crossing = np.clip(lower + to_limit / SIDEREAL_RATE, lower, upper)
+            ha_crossings = self._split_by_column(crossing, step_column, n_targets)
+
+        results = []
+        for column in range(n_targets):
+            ha_bounds = _crossings_to_bounds(in_ha_limits[0, column], ha_crossings[column], self.total_seconds)
+            results.append((_bounds_to_intervals(self.start_date, up_bounds[column]),
+                            _bounds_to_intervals(self.start_date, ha_bounds)))
+        return results
+
+    def _apply_moon_distance(self, up_bounds, ra_nodes, dec_nodes, min_lunar_distance, ephemeris):
+        ''' Splits every up interval into the same 30 minute chunks as rise_set, keeps the chunks which start at
+            least min_lunar_distance degrees from the moon and joins consecutive kept chunks back together.
+        '''
+        chunk_seconds = LUNAR_CHUNK_SIZE.total_seconds()
+        interval_column = np.concatenate([np.full(len(bounds), column) for column, bounds in enumerate(up_bounds)])
+        bounds = np.concatenate(up_bounds)
+        chunk_counts = np.ceil((bounds[:, 1] - bounds[:, 0]) / chunk_seconds).astype(int)
+        interval_index = np.repeat(np.arange(len(bounds)), chunk_counts)
+        chunk_number = np.arange(len(interval_index)) - np.repeat(np.cumsum(chunk_counts) - chunk_counts,
+                                                                  chunk_counts)
+        chunk_start = bounds[interval_index, 0] + chunk_number * chunk_seconds
+        chunk_end = np.minimum(chunk_start + chunk_seconds, bounds[interval_index, 1])
+        chunk_column = interval_column[interval_index]
+
+        ra = _interpolate_pointwise(self.apparent_node_offsets, ra_nodes, chunk_start, chunk_column)
+        dec = _interpolate_pointwise(self.apparent_node_offsets, dec_nodes, chunk_start, chunk_column)
+        target_vectors = np.column_stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+        moon_vectors = ephemeris.moon_unit_vectors(chunk_start)
+        keep = np.einsum('ij,ij->i', target_vectors, moon_vectors) <= np.cos(np.radians(min_lunar_distance))
+
+        # A run of kept chunks starts wherever the previous chunk was not kept or was part of another interval
+        previous_joined = np.zeros(len(keep), dtype=bool)
+        previous_joined[1:] = keep[:-1] & (interval_index[1:] == interval_index[:-1])
+        next_joined = np.zeros(len(keep), dtype=bool)
+        next_joined[:-1] = keep[1:] & (interval_index[1:] == interval_index[:-1])
+        run_starts = np.nonzero(keep & ~previous_joined)[0]
+        run_ends = np.nonzero(keep & ~next_joined)[0]
+        kept_bounds = np.column_stack([chunk_start[run_starts], chunk_end[run_ends]])
+        kept_columns = chunk_column[run_starts]
+        split_points = np.searchsorted(kept_columns, np.arange(1, len(up_bounds)))
+        return np.split(kept_bounds, split_points)
+
+    def _split_by_column(self, crossings, crossing_columns, n_columns):
+        '''Groups crossing offsets by target column, keeping them in time order.'''
+        order = np.lexsort((crossings, crossing_columns))
+        crossings, crossing_columns = crossings[order], crossing_columns[order]
+        split_points = np.searchsorted(crossing_columns, np.arange(1, n_columns))
+        return np.split(crossings, split_points)
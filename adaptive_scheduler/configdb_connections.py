@@ -5,7 +5,7 @@ from collections import defaultdict
 
 import requests
 
-from adaptive_scheduler.utils import SendMetricMixin, case_insensitive_equals, join_location
+from adaptive_scheduler.utils import SendMetricMixin, case_insensitive_equals, join_location, json_fingerprint
 
 log = logging.getLogger(__name__)
 
@@ -30,7 +30,12 @@ class ConfigDBInterface(SendMetricMixin):
         self.telescopes_file = telescopes_file
         self.active_instruments_file = active_instruments_file
         self.active_instruments = None
+        self.active_instruments_fingerprint = None
         self.telescope_info = None
+        # Telescopes resolved for each distinct set of instrument requirements, since the active instruments changed
+        self._telescopes_by_requirements = {}
+        self.telescope_resolution_hits = 0
+        self.telescope_resolution_misses = 0
         self.update_configdb_structures()
 
     def update_configdb_structures(self):
@@ -52,6 +57,8 @@ class ConfigDBInterface(SendMetricMixin):
             # save the active_instruments each update
             with open(self.active_instruments_file, 'w') as active_instruments_cache:
                 json.dump(self.active_instruments, active_instruments_cache)
+        self.active_instruments_fingerprint = json_fingerprint(self.active_instruments)
+        self._telescopes_by_requirements.clear()
 
     def update_telescope_info(self):
         try:
@@ -238,6 +245,26 @@ class ConfigDBInterface(SendMetricMixin):
                     break
         return True
 
+    @staticmethod
+    def _requirements_fingerprint(instrument_types_to_requirements, location, is_staff):
+        """Returns a hashable key for the instrument requirements, location and staff status of a request, which
+        ignores the case of names just as the matching against the active instruments does."""
+
+        def normalise_elements(elements_by_type):
+            return tuple(sorted((element_type.lower(), tuple(sorted({e.lower() for e in elements})))
+                                for element_type, elements in elements_by_type.items()))
+
+        requirements = tuple(sorted(
+            (instrument_type.lower(), bool(requirements['self_guide']),
+             normalise_elements(requirements['science_optical_elements']),
+             normalise_elements(requirements['guiding_optical_elements']))
+            for instrument_type, requirements in instrument_types_to_requirements.items()
+        ))
+        location = tuple(sorted((constraint, value.lower() if isinstance(value, str) else value)
+                                for constraint, value in location.items()
+                                if constraint in ('telescope_class', 'site', 'enclosure', 'telescope')))
+        return requirements, location, bool(is_staff)
+
     def get_telescopes_for_instruments(self, instrument_types_to_requirements, location, is_staff=False):
         """Get the set of telescopes on which a request can be observed.
 
@@ -245,6 +272,9 @@ class ConfigDBInterface(SendMetricMixin):
         the science and guide camera optical elements needed, and whether the observation is planning to self-guide.
         The optical elements sub-structures can contain any number of lists of different elements, keyed by element type
 
+        The telescopes are only resolved once for each distinct set of requirements until the active instruments
+        are next updated.
+
         Parameters:
             instrument_types_to_requirements: dict of Instrument type to corresponding sets of science_optical_elements,
                 guiding_optical_elements, and self_guide fields
@@ -252,6 +282,26 @@ class ConfigDBInterface(SendMetricMixin):
         Returns:
             Set of available telescopes
         """
+        fingerprint = self._requirements_fingerprint(instrument_types_to_requirements, location, is_staff)
+        if fingerprint in self._telescopes_by_requirements:
+            self.telescope_resolution_hits += 1
+        else:
+            self.telescope_resolution_misses += 1
+            self._telescopes_by_requirements[fingerprint] = self._resolve_telescopes_for_instruments(
+                instrument_types_to_requirements, location, is_staff)
+        # Return a copy so the cached set cannot be changed by the caller
+        return set(self._telescopes_by_requirements[fingerprint])
+
+    def send_telescope_resolution_metrics(self):
+        """Sends and logs how many telescope resolutions were served from the cache since this was last called."""
+        log.info("Resolved telescopes for {} distinct instrument requirements, {} served from the cache".format(
+            self.telescope_resolution_misses, self.telescope_resolution_hits))
+        self.send_metric('telescope_resolution.hits', self.telescope_resolution_hits)
+        self.send_metric('telescope_resolution.misses', self.telescope_resolution_misses)
+        self.telescope_resolution_hits = 0
+        self.telescope_resolution_misses = 0
+
+    def _resolve_telescopes_for_instruments(self, instrument_types_to_requirements, location, is_staff):
         loc_is_set = self._location_fully_set(location)
         telescope_sets = defaultdict(set)
         for instrument in self.active_instruments:
@@ -25,25 +25,38 @@ from datetime import datetime, timedelta
 
 from rise_set.angle import Angle
 from rise_set.visibility import Visibility
-from rise_set.utils import is_static_target
+from rise_set.utils import is_static_target, is_sidereal_target
 from rise_set.exceptions import MovingViolation
 
 from time_intervals.intervals import Intervals
 from adaptive_scheduler.kernel.reservation import Reservation
 from adaptive_scheduler.kernel.reservation import CompoundReservation
 
-from adaptive_scheduler.utils import (normalise_datetime_intervals, timeit, metric_timer, OptimizationType)
+from adaptive_scheduler.utils import (normalise_datetime_intervals, timeit, metric_timer, OptimizationType, to_bool,
+                                      canonical_value, time_limit, TimeLimitExceeded)
 from adaptive_scheduler.printing import plural_str as pl
-from adaptive_scheduler.models import (Window, Windows, filter_compounds_by_type, RequestGroup, redis_instance)
+from adaptive_scheduler.models import (Windows, filter_compounds_by_type, RequestGroup, redis_instance,
+                                       REDIS_CACHE_TTL, cache_airmasses_for_requests)
 from adaptive_scheduler.request_filters import (filter_on_duration, filter_on_type,
                                                 truncate_upper_crossing_windows,
                                                 filter_out_future_windows,
                                                 drop_empty_requests,
                                                 log_windows)
 from adaptive_scheduler.log import RequestGroupLogger
+from adaptive_scheduler.rise_set_cache import RiseSetDiskCache
+from adaptive_scheduler.site_ephemeris import get_site_ephemeris
+from adaptive_scheduler.batch_visibility import SiderealVisibilityBatch
+from adaptive_scheduler.parallel_visibility import (SharedIntervals, intersect_windows_in_worker, bounds_to_windows,
+                                                    datetimes_to_bounds, CHUNK_SIZE)
+from adaptive_scheduler.visibility_cache import VisibilityCache, coverage_cache_key
 
 from multiprocessing import cpu_count, current_process, TimeoutError, get_context
 import pickle
+import os
+import socket
+import threading
+import time
+import uuid
 
 # Set up and configure a module scope logger
 import logging
@@ -53,7 +66,66 @@ log = logging.getLogger(__name__)
 multi_rg_log = logging.getLogger('rg_logger')
 rg_log = RequestGroupLogger(multi_rg_log)
 
-local_cache = {}
+# Rise_set intervals are kept in process between runs, up to this many megabytes. Set to 0 to keep every one of them.
+RISE_SET_LOCAL_CACHE_MB = float(os.getenv('RISE_SET_LOCAL_CACHE_MB', 1024))
+local_cache = VisibilityCache(max_bytes=int(RISE_SET_LOCAL_CACHE_MB * 2 ** 20))
+
+# Compute the up and hour angle intervals of sidereal targets together per telescope, rather than one by one
+BATCH_SIDEREAL_VISIBILITY = to_bool(os.getenv('BATCH_SIDEREAL_VISIBILITY', 'True'))
+# Rise_set intervals in redis are namespaced by this version, the computation mode and the semester, and expire after
+# the TTL instead of being flushed when the semester changes. Bump the version whenever a change alters the intervals
+# that are computed. Batch computed intervals can differ from rise_set's by a few minutes where rise_set clips an
+# interval at a day boundary, so they are never shared with schedulers computing them one target at a time.
+RISE_SET_CACHE_VERSION = 3
+RISE_SET_CACHE_NAMESPACE = 'rise_set_v{}{}'.format(RISE_SET_CACHE_VERSION,
+                                                    '_batch' if BATCH_SIDEREAL_VISIBILITY else '')
+RISE_SET_CACHE_TTL = REDIS_CACHE_TTL
+
+# Optional persistent on-disk cache of rise_set intervals, consulted after the local_cache and before redis
+RISE_SET_CACHE_DIR = os.getenv('RISE_SET_CACHE_DIR', '')
+disk_cache = None
+if RISE_SET_CACHE_DIR:
+    disk_cache = RiseSetDiskCache(os.path.join(RISE_SET_CACHE_DIR, RISE_SET_CACHE_NAMESPACE))
+# Seconds a worker process may spend on the rise set intervals of a single target before giving up on it
+RISE_SET_TARGET_TIMEOUT = float(os.getenv('RISE_SET_TARGET_TIMEOUT', 60.0))
+# Seconds to wait for the next result from a freshly spawned rise set pool. Every worker gives up on its target within
+# RISE_SET_TARGET_TIMEOUT, so a result is due within that plus a margin, or 300 seconds if there is no target limit.
+RISE_SET_RESULT_TIMEOUT = RISE_SET_TARGET_TIMEOUT + 30.0 if RISE_SET_TARGET_TIMEOUT > 0 else 300.0
+# Number of scheduling runs a target's rise set calculation may time out in before it is quarantined
+RISE_SET_QUARANTINE_STRIKES = int(os.getenv('RISE_SET_QUARANTINE_STRIKES', 2))
+# Below this many requests the request windows are intersected with the rise set intervals in the main process,
+# otherwise in the rise set worker pool. Set to 0 to always use the main process.
+PARALLEL_VISIBILITY_MIN_REQUESTS = int(os.getenv('PARALLEL_VISIBILITY_MIN_REQUESTS', 2000))
+# Compute the rise_set intervals of targets only over the days spanned by their request windows, plus a margin, rather
+# than the whole semester. The span covered is cached with the intervals, and extended when a later run needs more.
+RISE_SET_HORIZON_LIMITED = to_bool(os.getenv('RISE_SET_HORIZON_LIMITED', 'False'))
+RISE_SET_COVERAGE_MARGIN_DAYS = float(os.getenv('RISE_SET_COVERAGE_MARGIN_DAYS', 3.0))
+# Scheduler instances sharing a redis take a lease on each rise set they compute, so that only one of them computes it.
+# The leases are renewed while their rise sets are being computed, and expire this many seconds after the last renewal
+# if their instance dies. Set to 0 to disable the leases.
+RISE_SET_LEASE_SECONDS = float(os.getenv('RISE_SET_LEASE_SECONDS', 600.0))
+RISE_SET_LEASE_POLL_SECONDS = float(os.getenv('RISE_SET_LEASE_POLL_SECONDS', 1.0))
+# Number of leases released or renewed by each script call
+RISE_SET_LEASE_BATCH_SIZE = 1000
+_LEASE_TOKEN = uuid.uuid4().hex
+# Delete or extend the leases in KEYS that this process still owns, in one step so that a lease which has expired and
+# been taken over by another instance between the check and the change is left alone
+_release_leases_script = redis_instance.register_script('''
+local released = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        released = released + redis.call('del', key)
+    end
+end
+return released''')
+_renew_leases_script = redis_instance.register_script('''
+local renewed = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('get', key) == ARGV[1] then
+        renewed = renewed + redis.call('pexpire', key, ARGV[2])
+    end
+end
+return renewed''')
 
 
 def telescope_to_rise_set_telescope(telescope):
@@ -75,59 +147,80 @@ def rise_set_to_kernel_intervals(intervals):
     return Intervals(intervals)
 
 
+class RiseSetTimedOut(object):
+    '''Returned by a worker process in place of the intervals of a target whose rise_set calculation took longer
+       than its time limit.
+    '''
+    pass
+
+
 def cache_rise_set_timepoint_intervals(args):
-    '''Calculates the rise set timepoint interval of a target and attempts to put the result in redis. If it fails and
-        throws an exception, the calling code should catch this and fall back to compute rise sets synchronously
+    '''Calculates the rise set timepoint interval of a target and puts the result in redis. Returns a tuple of the
+       cache key and True if the intervals were saved, a RiseSetTimedOut if the calculation took longer than
+       target_timeout seconds, or False if it failed.
     '''
+    (cache_key, redis_key, (resource, rise_set_target, visibility, max_airmass, min_lunar_distance,
+                            max_lunar_phase), target_timeout) = args
     try:
         log.info('process {} is calculating a rise set'.format(current_process().pid))
-        (resource, rise_set_target, visibility, max_airmass, min_lunar_distance, max_lunar_phase) = args
-        intervals = get_rise_set_timepoint_intervals(rise_set_target, visibility, max_airmass, min_lunar_distance, max_lunar_phase)
-        cache_key = make_cache_key(resource, rise_set_target, max_airmass, min_lunar_distance, max_lunar_phase)
-        redis_instance.set(cache_key, pickle.dumps(intervals))
+        with time_limit(target_timeout):
+            intervals = get_rise_set_timepoint_intervals(rise_set_target, visibility, max_airmass, min_lunar_distance,
+                                                         max_lunar_phase)
+        redis_instance.set(redis_key, pickle.dumps(intervals), ex=RISE_SET_CACHE_TTL)
         log.info('process {} finished calculating rise set'.format(current_process().pid))
+        return cache_key, True
+    except TimeLimitExceeded:
+        log.warn('process {} gave up on a rise set for {} after {} seconds'.format(
+            current_process().pid, resource, target_timeout))
+        return cache_key, RiseSetTimedOut()
     except Exception as e:
         log.warn('received an error when trying to cache rise set value {}'.format(repr(e)))
-        # Catch and reraise the exception as a base Exception to make sure it is pickleable and doesn't hang the process
-        raise Exception(repr(e))
+        return cache_key, False
 
 
-def get_rise_set_timepoint_intervals(rise_set_target, visibility, max_airmass, min_lunar_distance, max_lunar_phase):
-    ''' Computes the rise set timepoint intervals for a given target, visibility object, and constraints
+def get_rise_set_timepoint_intervals(rise_set_target, visibility, max_airmass, min_lunar_distance, max_lunar_phase,
+                                     up_intervals=None, ha_intervals=None):
+    ''' Computes the rise set timepoint intervals for a given target, visibility object, and constraints.
+        up_intervals and ha_intervals may be passed in if they were already computed, for example by a
+        SiderealVisibilityBatch. up_intervals must then already have the moon distance constraint applied.
     '''
-    # arguments are packed into a tuple since multiprocessing pools only work with single arg functions
-    rs_dark_intervals = visibility.get_dark_intervals()
+    # The dark intervals and lunar ephemeris are shared by every target at this site
+    ephemeris = get_site_ephemeris(visibility)
     rs_up_intervals = []
-    try:
-        rs_up_intervals = visibility.get_target_intervals(target=rise_set_target, up=True,
-                                                          airmass=max_airmass)
-    except MovingViolation as mv:
-        log.warning(f"Rise-set failed on target: {rise_set_target}, for site: {visibility.site}, for date range {visibility.start_date.isoformat()} to {visibility.end_date.isoformat()}, with error: {repr(mv)}")
-
+    if up_intervals is not None:
+        rs_up_intervals = up_intervals
+    else:
+        try:
+            rs_up_intervals = visibility.get_target_intervals(target=rise_set_target, up=True,
+                                                              airmass=max_airmass)
+        except MovingViolation as mv:
+            log.warning(f"Rise-set failed on target: {rise_set_target}, for site: {visibility.site}, for date range {visibility.start_date.isoformat()} to {visibility.end_date.isoformat()}, with error: {repr(mv)}")
 
     if not is_static_target(rise_set_target):
         # get the moon distance intervals using the target intervals and min_lunar_distance constraint
-        if min_lunar_distance > 0.0:
-            rs_up_intervals = visibility.get_moon_distance_intervals(target=rise_set_target,
-                                                                     target_intervals=rs_up_intervals,
-                                                                     moon_distance=Angle(degrees=min_lunar_distance))
+        if min_lunar_distance > 0.0 and up_intervals is None:
+            rs_up_intervals = ephemeris.get_moon_distance_intervals(target=rise_set_target,
+                                                                    target_intervals=rs_up_intervals,
+                                                                    moon_distance=Angle(degrees=min_lunar_distance))
         # Apply the moon phase intervals if max_lunar_phase < 1.0 (full moon)
         if max_lunar_phase < 1.0:
-            rs_up_intervals = visibility.get_moon_phase_intervals(target_intervals=rs_up_intervals,
-                                                                  max_moon_phase=max_lunar_phase)
+            rs_up_intervals = ephemeris.get_moon_phase_intervals(target_intervals=rs_up_intervals,
+                                                                 max_moon_phase=max_lunar_phase)
 
         if visibility.zenith_blind_spot.in_degrees() > 0.0:
             rs_up_intervals = visibility.get_zenith_distance_intervals(target=rise_set_target,
                                                                        target_intervals=rs_up_intervals)
 
     # HA support only currently implemented for ICRS targets
-    if 'ra' in rise_set_target:
+    if ha_intervals is not None:
+        rs_ha_intervals = ha_intervals
+    elif 'ra' in rise_set_target:
         rs_ha_intervals = visibility.get_ha_intervals(rise_set_target)
     else:
         rs_ha_intervals = rs_up_intervals
 
-    # Convert the rise_set intervals into kernel speak
-    dark_intervals = rise_set_to_kernel_intervals(rs_dark_intervals)
+    # Convert the rise_set intervals into kernel speak. The site's dark intervals are only converted once.
+    dark_intervals = ephemeris.dark_kernel_intervals
     # the target intervals then are then those that pass the moon distance constraint
     up_intervals = rise_set_to_kernel_intervals(rs_up_intervals)
     ha_intervals = rise_set_to_kernel_intervals(rs_ha_intervals)
@@ -136,7 +229,14 @@ def get_rise_set_timepoint_intervals(rise_set_target, visibility, max_airmass, m
     return dark_intervals
 
 
-def construct_compound_reservation(request_group, semester_start, network_model):
+def cache_airmasses_for_request_groups(request_groups, semester_start, network_model):
+    '''Pre-calculates and caches the airmasses of every request optimized for airmass, in one batch.'''
+    requests = [request for request_group in request_groups for request in request_group.requests
+                if request.optimization_type == OptimizationType.AIRMASS]
+    cache_airmasses_for_requests(requests, network_model, semester_start)
+
+
+def construct_compound_reservation(request_group, semester_start, network_model, airmasses_cached=False):
     '''Convert a RequestGroup into a CompoundReservation, translating datetimes
        to kernel epoch times. The Request windows were already translated into visible windows during the 
        filter_on_visibility step.
@@ -146,7 +246,7 @@ def construct_compound_reservation(request_group, semester_start, network_model)
         kernel_intervals_for_resources = request.windows.to_kernel_intervals(semester_start)
 
         # If the request has an optimization type of AIRMASS, pre-calculate and cache the airmasses at epoch values here.
-        if request.optimization_type == OptimizationType.AIRMASS:
+        if request.optimization_type == OptimizationType.AIRMASS and not airmasses_cached:
             request.cache_airmasses_within_kernel_windows(kernel_intervals_for_resources, network_model, semester_start)
 
         # Construct the kernel Reservation
@@ -161,12 +261,13 @@ def construct_compound_reservation(request_group, semester_start, network_model)
     return compound_res
 
 
-def construct_many_compound_reservation(request_group, request_index, semester_start, network_model):
+def construct_many_compound_reservation(request_group, request_index, semester_start, network_model,
+                                        airmasses_cached=False):
     request = request_group.requests[request_index]
     kernel_intervals_for_resources = request.windows.to_kernel_intervals(semester_start)
 
     # If the request has an optimization type of AIRMASS, pre-calculate and cache the airmasses at epoch values here.
-    if request.optimization_type == OptimizationType.AIRMASS:
+    if request.optimization_type == OptimizationType.AIRMASS and not airmasses_cached:
         request.cache_airmasses_within_kernel_windows(kernel_intervals_for_resources, network_model, semester_start)
 
     # Construct the kernel Reservation
@@ -226,7 +327,8 @@ def filter_on_scheduling_horizon(request_groups, scheduling_horizon):
 
 @timeit
 def filter_for_kernel(request_groups, visibility_for_resource, downtime_intervals, seeing_monitor,
-                      semester_start, semester_end, estimated_scheduler_end, scheduling_horizon):
+                      semester_start, semester_end, estimated_scheduler_end, scheduling_horizon, rise_set_pool=None,
+                      available_resources=None):
     '''After throwing out and marking RGs as UNSCHEDULABLE, reduce windows by
        considering dark time and target visibility. Remove any RGs that are now too
        small to hold their duration after this consideration, so they are not passed
@@ -239,7 +341,9 @@ def filter_for_kernel(request_groups, visibility_for_resource, downtime_interval
     rgs = filter_on_scheduling_horizon(request_groups, scheduling_horizon)
 
     # Filter on rise_set/airmass/downtime intervals
-    rgs = filter_on_visibility(rgs, visibility_for_resource, downtime_intervals, seeing_monitor, semester_start, semester_end, estimated_scheduler_end)
+    rgs = filter_on_visibility(rgs, visibility_for_resource, downtime_intervals, seeing_monitor, semester_start, semester_end,
+                               estimated_scheduler_end, rise_set_pool=rise_set_pool,
+                               available_resources=available_resources)
 
     # Clean up now impossible Requests
     rgs = filter_on_duration(rgs)
@@ -249,61 +353,552 @@ def filter_for_kernel(request_groups, visibility_for_resource, downtime_interval
     return rgs
 
 
-def make_cache_key(resource, rs_target, max_airmass, min_lunar_distance, max_lunar_phase):
-    return f"{resource}_{max_airmass}_{min_lunar_distance}_{max_lunar_phase}_{sorted(rs_target.items())}"
+def make_cache_key(resource, target_fingerprint, max_airmass, min_lunar_distance, max_lunar_phase):
+    constraints = '_'.join(canonical_value(value) for value in (max_airmass, min_lunar_distance, max_lunar_phase))
+    return f"{resource}_{constraints}_{target_fingerprint}"
+
+
+def make_request_cache_key(request, configuration, resource):
+    '''Returns the rise_set cache key for a configuration of a request on a resource.'''
+    target_fingerprint = configuration.target.get_rise_set_fingerprint()
+    # If the eccentricity is > 1.0, we cant do our normal semester long caching as the orbit may be unstable
+    # over longer time horizons. Instead, just cache for this exact request only
+    if configuration.target.has_unbound_orbit():
+        target_fingerprint = f"{target_fingerprint}_{request.id}"
+    return make_cache_key(resource, target_fingerprint, configuration.constraints['max_airmass'],
+                          configuration.constraints['min_lunar_distance'],
+                          configuration.constraints['max_lunar_phase'])
+
+
+def semester_cache_name(semester_start, semester_end):
+    return '{}_{}'.format(semester_start, semester_end)
+
+
+def redis_cache_key(cache_key, semester_name=None):
+    '''Returns the redis key for a rise_set cache key, namespaced by the cache version, mode and the semester.'''
+    if semester_name is None:
+        semester_name = local_cache.get('current_semester', '')
+    return '{}_{}_{}'.format(RISE_SET_CACHE_NAMESPACE, semester_name, cache_key)
+
+
+def get_from_redis_cache(cache_key):
+    '''Returns the rise_set intervals cached in redis for the current semester. Raises if they are not there.'''
+    value = redis_instance.get(redis_cache_key(cache_key))
+    if value is None:
+        raise KeyError(cache_key)
+    return pickle.loads(value)
+
+
+def save_to_redis_cache(cache_key, intervals, semester_name=None):
+    redis_instance.set(redis_cache_key(cache_key, semester_name), pickle.dumps(intervals), ex=RISE_SET_CACHE_TTL)
+
+
+def get_from_disk_cache(cache_key):
+    if disk_cache is None:
+        return None
+    try:
+        return disk_cache.get(cache_key)
+    except Exception as e:
+        log.warning("Failed to read rise set intervals from the disk cache: {}".format(repr(e)))
+        return None
+
+
+def save_to_disk_cache(cache_key, intervals):
+    if disk_cache is None:
+        return
+    try:
+        disk_cache.set(cache_key, intervals)
+    except Exception as e:
+        log.warning("Failed to save rise set intervals to the disk cache: {}".format(repr(e)))
 
 
 def update_cached_semester(semester_start, semester_end):
+    if disk_cache is not None:
+        try:
+            disk_cache.set_semester(semester_start, semester_end)
+        except OSError as e:
+            log.error("Failed to open the rise set disk cache in {}: {}".format(RISE_SET_CACHE_DIR, repr(e)))
     if 'current_semester' not in local_cache:
         try:
             current_semester = redis_instance.get('current_semester')
+            if isinstance(current_semester, bytes):
+                # This is needed in case we are loading an old python2 saved pickle input
+                current_semester = current_semester.decode('utf-8')
             local_cache['current_semester'] = current_semester
         except Exception:
             current_semester = ''
             log.error("current semester is not in the local cache, and redis is unavailable. Please restart redis.")
     else:
         current_semester = local_cache['current_semester']
-    if isinstance(current_semester, bytes):
-        # This is needed in case we are loading an old python2 saved pickle input
-        current_semester = current_semester.decode('utf-8')
-    if str(current_semester) != '{}_{}'.format(semester_start, semester_end):
-        # if the current semester has changed from what redis previously knew, clear redis entirely and re-cache
+    if str(current_semester) != semester_cache_name(semester_start, semester_end):
+        # if the current semester has changed, start a new local cache. The redis keys are namespaced by semester,
+        # so the previous semester's entries are left to expire rather than being flushed.
         local_cache.clear()
-        current_semester = '{}_{}'.format(semester_start, semester_end)
+        current_semester = semester_cache_name(semester_start, semester_end)
         local_cache['current_semester'] = current_semester
         try:
-            redis_instance.flushdb()
             redis_instance.set('current_semester', current_semester)
         except Exception:
-            log.error(
-                "Redis is down, and the current semester has rolled over. Please manually delete the redis cache file and restart redis.")
+            log.error("Redis is down, and the current semester has rolled over. Please check that redis is online.")
 
 
-@log_windows
-def filter_on_visibility(rgs, visibility_for_resource, downtime_intervals, seeing_monitor, semester_start, semester_end, estimated_scheduler_end):
+def compute_rise_sets_in_new_pool(rise_sets_to_compute_later):
+    '''Computes the missing rise_set intervals in a freshly spawned process pool, whose workers put the results
+       into redis. Returns the set of cache keys whose calculation timed out.
+    '''
+    timed_out = set()
+    num_processes = max(cpu_count() - 1, 1)
+    log.info("computing {} rise sets with {} processes".format(len(rise_sets_to_compute_later.keys()), num_processes))
+    # now use a thread pool to compute the missing rise_set intervals for a resource and target
+    if rise_sets_to_compute_later:
+        with get_context('spawn').Pool(processes=num_processes) as pool:
+            try:
+                tasks = [(cache_key, redis_cache_key(cache_key), args, RISE_SET_TARGET_TIMEOUT)
+                         for cache_key, args in rise_sets_to_compute_later.items()]
+                # Results are consumed as they complete, so only the targets still running are lost on a timeout
+                results = pool.imap_unordered(cache_rise_set_timepoint_intervals, tasks)
+                for _ in range(len(tasks)):
+                    cache_key, result = results.next(RISE_SET_RESULT_TIMEOUT)
+                    if isinstance(result, RiseSetTimedOut):
+                        timed_out.add(cache_key)
+            except TimeoutError:
+                pool.terminate()
+                log.warn('{} second timeout reached waiting for a rise_set computation. Falling back to synchronous '
+                         'computation'.format(RISE_SET_RESULT_TIMEOUT))
+            except Exception:
+                log.warn(
+                    'Failed to save rise_set intervals into redis. Please check that redis is online. Falling back on synchronous rise_set calculations.')
+            log.info("finished computing rise_sets")
+            pool.close()
+            pool.join()
+            log.info("finished closing thread pool")
+    return timed_out
+
+
+def compute_sidereal_rise_sets_in_batch(rise_sets_to_compute_later, semester_name=None):
+    '''Computes the rise_set intervals of the semester long sidereal targets in rise_sets_to_compute_later together,
+       one batch per telescope and airmass limit, and puts them into the local and redis caches. They are saved
+       in redis under semester_name, or the current semester if it isn't given. Returns the entries which still
+       need to be computed.
+    '''
+    batches = {}
+    remaining = {}
+    for cache_key, args in rise_sets_to_compute_later.items():
+        (resource, rise_set_target, visibility, max_airmass, min_lunar_distance, max_lunar_phase) = args
+        if is_sidereal_target(rise_set_target) and 'request_id' not in rise_set_target:
+            # Horizon limited targets are batched with the others computed over the same span
+            visibility_range = (resource, visibility.start_date, visibility.end_date)
+            batches.setdefault((visibility_range, max_airmass, min_lunar_distance), []).append((cache_key, args))
+        else:
+            remaining[cache_key] = args
+    if not batches:
+        return remaining
+
+    log.info("computing {} sidereal rise sets in {} batches".format(len(rise_sets_to_compute_later) - len(remaining),
+                                                                   len(batches)))
+    visibility_batches = {}
+    for (visibility_range, max_airmass, min_lunar_distance), entries in batches.items():
+        resource = visibility_range[0]
+        try:
+            visibility = entries[0][1][2]
+            if visibility_range not in visibility_batches:
+                visibility_batches[visibility_range] = SiderealVisibilityBatch(visibility)
+            targets = [args[1] for _, args in entries]
+            batch_intervals = visibility_batches[visibility_range].get_intervals(targets, max_airmass,
+                                                                                 min_lunar_distance)
+        except Exception as e:
+            log.warn('Failed to compute a batch of rise sets for {}: {}'.format(resource, repr(e)))
+            remaining.update(entries)
+            continue
+        for (cache_key, args), (up_intervals, ha_intervals) in zip(entries, batch_intervals):
+            (resource, rise_set_target, visibility, max_airmass, min_lunar_distance, max_lunar_phase) = args
+            local_cache[cache_key] = get_rise_set_timepoint_intervals(rise_set_target, visibility, max_airmass,
+                                                                      min_lunar_distance, max_lunar_phase,
+                                                                      up_intervals=up_intervals,
+                                                                      ha_intervals=ha_intervals)
+            try:
+                save_to_redis_cache(cache_key, local_cache[cache_key], semester_name)
+            except Exception:
+                log.warn('Failed to save rise_set intervals into redis. Please check that redis is online.')
+    log.info("finished computing sidereal rise sets")
+    return remaining
+
+
+def compute_rise_sets_in_worker_pool(rise_set_pool, rise_sets_to_compute_later, semester_range=None):
+    '''Computes the missing rise_set intervals in the long lived rise_set_pool. The results are streamed back to
+       this process, which puts them into the local and redis caches as they arrive. Returns the set of cache keys
+       whose calculation timed out.
+    '''
+    timed_out = set()
+    log.info("computing {} rise sets with the {} process worker pool".format(len(rise_sets_to_compute_later.keys()),
+                                                                            rise_set_pool.processes))
+    tasks = []
+    for cache_key, (resource, rise_set_target, visibility, max_airmass, min_lunar_distance,
+                    max_lunar_phase) in rise_sets_to_compute_later.items():
+        # Targets with a request specific or horizon limited visibility window are recomputed over that window in
+        # the worker
+        window_range = (visibility.start_date, visibility.end_date)
+        if 'request_id' not in rise_set_target and semester_range in (None, window_range):
+            window_range = None
+        tasks.append((cache_key, resource, rise_set_target, max_airmass, min_lunar_distance, max_lunar_phase,
+                      window_range))
+    try:
+        for cache_key, intervals in rise_set_pool.imap_rise_sets(tasks):
+            if isinstance(intervals, RiseSetTimedOut):
+                timed_out.add(cache_key)
+                continue
+            local_cache[cache_key] = intervals
+            try:
+                save_to_redis_cache(cache_key, intervals)
+            except Exception:
+                log.warn('Failed to save rise_set intervals into redis. Please check that redis is online.')
+    except Exception as e:
+        log.warn('Rise set worker pool failed: {}. Falling back on synchronous rise_set calculations.'.format(repr(e)))
+        rise_set_pool.shutdown(terminate=True)
+    log.info("finished computing rise_sets")
+    return timed_out
+
+
+def quarantine_redis_key(cache_key):
+    return 'quarantine_{}'.format(redis_cache_key(cache_key))
+
+
+def is_quarantined(cache_key):
+    '''Returns True if the target's rise_set calculation has timed out too many times to be attempted again'''
+    try:
+        strikes = redis_instance.get(quarantine_redis_key(cache_key))
+    except Exception:
+        return False
+    return strikes is not None and int(strikes) >= RISE_SET_QUARANTINE_STRIKES
+
+
+def record_rise_set_timeout(cache_key):
+    '''Counts a timed out rise_set calculation against the target, and returns True if the target is now
+       quarantined. The quarantine is keyed by the rise_set cache key, so it is lifted as soon as the target or its
+       constraints change.
+    '''
+    try:
+        strikes = redis_instance.incr(quarantine_redis_key(cache_key))
+        redis_instance.expire(quarantine_redis_key(cache_key), RISE_SET_CACHE_TTL)
+    except Exception:
+        log.warn('Failed to record a rise_set timeout in redis. Please check that redis is online.')
+        return False
+    return strikes >= RISE_SET_QUARANTINE_STRIKES
+
+
+def lease_owner():
+    return '{}_{}_{}'.format(socket.gethostname(), os.getpid(), _LEASE_TOKEN)
+
+
+def lease_redis_key(cache_key):
+    return 'lease_{}'.format(redis_cache_key(cache_key))
+
+
+def acquire_rise_set_leases(cache_keys):
+    '''Returns the set of cache_keys whose rise_set intervals this process may compute. The others are leased by
+       another scheduler instance, which is computing them already. Leases this process already holds count as
+       acquired.
+    '''
+    if RISE_SET_LEASE_SECONDS <= 0 or not cache_keys:
+        return set(cache_keys)
+    owner = lease_owner()
+    try:
+        pipe = redis_instance.pipeline(transaction=False)
+        for cache_key in cache_keys:
+            pipe.set(lease_redis_key(cache_key), owner, nx=True, px=int(RISE_SET_LEASE_SECONDS * 1000))
+            pipe.get(lease_redis_key(cache_key))
+        owners = pipe.execute()[1::2]
+    except Exception:
+        # Without redis there is nothing to share the results through, so just compute them
+        return set(cache_keys)
+    return {cache_key for cache_key, lease in zip(cache_keys, owners) if lease == owner.encode()}
+
+
+def _run_lease_script(script, cache_keys, args):
+    for index in range(0, len(cache_keys), RISE_SET_LEASE_BATCH_SIZE):
+        script(keys=[lease_redis_key(cache_key) for cache_key in cache_keys[index:index + RISE_SET_LEASE_BATCH_SIZE]],
+               args=args, client=redis_instance)
+
+
+def release_rise_set_leases(cache_keys):
+    '''Releases the leases this process holds on cache_keys, leaving any that have expired and been taken over.'''
+    if RISE_SET_LEASE_SECONDS <= 0:
+        return
+    try:
+        _run_lease_script(_release_leases_script, list(cache_keys), [lease_owner()])
+    except Exception:
+        log.warn('Failed to release rise_set leases in redis. They will expire in {} seconds.'.format(
+            RISE_SET_LEASE_SECONDS))
+
+
+def renew_rise_set_leases(cache_keys):
+    '''Extends the leases this process still holds on cache_keys by RISE_SET_LEASE_SECONDS.'''
+    try:
+        _run_lease_script(_renew_leases_script, list(cache_keys), [lease_owner(), int(RISE_SET_LEASE_SECONDS * 1000)])
+    except Exception:
+        log.warn('Failed to renew rise_set leases in redis. Please check that redis is online.')
+
+
+class RiseSetLeaseRenewer(object):
+    ''' Renews the leases this process holds on cache_keys in a background thread, three times per lease period, so
+        that they do not expire however long their rise sets take to compute.
+    '''
+
+    def __init__(self, cache_keys):
+        self.cache_keys = list(cache_keys)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.cache_keys and RISE_SET_LEASE_SECONDS > 0:
+            self._thread = threading.Thread(target=self._renew, name='rise_set_lease_renewer', daemon=True)
+            self._thread.start()
+
+    def _renew(self):
+        while not self._stopped.wait(RISE_SET_LEASE_SECONDS / 3):
+            renew_rise_set_leases(self.cache_keys)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def wait_for_rise_set_leases(cache_keys):
+    '''Waits until the leases which other scheduler instances hold on cache_keys have been released, or have expired
+       because their instance stopped renewing them.
+    '''
+    log.info('waiting for {} being computed by another scheduler instance'.format(pl(len(cache_keys), 'rise set')))
+    leased = list(cache_keys)
+    while leased:
+        try:
+            pipe = redis_instance.pipeline(transaction=False)
+            for cache_key in leased:
+                pipe.exists(lease_redis_key(cache_key))
+            leased = [cache_key for cache_key, exists in zip(leased, pipe.execute()) if exists]
+        except Exception:
+            return
+        if leased:
+            time.sleep(RISE_SET_LEASE_POLL_SECONDS)
+
+
+def coverage_redis_key(cache_key):
+    return 'coverage_{}'.format(redis_cache_key(cache_key))
+
+
+def span_cache_key(cache_key, span):
+    '''Returns the key that horizon limited intervals covering span are stored under.'''
+    return '{}_{}_{}'.format(cache_key, *(timepoint.strftime('%Y%m%dT%H%M%S') for timepoint in span))
+
+
+def get_window_spans(rgs):
+    '''Returns the (start, end) range spanned by the windows of every request which shares each cache key. Targets on
+       unbound orbits are left out, as they are already only computed over their request's windows.
+    '''
+    window_spans = {}
+    for rg in rgs:
+        for r in rg.requests:
+            for conf in r.configurations:
+                if conf.target.has_unbound_orbit():
+                    continue
+                for resource in r.windows.windows_for_resource:
+                    windows_start, windows_end = r.windows.range_at(resource)
+                    if windows_start is None:
+                        continue
+                    cache_key = make_request_cache_key(r, conf, resource)
+                    if cache_key in window_spans:
+                        span_start, span_end = window_spans[cache_key]
+                        windows_start, windows_end = min(windows_start, span_start), max(windows_end, span_end)
+                    window_spans[cache_key] = (windows_start, windows_end)
+    return window_spans
+
+
+def get_coverage_span(window_span, semester_start, semester_end):
+    '''Returns the whole days to compute rise_set intervals over for a window span, extended by the coverage margin
+       so that the following runs do not need to extend it straight away.
+    '''
+    start = datetime(window_span[0].year, window_span[0].month, window_span[0].day)
+    end = window_span[1] + timedelta(days=RISE_SET_COVERAGE_MARGIN_DAYS)
+    end_day = datetime(end.year, end.month, end.day)
+    if end_day < end:
+        end_day += timedelta(days=1)
+    return max(start, semester_start), min(end_day, semester_end)
+
+
+def get_cached_coverage(cache_key, semester_start, semester_end):
+    '''Returns the span covered by the cached rise_set intervals of cache_key, loading them into the local cache, or
+       None if nothing is cached. Intervals cached without a coverage span cover the whole semester.
+    '''
+    if cache_key in local_cache:
+        local_cache.record_lookup('local', True)
+        return local_cache.get(coverage_cache_key(cache_key), (semester_start, semester_end))
+    local_cache.record_lookup('local', False)
+    try:
+        value = redis_instance.get(coverage_redis_key(cache_key))
+    except Exception:
+        value = None
+    if value is not None:
+        coverage = pickle.loads(value)
+        try:
+            intervals = get_from_redis_cache(span_cache_key(cache_key, coverage))
+        except Exception:
+            local_cache.record_lookup('redis', False)
+            return None
+        local_cache.record_lookup('redis', True)
+    else:
+        coverage = (semester_start, semester_end)
+        intervals = get_from_disk_cache(cache_key)
+        if disk_cache is not None:
+            local_cache.record_lookup('disk', intervals is not None)
+        if intervals is None:
+            try:
+                intervals = get_from_redis_cache(cache_key)
+            except Exception:
+                local_cache.record_lookup('redis', False)
+                return None
+            local_cache.record_lookup('redis', True)
+            save_to_disk_cache(cache_key, intervals)
+    local_cache[cache_key] = intervals
+    local_cache[coverage_cache_key(cache_key)] = coverage
+    return coverage
+
+
+def save_coverage(cache_key, intervals, coverage, stale_keys):
+    '''Puts horizon limited intervals and the span they cover into the local and redis caches, replacing the stale
+       entries they were merged from. They are not put in the append only disk cache, which would otherwise keep
+       every extension.
+    '''
+    local_cache[cache_key] = intervals
+    local_cache[coverage_cache_key(cache_key)] = coverage
+    try:
+        save_to_redis_cache(span_cache_key(cache_key, coverage), intervals)
+        # The coverage is only moved once its intervals are saved, so it never points at missing intervals
+        redis_instance.set(coverage_redis_key(cache_key), pickle.dumps(coverage), ex=RISE_SET_CACHE_TTL)
+        stale_keys = [redis_cache_key(key) for key in stale_keys if key != span_cache_key(cache_key, coverage)]
+        if stale_keys:
+            redis_instance.delete(*stale_keys)
+    except Exception:
+        log.warn('Failed to save rise_set intervals into redis. Please check that redis is online.')
+
+
+def fill_rise_set_cache(rgs, visibility_for_resource, semester_start, semester_end, rise_set_pool=None,
+                        include_unbound_orbits=True):
+    '''Makes sure the rise_set intervals of every target, resource and constraint combination in rgs are in the
+       local cache, from the disk or redis caches or by computing them. Returns the set of cache keys which only hold
+       empty placeholder intervals because their computation timed out, and should be removed after use so they
+       are retried. Targets on unbound orbits, which are only computed over a single request's windows, are skipped
+       unless include_unbound_orbits is set.
+
+       Rise sets which another scheduler instance is computing are waited for and then read from redis. Any that
+       are still missing once its leases are released or expire are computed here.
+    '''
     update_cached_semester(semester_start, semester_end)
+    retry_later, leased_elsewhere = fill_rise_set_cache_once(rgs, visibility_for_resource, semester_start,
+                                                             semester_end, rise_set_pool, include_unbound_orbits)
+    if leased_elsewhere:
+        wait_for_rise_set_leases(leased_elsewhere)
+        retry_later |= fill_rise_set_cache_once(rgs, visibility_for_resource, semester_start, semester_end,
+                                                rise_set_pool, include_unbound_orbits, wait_for_leases=False)[0]
+    return retry_later
+
+
+def fill_rise_set_cache_once(rgs, visibility_for_resource, semester_start, semester_end, rise_set_pool,
+                             include_unbound_orbits, wait_for_leases=True):
+    '''Fills the local cache like fill_rise_set_cache, but only computes the rise sets that this process can lease,
+       unless wait_for_leases is False. Returns the set of cache keys to retry later, and the set of cache keys that
+       other scheduler instances are computing.
+    '''
+    leased_elsewhere = set()
+    to_lease = []
+    window_spans = get_window_spans(rgs) if RISE_SET_HORIZON_LIMITED else {}
+    # The cached intervals, new coverage and keys of the spans to compute, for each horizon limited cache key
+    extensions = {}
+    # The horizon limited cache key that each span being computed belongs to
+    span_keys = {}
+    span_visibilities = {}
     rise_sets_to_compute_later = {}
     for rg in rgs:
         for r in rg.requests:
             for conf in r.configurations:
-                rise_set_target = conf.target.in_rise_set_format()
+                if not include_unbound_orbits and conf.target.has_unbound_orbit():
+                    continue
                 for resource in r.windows.windows_for_resource:
-                    # If the eccentricity is > 1.0, we cant do our normal semester long caching as the orbit may be unstable
-                    # over longer time horizons. Instead, just cache for this exact request only
-                    if rise_set_target.get('eccentricity', 0.0) >= 1.0:
-                        # Add the request id to the rise_set_target since that is part of its cache key
-                        rise_set_target['request_id'] = r.id
-                    cache_key = make_cache_key(resource, rise_set_target, conf.constraints['max_airmass'],
-                                               conf.constraints['min_lunar_distance'], conf.constraints['max_lunar_phase'])
-                    if cache_key not in local_cache:
+                    cache_key = make_request_cache_key(r, conf, resource)
+                    if cache_key in window_spans:
+                        if cache_key in extensions or cache_key in leased_elsewhere:
+                            continue
+                        window_start = max(window_spans[cache_key][0], semester_start)
+                        window_end = min(window_spans[cache_key][1], semester_end)
+                        coverage = get_cached_coverage(cache_key, semester_start, semester_end)
+                        if coverage is not None and coverage[0] <= window_start and window_end <= coverage[1]:
+                            continue
+                        if is_quarantined(cache_key):
+                            log.warn('Skipping the quarantined rise set of request {} on {}'.format(r.id, resource))
+                            local_cache[cache_key] = Intervals([])
+                            local_cache[coverage_cache_key(cache_key)] = (semester_start, semester_end)
+                            continue
+                        to_lease.append(cache_key)
+                        # Only the days which are not already covered are computed
+                        span = get_coverage_span(window_spans[cache_key], semester_start, semester_end)
+                        if coverage is None:
+                            intervals, new_coverage, missing_spans = None, span, [span]
+                        else:
+                            intervals = local_cache[cache_key]
+                            new_coverage = (min(span[0], coverage[0]), max(span[1], coverage[1]))
+                            missing_spans = [missing for missing in [(new_coverage[0], coverage[0]),
+                                                                     (coverage[1], new_coverage[1])]
+                                             if missing[0] < missing[1]]
+                        missing_keys = []
+                        for missing in missing_spans:
+                            if (resource, missing) not in span_visibilities:
+                                span_visibilities[(resource, missing)] = duplicate_visibility_with_new_window(
+                                    visibility_for_resource[resource], *missing)
+                            missing_key = span_cache_key(cache_key, missing)
+                            rise_sets_to_compute_later[missing_key] = ((resource, conf.target.in_rise_set_format(),
+                                                                        span_visibilities[(resource, missing)],
+                                                                        conf.constraints['max_airmass'],
+                                                                        conf.constraints['min_lunar_distance'],
+                                                                        conf.constraints['max_lunar_phase']))
+                            span_keys[missing_key] = cache_key
+                            missing_keys.append(missing_key)
+                        stale_keys = missing_keys if coverage is None else missing_keys + [
+                            span_cache_key(cache_key, coverage)]
+                        extensions[cache_key] = (intervals, new_coverage, missing_keys, stale_keys)
+                        continue
+                    if cache_key in local_cache:
+                        local_cache.record_lookup('local', True)
+                    # Identical targets in other requests share a single computation
+                    elif cache_key not in rise_sets_to_compute_later and cache_key not in leased_elsewhere:
+                        local_cache.record_lookup('local', False)
+                        intervals = get_from_disk_cache(cache_key)
+                        if disk_cache is not None:
+                            local_cache.record_lookup('disk', intervals is not None)
+                        if intervals is not None:
+                            local_cache[cache_key] = intervals
+                            continue
                         try:
                             # put intersections from the redis cache into the local cache for use later
-                            local_cache[cache_key] = pickle.loads(redis_instance.get(cache_key))
+                            local_cache[cache_key] = get_from_redis_cache(cache_key)
+                            local_cache.record_lookup('redis', True)
+                            save_to_disk_cache(cache_key, local_cache[cache_key])
                         except Exception:
+                            local_cache.record_lookup('redis', False)
+                            if is_quarantined(cache_key):
+                                # This target's rise_set calculation keeps timing out, so it is not visible
+                                log.warn('Skipping the quarantined rise set of request {} on {}'.format(r.id,
+                                                                                                      resource))
+                                local_cache[cache_key] = Intervals([])
+                                continue
+                            to_lease.append(cache_key)
                             # need to compute the rise_set for this target/resource/airmass/lunar_distance/lunar_phase combo
+                            rise_set_target = conf.target.in_rise_set_format()
+                            if conf.target.has_unbound_orbit():
+                                # The request id marks the target as only being computed over this request's windows
+                                rise_set_target['request_id'] = r.id
                             # If it happens to have been something with eccentricity >= 1.0, then do not use the cached visibility_for_resource
                             if 'request_id' in rise_set_target:
-                                windows_start, windows_end = windows_list_to_range(r.windows.windows_for_resource[resource])
+                                windows_start, windows_end = r.windows.range_at(resource)
                                 visibility = duplicate_visibility_with_new_window(visibility_for_resource[resource], windows_start, windows_end)
                                 rise_sets_to_compute_later[cache_key] = ((resource, rise_set_target,
                                                                           visibility,
@@ -317,69 +912,192 @@ def filter_on_visibility(rgs, visibility_for_resource, downtime_intervals, seein
                                                                           conf.constraints['min_lunar_distance'],
                                                                           conf.constraints['max_lunar_phase']))
 
-    num_processes = max(cpu_count() - 1, 1)
-    log.info("computing {} rise sets with {} processes".format(len(rise_sets_to_compute_later.keys()), num_processes))
-    # now use a thread pool to compute the missing rise_set intervals for a resource and target
-    if rise_sets_to_compute_later:
-        with get_context('spawn').Pool(processes=num_processes) as pool:
-            try:
-                pool.map_async(cache_rise_set_timepoint_intervals, rise_sets_to_compute_later.values()).get(300)
-            except TimeoutError:
-                pool.terminate()
-                log.warn(
-                    '300 second timeout reached on multiprocessing rise_set computations. Falling back to synchronous computation')
-            except Exception:
-                log.warn(
-                    'Failed to save rise_set intervals into redis. Please check that redis is online. Falling back on synchronous rise_set calculations.')
-            log.info("finished computing rise_sets")
-            pool.close()
-            pool.join()
-            log.info("finished closing thread pool")
+    # Every missing rise set is leased in one go, and those that another scheduler instance is computing are waited for
+    leased = acquire_rise_set_leases(to_lease)
+    if wait_for_leases:
+        for cache_key in to_lease:
+            if cache_key in leased:
+                continue
+            leased_elsewhere.add(cache_key)
+            if cache_key in extensions:
+                for missing_key in extensions.pop(cache_key)[2]:
+                    del rise_sets_to_compute_later[missing_key]
+                    del span_keys[missing_key]
+            else:
+                del rise_sets_to_compute_later[cache_key]
+
+    compute_start = time.monotonic()
+    lease_renewer = RiseSetLeaseRenewer(leased)
+    lease_renewer.start()
+    try:
+        rise_sets_for_pool = rise_sets_to_compute_later
+        if BATCH_SIDEREAL_VISIBILITY:
+            rise_sets_for_pool = compute_sidereal_rise_sets_in_batch(rise_sets_to_compute_later)
+        if rise_set_pool is not None:
+            timed_out = compute_rise_sets_in_worker_pool(rise_set_pool, rise_sets_for_pool,
+                                                         semester_range=(semester_start, semester_end))
+        else:
+            timed_out = compute_rise_sets_in_new_pool(rise_sets_for_pool)
+        # Targets which timed out are not visible in this run, rather than being recomputed here. They are retried in
+        # the next run unless they have now timed out too many times.
+        retry_later = set()
+        for cache_key in timed_out:
+            local_cache[cache_key] = Intervals([])
+            if not record_rise_set_timeout(span_keys.get(cache_key, cache_key)):
+                retry_later.add(cache_key)
         for cache_key in rise_sets_to_compute_later.keys():
-            try:
-                local_cache[cache_key] = pickle.loads(redis_instance.get(cache_key))
-            except Exception:
-                # failed to load this cache_key from redis, maybe redis is down. Will run synchronously.
-                (resource, rise_set_target, visibility, max_airmass, min_lunar_distance,
-                 max_lunar_phase) = rise_sets_to_compute_later[cache_key]
-                local_cache[cache_key] = get_rise_set_timepoint_intervals(rise_set_target, visibility, max_airmass,
-                                                                          min_lunar_distance, max_lunar_phase)
-                # save the newly calculated rise-set values into the redis cache for next restart
+            if cache_key in timed_out:
+                continue
+            if cache_key not in local_cache:
                 try:
-                    redis_instance.set(cache_key, pickle.dumps(local_cache[cache_key]))
+                    local_cache[cache_key] = get_from_redis_cache(cache_key)
                 except Exception:
-                    log.warn(
-                    'Failed to save rise_set intervals into redis. Please check that redis is online.')
+                    # failed to load this cache_key from redis, maybe redis is down. Will run synchronously.
+                    (resource, rise_set_target, visibility, max_airmass, min_lunar_distance,
+                     max_lunar_phase) = rise_sets_to_compute_later[cache_key]
+                    local_cache[cache_key] = get_rise_set_timepoint_intervals(rise_set_target, visibility,
+                                                                              max_airmass, min_lunar_distance,
+                                                                              max_lunar_phase)
+                    # save the newly calculated rise-set values into the redis cache for next restart
+                    try:
+                        save_to_redis_cache(cache_key, local_cache[cache_key])
+                    except Exception:
+                        log.warn(
+                        'Failed to save rise_set intervals into redis. Please check that redis is online.')
+            if cache_key not in span_keys:
+                save_to_disk_cache(cache_key, local_cache[cache_key])
+        local_cache.record_compute(len(rise_sets_to_compute_later), time.monotonic() - compute_start)
+
+        # Merge the newly computed spans of horizon limited targets into what was already cached for them
+        for cache_key, (intervals, coverage, missing_keys, stale_keys) in extensions.items():
+            missing_intervals = [local_cache.pop(missing_key) for missing_key in missing_keys]
+            if any(missing_key in timed_out for missing_key in missing_keys):
+                # The coverage is left as it was, so the missing spans are computed again in the next run
+                local_cache[cache_key] = intervals if intervals is not None else Intervals([])
+                if any(missing_key in retry_later for missing_key in missing_keys):
+                    retry_later.add(cache_key)
+            elif intervals is None:
+                save_coverage(cache_key, missing_intervals[0], coverage, stale_keys)
+            else:
+                save_coverage(cache_key, intervals.union(missing_intervals), coverage, stale_keys)
+            retry_later.difference_update(missing_keys)
+    finally:
+        # The results are in redis now, or were not computed, so other instances may go ahead
+        lease_renewer.stop()
+        release_rise_set_leases(leased)
+
+    return retry_later, leased_elsewhere
+
+
+def filter_on_resource_availability(rgs, available_resources, availability_context):
+    ''' Drops the windows of requests on resources which are not available this run, or on which every window is
+        blocked by downtime, so that no rise sets are looked up or computed for them. Those windows would be
+        discarded later anyway. An available_resources of None means every resource is available. Returns the
+        number of rise set lookups that were skipped.
+    '''
+    skipped = 0
+    for rg in rgs:
+        for r in rg.requests:
+            unavailable = set()
+            for resource in r.windows.windows_for_resource:
+                if available_resources is not None and resource not in available_resources:
+                    unavailable.add(resource)
+                    continue
+                blocked_intervals = availability_context.get_blocked_intervals(r, resource)
+                if not blocked_intervals.is_empty() and r.windows.intervals_at(resource).subtract(
+                        blocked_intervals).is_empty():
+                    unavailable.add(resource)
+            for resource in unavailable:
+                r.windows.remove_resource(resource)
+            skipped += len(unavailable) * len(r.configurations)
+    return skipped
+
 
+@log_windows
+def filter_on_visibility(rgs, visibility_for_resource, downtime_intervals, seeing_monitor, semester_start, semester_end,
+                         estimated_scheduler_end, rise_set_pool=None, available_resources=None):
+    availability_context = AvailabilityContext(downtime_intervals, seeing_monitor, estimated_scheduler_end)
+    skipped = filter_on_resource_availability(rgs, available_resources, availability_context)
+    if skipped:
+        log.info('Skipped {} rise set lookups on unavailable resources'.format(skipped))
+    local_cache.record_skipped(skipped)
+    retry_later = fill_rise_set_cache(rgs, visibility_for_resource, semester_start, semester_end, rise_set_pool)
 
     # now that we have all the rise_set intervals in local cache, perform the visibility filter on the requests
+    num_requests = sum(len(rg.requests) for rg in rgs)
+    if not (rise_set_pool is not None and 0 < PARALLEL_VISIBILITY_MIN_REQUESTS <= num_requests and
+            compute_availability_in_worker_pool(rise_set_pool, rgs, availability_context)):
+        for rg in rgs:
+            for r in rg.requests:
+                intervals_by_resource = {}
+                for conf in r.configurations:
+                    for resource in r.windows.windows_for_resource:
+                        target_intervals = local_cache[make_request_cache_key(r, conf, resource)]
+                        if resource in intervals_by_resource:
+                            intervals_by_resource[resource] = intervals_by_resource[resource].intersect(
+                                [target_intervals])
+                        else:
+                            intervals_by_resource[resource] = target_intervals
+                process_request_visibility(rg.id, r, intervals_by_resource, downtime_intervals, seeing_monitor,
+                                           estimated_scheduler_end, availability_context=availability_context)
+    for cache_key in retry_later:
+        del local_cache[cache_key]
+    local_cache.finish_run()
+
+    return rgs
+
+
+def compute_availability_in_worker_pool(rise_set_pool, rgs, availability_context):
+    '''Intersects the windows of every request with its cached rise_set intervals, and removes the blocked
+       intervals, in the rise_set_pool. The cached intervals are shared with the workers through shared memory.
+       Returns False, leaving the requests untouched, if the workers failed so the caller can fall back.
+    '''
+    shared_intervals = SharedIntervals()
+    requests = []
+    request_tasks = []
     for rg in rgs:
         for r in rg.requests:
-            intervals_by_resource = {}
-            for conf in r.configurations:
-                for resource in r.windows.windows_for_resource:
-                    rise_set_target = conf.target.in_rise_set_format()
-                    # If the eccentricity is > 1.0, we cant do our normal semester long caching as the orbit may be unstable
-                    # over longer time horizons. Instead, just cache for this exact request only
-                    if rise_set_target.get('eccentricity', 0.0) >= 1.0:
-                        # Add the request id to the rise_set_target since that is part of its cache key
-                        rise_set_target['request_id'] = r.id
-                    cache_key = make_cache_key(resource, rise_set_target,
-                                               conf.constraints['max_airmass'],
-                                               conf.constraints['min_lunar_distance'],
-                                               conf.constraints['max_lunar_phase'])
-                    target_intervals = local_cache[cache_key]
-                    if resource in intervals_by_resource:
-                        intervals_by_resource[resource] = intervals_by_resource[resource].intersect([target_intervals])
-                    else:
-                        intervals_by_resource[resource] = target_intervals
-            process_request_visibility(rg.id, r, intervals_by_resource, downtime_intervals, seeing_monitor, estimated_scheduler_end)
+            resource_tasks = []
+            for resource in r.windows.windows_for_resource:
+                cache_keys = [make_request_cache_key(r, conf, resource) for conf in r.configurations]
+                target_slots = [shared_intervals.add(cache_key, local_cache[cache_key]) for cache_key in cache_keys]
+                user_bounds = r.windows.bounds_at(resource)
+                blocked_slot = shared_intervals.add(availability_context.blocked_intervals_key(r, resource),
+                                                    availability_context.get_blocked_intervals(r, resource))
+                resource_tasks.append((resource, target_slots, user_bounds, blocked_slot))
+            request_tasks.append((len(requests), resource_tasks))
+            requests.append((rg.id, r))
+
+    log.info("intersecting the windows of {} with {} processes".format(pl(len(requests), 'request'),
+                                                                       rise_set_pool.processes))
+    try:
+        name, rows = shared_intervals.publish()
+        chunks = [(name, rows, request_tasks[index:index + CHUNK_SIZE])
+                  for index in range(0, len(request_tasks), CHUNK_SIZE)]
+        results = rise_set_pool.map_tasks(intersect_windows_in_worker, chunks)
+    except Exception as e:
+        log.warning('Failed to intersect request windows in the worker pool, falling back to the main process: '
+                    '{}'.format(repr(e)))
+        return False
+    finally:
+        shared_intervals.close()
 
-    return rgs
+    for chunk_results in results:
+        for request_index, bounds_by_resource in chunk_results:
+            request_group_id, request = requests[request_index]
+            request.windows = bounds_to_windows(request, bounds_by_resource)
+            emit_request_visibility_feedback(request_group_id, request)
+    return True
+
+
+def process_request_visibility(request_group_id, request, target_intervals, downtime_intervals, seeing_monitor,
+                               estimated_scheduler_end, availability_context=None):
+    request = compute_request_availability(request, target_intervals, downtime_intervals, seeing_monitor,
+                                           estimated_scheduler_end, availability_context=availability_context)
+    emit_request_visibility_feedback(request_group_id, request)
 
 
-def process_request_visibility(request_group_id, request, target_intervals, downtime_intervals, seeing_monitor, estimated_scheduler_end):
-    request = compute_request_availability(request, target_intervals, downtime_intervals, seeing_monitor, estimated_scheduler_end)
+def emit_request_visibility_feedback(request_group_id, request):
     if request.has_windows():
         tag = 'RequestIsVisible'
         msg = 'Request {} (RG {}) is visible ({} windows remaining)'.format(request.id, request_group_id,
@@ -391,28 +1109,62 @@ def process_request_visibility(request_group_id, request, target_intervals, down
     RequestGroup.emit_request_group_feedback(request_group_id, msg, tag)
 
 
-def compute_request_availability(request, target_intervals_by_resource, downtime_intervals, seeing_monitor, estimated_scheduler_end=datetime.utcnow()):
+class AvailabilityContext(object):
+    ''' Holds the downtime and seeing intervals which are blocked off for every request in a scheduling run. The
+        blocked intervals only depend on the resource, the instrument type and whether the seeing constraint of a
+        request is violated, so they are built once for each combination and reused for every request.
+    '''
+
+    def __init__(self, downtime_intervals, seeing_monitor, estimated_scheduler_end):
+        self.downtime_intervals = downtime_intervals
+        self.seeing_by_resources = seeing_monitor.retrieve_data()
+        self.seeing_valid_time_period = seeing_monitor.seeing_valid_time_period
+        self.estimated_scheduler_end = estimated_scheduler_end
+        self._blocked_intervals = {}
+
+    def seeing_is_violated(self, request, resource):
+        if resource not in self.seeing_by_resources:
+            return False
+        current_seeing = self.seeing_by_resources[resource]['seeing']
+        return any('max_seeing' in conf.constraints and conf.constraints['max_seeing'] <= current_seeing
+                   for conf in request.configurations)
+
+    def blocked_intervals_key(self, request, resource):
+        return (resource, request.configurations[0].instrument_type.upper(),
+                self.seeing_is_violated(request, resource))
+
+    def get_blocked_intervals(self, request, resource):
+        ''' Returns the kernel Intervals on the resource which are unavailable to the request '''
+        key = self.blocked_intervals_key(request, resource)
+        if key not in self._blocked_intervals:
+            self._blocked_intervals[key] = self._build_blocked_intervals(*key)
+        return self._blocked_intervals[key]
+
+    def _build_blocked_intervals(self, resource, instrument_type, seeing_is_violated):
+        blocked = []
+        for downtime_instrument_type, intervals in self.downtime_intervals.get(resource, {}).items():
+            if downtime_instrument_type == 'all' or downtime_instrument_type.upper() == instrument_type:
+                blocked.extend(intervals)
+        if seeing_is_violated:
+            blockoff_until = (self.seeing_by_resources[resource]['time'] +
+                              timedelta(minutes=self.seeing_valid_time_period))
+            if blockoff_until > self.estimated_scheduler_end:
+                blocked.append((self.estimated_scheduler_end, blockoff_until))
+        return rise_set_to_kernel_intervals(blocked)
+
+
+def compute_request_availability(request, target_intervals_by_resource, downtime_intervals, seeing_monitor,
+                                 estimated_scheduler_end=datetime.utcnow(), availability_context=None):
+    if availability_context is None:
+        availability_context = AvailabilityContext(downtime_intervals, seeing_monitor, estimated_scheduler_end)
     intervals_for_resource = {}
-    seeing_by_resources = seeing_monitor.retrieve_data()
     for resource, target_intervals in target_intervals_by_resource.items():
         # Intersect with any window provided in the user request
-        user_windows = request.windows.at(resource)
-        user_intervals = Windows.request_window_to_kernel_intervals(user_windows)
+        user_intervals = request.windows.intervals_at(resource)
         intervals_for_resource[resource] = target_intervals.intersect([user_intervals])
-        if resource in downtime_intervals:
-            for instrument_type, intervals in downtime_intervals[resource].items():
-                if instrument_type == 'all' or instrument_type.upper() == request.configurations[0].instrument_type.upper():
-                    downtime_kernel_intervals = rise_set_to_kernel_intervals(intervals)
-                    intervals_for_resource[resource] = intervals_for_resource[resource].subtract(downtime_kernel_intervals)
-        if resource in seeing_by_resources:
-            for conf in request.configurations:
-                if 'max_seeing' in conf.constraints and conf.constraints['max_seeing'] <= seeing_by_resources[resource]['seeing']:
-                    blockoff_until = seeing_by_resources[resource]['time'] + timedelta(minutes=seeing_monitor.seeing_valid_time_period)
-                    if blockoff_until > estimated_scheduler_end:
-                        blockoff_seeing_interval = rise_set_to_kernel_intervals([(estimated_scheduler_end, blockoff_until)])
-                        intervals_for_resource[resource] = intervals_for_resource[resource].subtract(blockoff_seeing_interval)
-                    # We've already blocked off time for the seeing constraint being violated, so no need to check any more configurations
-                    break
+        # Remove any downtime, and time blocked off because the seeing constraint is currently violated
+        blocked_intervals = availability_context.get_blocked_intervals(request, resource)
+        intervals_for_resource[resource] = intervals_for_resource[resource].subtract(blocked_intervals)
 
     request.windows = intervals_to_windows(request, intervals_for_resource)
     return request
@@ -421,17 +1173,9 @@ def compute_request_availability(request, target_intervals_by_resource, downtime
 def intervals_to_windows(req, intersections_for_resource):
     windows = Windows()
     for resource_name, intervals in intersections_for_resource.items():
-        windows_for_resource = req.windows.windows_for_resource[resource_name]
-        # TODO: This needs cleanup
-        # It's possible there are no windows for this resource so we can't
-        # assume that we will be able to get a handle on the resource from the
-        # first window.
-        if (len(windows_for_resource) > 0):
-            resource = windows_for_resource[0].resource
-
-            for (start, end) in intervals.toTupleList():
-                w = Window({'start': start, 'end': end}, resource)
-                windows.append(w)
+        # It's possible there are no windows for this resource, in which case it gets none
+        if len(req.windows.bounds_at(resource_name)) > 0 and not intervals.is_empty():
+            windows.set_bounds(resource_name, datetimes_to_bounds(intervals.toTupleList()))
 
     return windows
 
@@ -441,10 +1185,11 @@ def intervals_to_windows(req, intersections_for_resource):
 def make_compound_reservations(request_groups, semester_start, network_model):
     '''Parse a list of CompoundRequests, and produce a corresponding list of
        CompoundReservations.'''
+    cache_airmasses_for_request_groups(request_groups, semester_start, network_model)
     to_schedule = []
     for rg in request_groups:
         # Make and store the CompoundReservation
-        compound_res = construct_compound_reservation(rg, semester_start, network_model)
+        compound_res = construct_compound_reservation(rg, semester_start, network_model, airmasses_cached=True)
         to_schedule.append(compound_res)
 
     return to_schedule
@@ -455,13 +1200,15 @@ def make_many_type_compound_reservations(many_request_groups, semester_start, ne
     '''Parse a list of CompoundRequests of type 'many', and produce a corresponding
        list of CompoundReservations. Each 'many' will produce one CompoundReservation
        per Request child.'''
+    cache_airmasses_for_request_groups(many_request_groups, semester_start, network_model)
     to_schedule = []
     for many_rg in many_request_groups:
         # Produce a distinct CR for each R in a 'many'
         # We do this because the kernel knows nothing about 'many', and will treat
         # the scheduling of the children as completely independent
         for request_index, _ in enumerate(many_rg.requests):
-            compound_res = construct_many_compound_reservation(many_rg, request_index, semester_start, network_model)
+            compound_res = construct_many_compound_reservation(many_rg, request_index, semester_start, network_model,
+                                                               airmasses_cached=True)
             to_schedule.append(compound_res)
 
     return to_schedule
@@ -512,17 +1259,6 @@ def duplicate_visibility_with_new_window(visibility, start, end, twilight='nauti
     return new_visibility
 
 
-def windows_list_to_range(windows_list):
-    start = None
-    end = None
-    for window in windows_list:
-        if start is None or window.start < start:
-            start = window.start
-        if end is None or window.end > end:
-            end = window.end
-    return start, end
-
-
 def construct_global_availability(resource_interval_mask, semester_start, resource_windows):
     '''Use the interval mask to make unavailable portions of each resource where an
        observation is running/rr request will occur. Normalise and intersect with the resource windows to
@@ -23,7 +23,11 @@ from rise_set.angle import Angle
 from rise_set.exceptions import InvalidAngleError, AngleConfigError, RatesConfigError
 from rise_set.rates import ProperMotion
 from adaptive_scheduler.utils import (iso_string_to_datetime, convert_proper_motion, datetime_to_normalised_epoch,
-                                      EqualityMixin, safe_unidecode, normalise_datetime_intervals, OptimizationType)
+                                      EqualityMixin, SendMetricMixin, safe_unidecode, OptimizationType,
+                                      rise_set_target_fingerprint,
+                                      deterministic_fraction, json_fingerprint,
+                                      datetime_to_epoch, normalise, datetime_to_epoch_microseconds,
+                                      epoch_microseconds_to_datetime, epoch_array_to_datetimes)
 from adaptive_scheduler.printing import plural_str as pl
 from adaptive_scheduler.kernel.reservation import CompoundReservation
 from adaptive_scheduler.feedback import UserFeedbackLogger
@@ -33,12 +37,12 @@ from adaptive_scheduler.observation_portal_connections import ObservationPortalC
 
 from datetime import datetime, timedelta
 from collections import defaultdict
+from collections.abc import MutableMapping, Sequence
 import numpy as np
 import ast
 import os
 import json
 import logging
-import random
 from redis import Redis
 
 log = logging.getLogger(__name__)
@@ -47,6 +51,9 @@ event_bus = get_eventbus()
 
 redis_instance = Redis.from_url(url=os.getenv('REDIS_URL', 'redis://redis'), socket_connect_timeout=15,
               socket_timeout=30)
+# Cached rise_set intervals and airmass samples expire from redis after this long, since redis is no longer flushed
+# when the semester changes
+REDIS_CACHE_TTL = timedelta(days=float(os.getenv('RISE_SET_CACHE_TTL_DAYS', 400.0)))
 
 
 AIRMASS_WEIGHTING_COEFFICIENT = os.getenv("AIRMASS_WEIGHTING_COEFFICIENT", 0.1)
@@ -148,6 +155,61 @@ def differentiate_by_type(operator, rgs):
     return chosen_type, other_types
 
 
+class RGCollection(Sequence):
+    ''' An ordered collection of RequestGroups indexed by their id. Membership is checked by id, given either a
+        RequestGroup or its id, so it does not need to compare the RequestGroups themselves.
+    '''
+
+    def __init__(self, request_groups=()):
+        self._request_groups = []
+        self._by_id = {}
+        self._by_request_id = {}
+        for rg in request_groups:
+            self.append(rg)
+
+    def append(self, rg):
+        self._request_groups.append(rg)
+        self._by_id[rg.id] = rg
+        for request in rg.requests:
+            self._by_request_id[request.id] = rg
+
+    def get(self, rg_id, default=None):
+        return self._by_id.get(rg_id, default)
+
+    def get_by_request_id(self, request_id, default=None):
+        '''Returns the RequestGroup which still holds the request with this id.'''
+        rg = self._by_request_id.get(request_id)
+        if rg is not None and any(request.id == request_id for request in rg.requests):
+            return rg
+        return default
+
+    def ids(self):
+        return self._by_id.keys()
+
+    def difference(self, other):
+        '''Returns the RequestGroups in this collection whose ids are not in other, in their original order.'''
+        if not isinstance(other, RGCollection):
+            other = RGCollection(other)
+        return RGCollection(rg for rg in self._request_groups if rg.id not in other)
+
+    def __contains__(self, rg_or_id):
+        return getattr(rg_or_id, 'id', rg_or_id) in self._by_id
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RGCollection(self._request_groups[index])
+        return self._request_groups[index]
+
+    def __iter__(self):
+        return iter(self._request_groups)
+
+    def __len__(self):
+        return len(self._request_groups)
+
+    def __repr__(self):
+        return 'RGCollection({})'.format(list(self.ids()))
+
+
 def file_to_dicts(filename):
     fh = open(filename, 'r')
     data = fh.read()
@@ -165,11 +227,45 @@ class DataContainer(EqualityMixin):
 
 
 class Target(DataContainer):
+    _memoized = ('_rise_set_format', '_rise_set_fingerprint')
+    _eq_exclude = _memoized
 
     def __init__(self, required_fields, *initial_data, **kwargs):
         super().__init__(*initial_data, **kwargs)
         self.required_fields = required_fields
 
+    def __setattr__(self, name, value):
+        # Any change to the target invalidates its memoized rise_set format and fingerprint
+        if name not in self._memoized:
+            for memoized in self._memoized:
+                self.__dict__.pop(memoized, None)
+        super().__setattr__(name, value)
+
+    def in_rise_set_format(self):
+        ''' Returns the target in the rise_set format. It is only built once per target, as it is needed for every
+            resource and configuration the target is observed with. Each caller gets its own copy of the dict.
+        '''
+        if '_rise_set_format' not in self.__dict__:
+            self._rise_set_format = self.make_rise_set_format()
+        return dict(self._rise_set_format)
+
+    def make_rise_set_format(self):
+        ''' Builds the target's rise_set format. Targets that cannot be scheduled, such as a NullTarget, have none, and
+            raise the AttributeError they raised before they had an in_rise_set_format.
+        '''
+        raise AttributeError('targets of type {} have no rise_set format'.format(self.__class__.__name__))
+
+    def get_rise_set_fingerprint(self):
+        ''' Returns a digest of the target's rise_set format, used to key cached visibility intervals. It is only
+            computed once per target, so identical targets in many requests don't each build a key from scratch.
+        '''
+        if '_rise_set_fingerprint' not in self.__dict__:
+            self._rise_set_fingerprint = rise_set_target_fingerprint(self.in_rise_set_format())
+        return self._rise_set_fingerprint
+
+    def has_unbound_orbit(self):
+        return False
+
     def list_missing_fields(self):
         missing_fields = []
         for field in self.required_fields:
@@ -220,7 +316,7 @@ class ICRSTarget(Target):
     def get_dec(self):
         return self._dec
 
-    def in_rise_set_format(self):
+    def make_rise_set_format(self):
         if hasattr(self, 'proper_motion_ra') and hasattr(self, 'proper_motion_dec'):
             # if we have proper_motion, then convert the units of proper motion to arcsec/year
             prop_mot_ra, prop_mot_dec = convert_proper_motion(self.proper_motion_ra,
@@ -251,7 +347,7 @@ class OrbitalElementsTarget(Target):
         required_fields = required_fields_from_scheme(scheme)
         super().__init__(required_fields, *initial_data, **kwargs)
 
-    def in_rise_set_format(self):
+    def make_rise_set_format(self):
         if self.scheme.lower() == 'mpc_comet':
             target_dict = make_comet_target(self.scheme, self.epochofel, self.epochofperih,
                                             self.orbinc, self.longascnode, self.argofperih,
@@ -272,6 +368,10 @@ class OrbitalElementsTarget(Target):
 
         return target_dict
 
+    def has_unbound_orbit(self):
+        # Orbits with an eccentricity >= 1.0 may be unstable over a semester, so they are not cached semester long
+        return getattr(self, 'eccentricity', 0.0) >= 1.0
+
 
 class SatelliteTarget(Target):
     ''' SatelliteTarget for targets with satellite parameters and fixed windows. Rise-set just returns the
@@ -283,7 +383,7 @@ class SatelliteTarget(Target):
                            'diff_altitude_acceleration', 'diff_azimuth_acceleration')
         super().__init__(required_fields, *initial_data, **kwargs)
 
-    def in_rise_set_format(self):
+    def make_rise_set_format(self):
         target_dict = make_satellite_target(self.altitude, self.azimuth, self.diff_altitude_rate, self.diff_azimuth_rate,
                                             self.diff_altitude_acceleration, self.diff_azimuth_acceleration,
                                             self.diff_epoch)
@@ -315,40 +415,171 @@ class Configuration(DataContainer):
         return instrument_requirements
 
 
-class Window(EqualityMixin):
-    '''Accepts start and end times as datetimes or ISO strings.'''
+class Window(object):
+    '''Accepts start and end times as datetimes or ISO strings. These are stored as integer epoch
+       microseconds, and are only turned back into datetimes when start or end is read.'''
+    __slots__ = ('start_epoch', 'end_epoch', 'resource')
 
     def __init__(self, window_dict, resource):
         try:
-            self.start = iso_string_to_datetime(window_dict['start'])
-            self.end = iso_string_to_datetime(window_dict['end'])
+            start = iso_string_to_datetime(window_dict['start'])
+            end = iso_string_to_datetime(window_dict['end'])
         except TypeError:
-            self.start = window_dict['start']
-            self.end = window_dict['end']
+            start = window_dict['start']
+            end = window_dict['end']
 
+        self.start_epoch = datetime_to_epoch_microseconds(start)
+        self.end_epoch = datetime_to_epoch_microseconds(end)
         self.resource = resource
 
+    @classmethod
+    def from_epochs(cls, start_epoch, end_epoch, resource):
+        window = cls.__new__(cls)
+        window.start_epoch = int(start_epoch)
+        window.end_epoch = int(end_epoch)
+        window.resource = resource
+        return window
+
+    @property
+    def start(self):
+        return epoch_microseconds_to_datetime(self.start_epoch)
+
+    @start.setter
+    def start(self, start):
+        self.start_epoch = datetime_to_epoch_microseconds(start)
+
+    @property
+    def end(self):
+        return epoch_microseconds_to_datetime(self.end_epoch)
+
+    @end.setter
+    def end(self, end):
+        self.end_epoch = datetime_to_epoch_microseconds(end)
+
     def get_resource_name(self):
         return self.resource
 
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return ((self.start_epoch, self.end_epoch, self.resource) ==
+                    (other.start_epoch, other.end_epoch, other.resource))
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def __repr__(self):
         return "Window (%s, %s)" % (self.start, self.end)
 
 
-class Windows(EqualityMixin):
+# The bounds of a resource without any windows. Bounds arrays are never written to once stored.
+_NO_BOUNDS = np.empty((0, 2), dtype=np.int64)
+_NO_BOUNDS.flags.writeable = False
+
+
+class WindowsByResource(MutableMapping):
+    ''' A dict like view of the windows in a Windows, by resource name. The Window objects are made as they are read,
+        and assigning a list of windows to a resource replaces the windows on that resource.
+    '''
+    __slots__ = ('_windows',)
+
+    def __init__(self, windows):
+        self._windows = windows
+
+    def __getitem__(self, resource_name):
+        return self._windows.at(resource_name)
+
+    def __setitem__(self, resource_name, windows):
+        self._windows.set_bounds(resource_name, [(window.start_epoch, window.end_epoch) for window in windows])
+
+    def __delitem__(self, resource_name):
+        self._windows.remove_resource(resource_name)
+
+    def __contains__(self, resource_name):
+        return resource_name in self._windows._bounds
+
+    def __iter__(self):
+        return iter(self._windows._bounds)
+
+    def __len__(self):
+        return len(self._windows._bounds)
+
+    def copy(self):
+        return {resource_name: self[resource_name] for resource_name in self}
+
+
+def is_shared_bounds(bounds):
+    '''Returns whether bounds is already a read only (n x 2) int64 array, which can be stored without copying.'''
+    return (isinstance(bounds, np.ndarray) and bounds.dtype == np.int64 and bounds.ndim == 2 and
+            bounds.shape[1] == 2 and not bounds.flags.writeable)
+
+
+class Windows(object):
+    ''' The windows of a request on each resource. The windows on a resource are kept as an (n x 2) int64 array of
+        their (start, end) epoch microseconds, and Window objects are only made when windows_for_resource or at() are
+        read. Appended windows are gathered into the array the next time it is needed.
+    '''
+    __slots__ = ('_bounds', '_appended')
+
     def __init__(self):
-        self.windows_for_resource = {}
+        self._bounds = {}
+        self._appended = {}
 
-    def append(self, window):
-        if window.get_resource_name() in self.windows_for_resource:
-            self.windows_for_resource[window.get_resource_name()].append(window)
-        else:
-            self.windows_for_resource[window.get_resource_name()] = [window]
+    @property
+    def windows_for_resource(self):
+        return WindowsByResource(self)
 
-        return
+    def append(self, window):
+        self.append_epochs(window.get_resource_name(), window.start_epoch, window.end_epoch)
+
+    def append_epochs(self, resource_name, start_epoch, end_epoch):
+        if resource_name not in self._bounds:
+            self._bounds[resource_name] = _NO_BOUNDS
+        self._appended.setdefault(resource_name, []).append((start_epoch, end_epoch))
+
+    def set_bounds(self, resource_name, bounds):
+        '''Replaces the windows on the resource with the (start, end) epoch microseconds in bounds. A read only bounds
+           array is stored as it is, so the same windows can be shared by many resources and requests.'''
+        self._appended.pop(resource_name, None)
+        if not is_shared_bounds(bounds):
+            bounds = np.array(bounds, dtype=np.int64).reshape(-1, 2)
+            bounds.flags.writeable = False
+        self._bounds[resource_name] = bounds
+
+    def copy(self):
+        '''Returns a copy of these windows. The bounds arrays are never written to, so they are shared.'''
+        windows = Windows()
+        windows._bounds = dict(self._bounds)
+        windows._appended = {resource_name: list(appended) for resource_name, appended in self._appended.items()}
+        return windows
+
+    def remove_resource(self, resource_name):
+        del self._bounds[resource_name]
+        self._appended.pop(resource_name, None)
+
+    def bounds_at(self, resource_name):
+        '''Returns a read only (n x 2) array of the (start, end) epoch microseconds of the windows on the resource.'''
+        if resource_name in self._appended:
+            bounds = self._bounds[resource_name]
+            appended = np.array(self._appended.pop(resource_name), dtype=np.int64)
+            self.set_bounds(resource_name, np.concatenate((bounds, appended)) if len(bounds) else appended)
+        return self._bounds[resource_name]
 
     def at(self, resource_name):
-        return self.windows_for_resource[resource_name]
+        return [Window.from_epochs(start, end, resource_name)
+                for start, end in self.bounds_at(resource_name).tolist()]
+
+    def range_at(self, resource_name):
+        '''Returns the earliest start and latest end of the windows on the resource, or (None, None) if it has none.'''
+        bounds = self.bounds_at(resource_name)
+        if len(bounds) == 0:
+            return None, None
+        return epoch_microseconds_to_datetime(bounds[:, 0].min()), epoch_microseconds_to_datetime(bounds[:, 1].max())
+
+    def intervals_at(self, resource_name):
+        '''Returns the windows on the resource as Intervals of datetimes, like request_window_to_kernel_intervals.'''
+        return Intervals([tuple(epoch_array_to_datetimes(bounds))
+                          for bounds in self.bounds_at(resource_name)])
 
     def has_windows(self):
         return self.size() > 0
@@ -357,7 +588,7 @@ class Windows(EqualityMixin):
         '''Convert windows for resources into intervals for resources. This shouldn't be called until the windows have been pared down
         to only those available for scheduling within.
         '''
-        return {resource: Windows.request_window_to_kernel_intervals(windows) for resource, windows in self.windows_for_resource.items()}
+        return {resource: self.intervals_at(resource) for resource in self._bounds}
 
     @staticmethod
     def request_window_to_kernel_intervals(windows):
@@ -373,32 +604,45 @@ class Windows(EqualityMixin):
         '''Convert windows for resources into kernel intervals for resources. This shouldn't be called until the windows have been pared down
         to only those available for scheduling within.
         '''
-        window_intervals = self.to_window_intervals()
+        epoch_start = datetime_to_epoch(semester_start)
         window_dict = {}
 
         # Build the normalised Windows data structure for the kernel
-        for resource_name, dark_up_intervals in window_intervals.items():
-            # Convert timepoints into normalised epoch time
-            epoch_intervals = normalise_datetime_intervals(dark_up_intervals, semester_start)
+        for resource_name in self._bounds:
+            # Overlapping windows are merged at full resolution, before being truncated to whole seconds of kernel
+            # time, just as the datetime windows were
+            window_intervals = Intervals([tuple(bounds) for bounds in self.bounds_at(resource_name).tolist()])
+            epoch_timepoints = [{'time': normalise(timepoint['time'] // 1000000, epoch_start),
+                                 'type': timepoint['type']} for timepoint in window_intervals.toDictList()]
 
             # Construct Reservations
             # Priority comes from the parent CompoundRequest
             # Each Reservation represents the set of available windows of opportunity
             # The resource is governed by the timepoint.resource attribute
-            window_dict[resource_name] = epoch_intervals
+            window_dict[resource_name] = Intervals(epoch_timepoints)
 
         return window_dict
 
     def size(self):
         all_windows_size = 0
-        for windows in self.windows_for_resource.values():
-            all_windows_size += len(windows)
+        for resource_name, bounds in self._bounds.items():
+            all_windows_size += len(bounds) + len(self._appended.get(resource_name, ()))
 
         return all_windows_size
 
     def __iter__(self):
-        for resource_name, windows in self.windows_for_resource.items():
-            yield resource_name, windows
+        for resource_name in list(self._bounds):
+            yield resource_name, self.at(resource_name)
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return (self._bounds.keys() == other._bounds.keys() and
+                    all(np.array_equal(self.bounds_at(resource_name), other.bounds_at(resource_name))
+                        for resource_name in self._bounds))
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
 
 class Proposal(DataContainer):
@@ -457,64 +701,16 @@ class Request(EqualityMixin):
         Also caches the "best" and "worst" airmass points, to use for normalization within the kernel.
 
         This should only be called after the windows of this request have already been pared down within kernel_mappings.
+        When caching the airmasses of many requests, call cache_airmasses_for_requests once for all of them instead.
         '''
-        for resource in kernel_intervals_for_resources.keys():
-            cache_key = f'{self.id}_{resource}_airmass_at_times'
-            if not redis_instance.exists(cache_key):
-                # Need to calculate the airmass values here
-                resource_info = network_model[resource]
-                datetimes = []
-                times = []
-                obs_latitude = Angle(degrees=resource_info['latitude'])
-                obs_longitude = Angle(degrees=resource_info['longitude'])
-                obs_height = resource_info['elevation']
-                visibility_intervals = Windows.request_window_to_kernel_intervals(self.windows.at(resource_info["name"]))
-                for (start, end) in visibility_intervals.toTupleList():
-                    current_datetime = start
-                    current_time = datetime_to_normalised_epoch(start, semester_start)
-                    # Add the start point, and then a timepoint at interval_size spacing until you reach the end
-                    while current_datetime < end:
-                        datetimes.append(current_datetime)
-                        current_datetime += timedelta(seconds=interval_size)
-                        times.append(current_time)
-                        current_time += interval_size
-                    # Add the end point on so we have a complete set of airmasses spanning the interval
-                    datetimes.append(end)
-                    times.append(datetime_to_normalised_epoch(end, semester_start))
-                if not datetimes:
-                    continue
-                # Now that we have a full set of datetimes and unix/kernel times, calculate the airmass values within those times
-                # Calculate the airmasses for each target in the configuration and attempt to merge them all... This could be improved upon
-                rs_targets = [configuration.target.in_rise_set_format() for configuration in self.configurations]
-                airmass_by_targets = {}
-                for rs_target in rs_targets:
-                    rs_target_key = f"{rs_target.items()}"
-                    if rs_target_key not in airmass_by_targets:
-                        airmass_by_targets[rs_target_key] = calculate_airmass_at_times(datetimes, rs_target, obs_latitude, obs_longitude, obs_height)
-
-                if len(airmass_by_targets) == 1:
-                    airmasses = list(airmass_by_targets.values())[0]
-                else:
-                    numpy_airmasses = np.array(list(airmass_by_targets.values()))
-                    airmasses = np.mean(numpy_airmasses, axis=0).tolist()
-                # Now normalize the airmass values between the minimum and maximum airmass so that the weighting
-                # is similar for all requests
-                best_airmass = min(airmasses)
-                worst_airmass = max(airmasses)
-                # This should give us something ranging from 0 to AIRMASS_WEIGHTING_COEFFICIENT to add to the effective priority
-                airmasses = [float(AIRMASS_WEIGHTING_COEFFICIENT) * (1 - (airmass - best_airmass) / (worst_airmass - best_airmass)) for airmass in airmasses]
-                # Now store the airmasses and times in the redis cache
-                airmass_at_times = {
-                    'airmasses': airmasses,
-                    'times': times
-                }
-                redis_instance.set(cache_key, json.dumps(airmass_at_times))
+        cache_airmasses_for_requests([self], network_model, semester_start, interval_size,
+                                     resources=kernel_intervals_for_resources.keys())
 
     def get_airmasses_within_kernel_windows(self, resource_name):
         '''Attempts to return a previously cached set of airmasses, or an empty dict if none are cached.
         This should be called after calling cache_airmasses_within_kernel.
         '''
-        cache_key = f'{self.id}_{resource_name}_airmass_at_times'
+        cache_key = airmass_cache_key(self, resource_name)
         try:
             airmass_at_times = json.loads(redis_instance.get(cache_key))
             return airmass_at_times
@@ -525,6 +721,106 @@ class Request(EqualityMixin):
     duration = property(get_duration)
 
 
+def airmass_cache_key(request, resource_name):
+    return f'{request.id}_{resource_name}_airmass_at_times'
+
+
+def airmass_sample_times(windows, semester_start, interval_size):
+    '''Returns the datetimes at which to sample the airmass within a list of windows, and their normalised epochs. The
+       start of each window is sampled, then a timepoint at interval_size spacing until its end, which is sampled too.
+    '''
+    datetimes = []
+    times = []
+    for (start, end) in Windows.request_window_to_kernel_intervals(windows).toTupleList():
+        current_datetime = start
+        current_time = datetime_to_normalised_epoch(start, semester_start)
+        while current_datetime < end:
+            datetimes.append(current_datetime)
+            current_datetime += timedelta(seconds=interval_size)
+            times.append(current_time)
+            current_time += interval_size
+        datetimes.append(end)
+        times.append(datetime_to_normalised_epoch(end, semester_start))
+    return datetimes, times
+
+
+def cache_airmasses_for_requests(requests, network_model, semester_start, interval_size=30*60, resources=None):
+    '''Caches the airmasses of a batch of requests at interval spacing within their windows on each resource, in the
+       format returned by Request.get_airmasses_within_kernel_windows. The airmasses of a request are averaged over
+       the targets of its configurations, then normalized between its best and worst airmass.
+
+       The batch makes two redis round trips, however many requests it holds: one pipeline checking which requests
+       and resources are already cached, and one storing the rest. The airmasses of each distinct target are only
+       calculated once per site, over every time sampled by any of the requests observing it there.
+       Returns the number of (target, site) airmass series calculated.
+    '''
+    pending = []
+    for request in requests:
+        for resource in (request.windows.windows_for_resource if resources is None else resources):
+            if len(request.windows.bounds_at(resource)) > 0:
+                pending.append((request, resource))
+    if not pending:
+        return 0
+
+    pipeline = redis_instance.pipeline(transaction=False)
+    for request, resource in pending:
+        pipeline.exists(airmass_cache_key(request, resource))
+    missing = [pair for pair, cached in zip(pending, pipeline.execute()) if not cached]
+
+    # Gather the times each target is sampled at on each site, so shared targets are calculated together
+    samples = []
+    rs_targets = {}
+    datetimes_by_target_and_site = defaultdict(set)
+    for request, resource in missing:
+        datetimes, times = airmass_sample_times(request.windows.at(resource), semester_start, interval_size)
+        if not datetimes:
+            continue
+        resource_info = network_model[resource]
+        site = (resource_info['latitude'], resource_info['longitude'], resource_info['elevation'])
+        fingerprints = []
+        for configuration in request.configurations:
+            fingerprint = configuration.target.get_rise_set_fingerprint()
+            if fingerprint not in rs_targets:
+                rs_targets[fingerprint] = configuration.target.in_rise_set_format()
+            if fingerprint not in fingerprints:
+                fingerprints.append(fingerprint)
+            datetimes_by_target_and_site[(fingerprint, site)].update(datetimes)
+        samples.append((request, resource, site, fingerprints, datetimes, times))
+
+    airmass_by_target_and_site = {}
+    for (fingerprint, site), datetimes in datetimes_by_target_and_site.items():
+        datetimes = sorted(datetimes)
+        latitude, longitude, elevation = site
+        airmasses = calculate_airmass_at_times(datetimes, rs_targets[fingerprint], Angle(degrees=latitude),
+                                               Angle(degrees=longitude), elevation)
+        airmass_by_target_and_site[(fingerprint, site)] = dict(zip(datetimes, airmasses))
+
+    pipeline = redis_instance.pipeline(transaction=False)
+    for request, resource, site, fingerprints, datetimes, times in samples:
+        # Average the airmasses of every target in the configurations... This could be improved upon
+        airmasses = np.mean([[airmass_by_target_and_site[(fingerprint, site)][sample] for sample in datetimes]
+                             for fingerprint in fingerprints], axis=0)
+        # Now normalize the airmass values between the minimum and maximum airmass so that the weighting
+        # is similar for all requests. This gives something ranging from 0 to AIRMASS_WEIGHTING_COEFFICIENT
+        # to add to the effective priority, where a constant airmass is the best everywhere.
+        best_airmass = airmasses.min()
+        airmass_range = airmasses.max() - best_airmass
+        if airmass_range > 0:
+            weights = float(AIRMASS_WEIGHTING_COEFFICIENT) * (1 - (airmasses - best_airmass) / airmass_range)
+        else:
+            weights = np.full(len(airmasses), float(AIRMASS_WEIGHTING_COEFFICIENT))
+        airmass_at_times = {
+            'airmasses': weights.tolist(),
+            'times': times
+        }
+        pipeline.set(airmass_cache_key(request, resource), json.dumps(airmass_at_times), ex=REDIS_CACHE_TTL)
+    pipeline.execute()
+
+    log.debug('Cached the airmasses of {} from {} airmass series'.format(
+        pl(len(samples), 'request window'), len(airmass_by_target_and_site)))
+    return len(airmass_by_target_and_site)
+
+
 class RequestGroup(EqualityMixin):
     '''RequestGroups are just top-level groups of requests. They contain a set of requests, an operator, proposal info,
        ipp info, an id, and group name. This is translated into a CompoundReservation when scheduling'''
@@ -532,6 +828,7 @@ class RequestGroup(EqualityMixin):
     _many_type = {'many': 'As many as possible of the provided blocks are to be scheduled'}
     valid_types = dict(CompoundReservation.valid_types)
     valid_types.update(_many_type)
+    _eq_exclude = ('_effective_priorities',)
 
     def __init__(self, operator, requests, proposal, rg_id, is_staff, observation_type, ipp_value, name, expires,
                  submitter):
@@ -661,13 +958,19 @@ class RequestGroup(EqualityMixin):
         if request_index < 0 or request_index >= len(self.requests):
             request_index = 0
 
-        # seeded with the request id so it is repeatable with tests
-        random.seed(self.requests[request_index].id)
-        perturbation_size = 0.01
-        ran = (1.0 - perturbation_size / 2.0) + perturbation_size * random.random()
-
         req = self.requests[request_index]
 
+        # The effective priority is memoized for as long as everything it is computed from is unchanged
+        inputs = (req.id, req.get_duration(), self.observation_type, getattr(self.proposal, 'tac_priority', None),
+                  self.ipp_value)
+        memoized = self.__dict__.setdefault('_effective_priorities', {}).get(request_index)
+        if memoized is not None and memoized[0] == inputs:
+            return memoized[1]
+
+        # perturbed by a hash of the request id so it is repeatable with tests, without reseeding the global random
+        perturbation_size = 0.01
+        ran = (1.0 - perturbation_size / 2.0) + perturbation_size * deterministic_fraction(req.id)
+
         if self.observation_type.upper() == 'NORMAL':
             effective_priority = self.get_ipp_modified_priority() * req.get_duration() / 60.0
         elif self.observation_type.upper() == 'TIME_CRITICAL':
@@ -682,6 +985,7 @@ class RequestGroup(EqualityMixin):
                 self.observation_type))
 
         effective_priority = min(effective_priority, 320000.0) * ran
+        self._effective_priorities[request_index] = (inputs, effective_priority)
 
         return effective_priority
 
@@ -697,13 +1001,23 @@ class RequestGroup(EqualityMixin):
 
 class ModelBuilder(object):
 
-    def __init__(self, observation_portal_interface, configdb_interface, proposals_by_id=None, semester_details=None):
+    def __init__(self, observation_portal_interface, configdb_interface, proposals_by_id=None, semester_details=None,
+                 proposal_cache=None):
         self.observation_portal_interface = observation_portal_interface
         self.configdb_interface = configdb_interface
         self.proposals_by_id = proposals_by_id if proposals_by_id else {}
         self.semester_details = semester_details
+        # The epoch microseconds of every window timestamp parsed by this builder, which lasts for one run
+        self._window_epochs = {}
+        # Proposals are looked up in the ProposalCache if there is one, which outlives the builder
+        self.proposal_cache = None
         if not self.proposals_by_id:
-            self._get_all_proposals()
+            if proposal_cache is not None:
+                self.proposal_cache = proposal_cache
+                proposal_cache.refresh(observation_portal_interface)
+                self.proposals_by_id = proposal_cache.proposals_by_id
+            else:
+                self._get_all_proposals()
 
     def _get_all_proposals(self):
         try:
@@ -715,6 +1029,12 @@ class ModelBuilder(object):
             log.warning("failed to retrieve bulk proposals: {}".format(repr(e)))
 
     def get_proposal_details(self, proposal_id):
+        if self.proposal_cache is not None:
+            try:
+                return self.proposal_cache.get(proposal_id, self.observation_portal_interface)
+            except ObservationPortalConnectionError as e:
+                raise RequestError("failed to retrieve proposal {}: {}".format(proposal_id, repr(e)))
+
         if proposal_id not in self.proposals_by_id:
             try:
                 proposal = Proposal(self.observation_portal_interface.get_proposal_by_id(proposal_id))
@@ -724,6 +1044,27 @@ class ModelBuilder(object):
 
         return self.proposals_by_id[proposal_id]
 
+    def send_proposal_cache_metrics(self):
+        if self.proposal_cache is not None:
+            self.proposal_cache.send_metrics()
+
+    def window_epoch(self, timestamp):
+        '''Returns the epoch microseconds of a window's ISO string or datetime start or end.'''
+        if timestamp not in self._window_epochs:
+            try:
+                moment = iso_string_to_datetime(timestamp)
+            except TypeError:
+                moment = timestamp
+            self._window_epochs[timestamp] = datetime_to_epoch_microseconds(moment)
+        return self._window_epochs[timestamp]
+
+    def build_window_bounds(self, window_dicts):
+        '''Returns the read only bounds of a request's windows, shared by every telescope the request can use.'''
+        bounds = np.array([(self.window_epoch(window_dict['start']), self.window_epoch(window_dict['end']))
+                           for window_dict in window_dicts], dtype=np.int64).reshape(-1, 2)
+        bounds.flags.writeable = False
+        return bounds
+
     def get_semester_details(self, date):
         if not self.semester_details:
             try:
@@ -776,9 +1117,10 @@ class ModelBuilder(object):
         # Calculate the maximum window time as the expire time
         max_window_time = datetime(1000, 1, 1)
         for req in requests:
-            for windows in req.windows.windows_for_resource.values():
-                for window in windows:
-                    max_window_time = max(max_window_time, window.end)
+            for resource_name in req.windows.windows_for_resource:
+                windows_end = req.windows.range_at(resource_name)[1]
+                if windows_end is not None:
+                    max_window_time = max(max_window_time, windows_end)
 
         # Truncate the expire time by the current semester's end
         semester_details = self.get_semester_details(datetime.utcnow())
@@ -868,12 +1210,11 @@ class ModelBuilder(object):
             )
             raise RequestError(msg)
 
-        # Create a window for each telescope in the subnetwork
+        # Create a window for each telescope in the subnetwork. The telescopes all share the same windows.
+        window_bounds = self.build_window_bounds(req_dict['windows'])
         windows = Windows()
         for telescope in telescopes:
-            for window_dict in req_dict['windows']:
-                window = Window(window_dict=window_dict, resource=telescope)
-                windows.append(window)
+            windows.set_bounds(telescope, window_bounds)
 
         # Finally, package everything up into the Request
         req = Request(
@@ -909,12 +1250,171 @@ class ModelBuilder(object):
                 msg = "Rise-Set error: {}. Removing from consideration.".format(repr(er))
                 raise RequestError(msg)
 
-        configuration['target'] = target
+        # The json configuration is left as it was, so it identifies the same request group in every cycle
         configuration = Configuration(
-            **configuration
+            **dict(configuration, target=target)
         )
         return configuration
 
 
+class CachedRequestGroup(object):
+    ''' A RequestGroup model kept between scheduling cycles, along with the requests and windows it was built with,
+        which the filters of a cycle remove or replace.
+    '''
+
+    def __init__(self, fingerprint, request_group, invalid_requests):
+        self.fingerprint = fingerprint
+        self.request_group = request_group
+        self.invalid_requests = invalid_requests
+        self.requests = list(request_group.requests)
+        self.windows = [request.windows.copy() for request in self.requests]
+
+    def restore(self, proposal, scheduled_requests):
+        '''Resets the RequestGroup to how it was built, with the current proposal and scheduled reservations.'''
+        self.request_group.requests = list(self.requests)
+        for request, windows in zip(self.requests, self.windows):
+            request.windows = windows.copy()
+            request.scheduled_reservation = scheduled_requests.get(request.id)
+        self.request_group.proposal = proposal
+        return self.request_group, self.invalid_requests
+
+
+class RequestGroupModelCache(object):
+    ''' Keeps the RequestGroup models built in earlier scheduling cycles by request group id, so that only the request
+        groups whose json has changed since are rebuilt. A request group is recognised as unchanged by a fingerprint
+        of its json. Everything is rebuilt when anything else the models are built from changes: the ignore_ipp
+        setting, the active instruments in configdb, or the semester.
+    '''
+
+    def __init__(self):
+        self._entries = {}
+        self._context = None
+        self._seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    def start_cycle(self, context):
+        if context != self._context:
+            self._entries.clear()
+            self._context = context
+        self._seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    def build_request_group(self, model_builder, rg_dict, scheduled_requests=None, ignore_ipp=False):
+        '''Returns the same (request_group, invalid_requests) as ModelBuilder.build_request_group.'''
+        if scheduled_requests is None:
+            scheduled_requests = {}
+        rg_id = int(rg_dict['id'])
+        fingerprint = json_fingerprint(rg_dict)
+        self._seen.add(rg_id)
+        cached = self._entries.get(rg_id)
+        if cached is not None and cached.fingerprint == fingerprint:
+            self.hits += 1
+            return cached.restore(model_builder.get_proposal_details(rg_dict['proposal']), scheduled_requests)
+
+        self.misses += 1
+        self._entries.pop(rg_id, None)
+        request_group, invalid_requests = model_builder.build_request_group(rg_dict, scheduled_requests,
+                                                                            ignore_ipp=ignore_ipp)
+        self._entries[rg_id] = CachedRequestGroup(fingerprint, request_group, invalid_requests)
+        return request_group, invalid_requests
+
+    def finish_cycle(self):
+        '''Forgets the request groups which were not seen this cycle.'''
+        for rg_id in set(self._entries) - self._seen:
+            del self._entries[rg_id]
+
+
+class ProposalCache(SendMetricMixin):
+    ''' Keeps the proposals fetched from the observation portal across scheduling cycles. Every active proposal is
+        fetched in bulk, a page at a time, the first time the cache is refreshed and then again once the last bulk
+        fetch is older than max_age_seconds. Proposals that are unknown, or that were fetched longer ago than that,
+        are fetched one at a time when they are looked up. Each refresh starts a cycle, and proposals fetched during
+        the current cycle are never stale, so a max_age_seconds of 0 fetches everything once per cycle.
+    '''
+
+    def __init__(self, max_age_seconds=3600.0):
+        self.max_age = timedelta(seconds=max_age_seconds)
+        self.proposals_by_id = {}
+        self._fetched_at = {}
+        self._bulk_fetched_at = None
+        self._bulk_ids = set()
+        self._bulk_pages = 0
+        self._cycle_start = None
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.http_calls = 0
+        self.http_calls_avoided = 0
+        self._avoided_ids = set()
+
+    def _is_fresh(self, fetched_at, now):
+        if fetched_at is None:
+            return False
+        return (self._cycle_start is not None and fetched_at >= self._cycle_start) or now - fetched_at < self.max_age
+
+    def refresh(self, observation_portal_interface, now=None):
+        '''Fetches every active proposal in bulk, unless they were last fetched in bulk recently enough.'''
+        now = now or datetime.utcnow()
+        self._cycle_start = now
+        if self._bulk_fetched_at is not None and now - self._bulk_fetched_at < self.max_age:
+            self.http_calls_avoided += self._bulk_pages
+            return
+        try:
+            pages = observation_portal_interface.get_proposal_pages()
+        except ObservationPortalConnectionError as e:
+            self.http_calls += 1
+            log.warning("failed to retrieve bulk proposals: {}".format(repr(e)))
+            return
+        self.http_calls += len(pages)
+        self._bulk_pages = len(pages)
+        self._bulk_fetched_at = now
+        self._bulk_ids = set()
+        for page in pages:
+            for prop in page:
+                proposal = Proposal(prop)
+                self.proposals_by_id[proposal.id] = proposal
+                self._fetched_at[proposal.id] = now
+                self._bulk_ids.add(proposal.id)
+        # Forget stale proposals which are no longer active. They are fetched again if they are looked up.
+        for proposal_id, fetched_at in list(self._fetched_at.items()):
+            if not self._is_fresh(fetched_at, now):
+                del self._fetched_at[proposal_id]
+                del self.proposals_by_id[proposal_id]
+
+    def get(self, proposal_id, observation_portal_interface, now=None):
+        '''Returns the proposal, fetching it by its id if it is unknown or stale. Raises an
+           ObservationPortalConnectionError if it can't be fetched.
+        '''
+        now = now or datetime.utcnow()
+        if self._is_fresh(self._fetched_at.get(proposal_id), now):
+            self.hits += 1
+            # Proposals outside the bulk fetch would otherwise be fetched by id once every cycle
+            if proposal_id not in self._bulk_ids and proposal_id not in self._avoided_ids:
+                self._avoided_ids.add(proposal_id)
+                self.http_calls_avoided += 1
+            return self.proposals_by_id[proposal_id]
+
+        self.misses += 1
+        self.http_calls += 1
+        proposal = Proposal(observation_portal_interface.get_proposal_by_id(proposal_id))
+        self.proposals_by_id[proposal_id] = proposal
+        self._fetched_at[proposal_id] = now
+        return proposal
+
+    def send_metrics(self):
+        '''Sends and logs the lookups served by the cache and the HTTP calls made since this was last called.'''
+        log.info("Made {} to the observation portal for proposals, and avoided {}. {} served from the cache".format(
+            pl(self.http_calls, 'HTTP call'), self.http_calls_avoided, pl(self.hits, 'proposal lookup')))
+        self.send_metric('proposal_cache.hits', self.hits)
+        self.send_metric('proposal_cache.misses', self.misses)
+        self.send_metric('proposal_cache.http_calls', self.http_calls)
+        self.send_metric('proposal_cache.http_calls_avoided', self.http_calls_avoided)
+        self._reset_counters()
+
+
 class RequestError(Exception):
     pass
@@ -3,10 +3,15 @@ from adaptive_scheduler.utils import timeit, metric_timer, SendMetricMixin
 import logging
 import requests
 import os
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from dateutil.parser import parse
 from requests.exceptions import RequestException, Timeout
 
+# The number of proposals requested in each page of the bulk proposals API, and how many pages are fetched at once
+PROPOSALS_PAGE_SIZE = int(os.getenv('PROPOSALS_PAGE_SIZE', 1000))
+PROPOSALS_FETCH_THREADS = int(os.getenv('PROPOSALS_FETCH_THREADS', 4))
+
 
 class ObservationPortalConnectionError(Exception):
     pass
@@ -19,16 +24,34 @@ class ObservationPortalInterface(SendMetricMixin):
         self.log = logging.getLogger(__name__)
         self.headers = {'Authorization': 'Token ' + os.getenv("OBSERVATION_PORTAL_API_TOKEN", '')}
         self.current_semester_details = None
+        self.next_semester_details = None
 
     def get_proposals(self):
         ''' Returns all active proposals using the bulk proposals API of the observation portal
         '''
+        return [proposal for page in self.get_proposal_pages() for proposal in page]
+
+    def get_proposal_pages(self):
+        ''' Returns the pages of active proposals from the bulk proposals API of the observation portal. The first
+            page gives the number of active proposals, then the rest of the pages are fetched concurrently.
+        '''
+        first_page = self._get_proposal_page(0)
+        page_size = len(first_page['results'])
+        offsets = list(range(page_size, first_page.get('count', page_size), page_size)) if page_size else []
+        pages = [first_page['results']]
+        if offsets:
+            with ThreadPoolExecutor(max_workers=max(1, min(PROPOSALS_FETCH_THREADS, len(offsets)))) as executor:
+                pages.extend(page['results'] for page in executor.map(self._get_proposal_page, offsets))
+        return pages
+
+    def _get_proposal_page(self, offset):
         try:
-            response = requests.get(self.obs_portal_url + '/api/proposals/?active=True&limit=1000',
+            response = requests.get(self.obs_portal_url + '/api/proposals/',
+                                    params={'active': True, 'limit': PROPOSALS_PAGE_SIZE, 'offset': offset},
                                     headers=self.headers,
                                     timeout=120)
             response.raise_for_status()
-            return response.json()['results']
+            return response.json()
         except (RequestException, ValueError, Timeout) as e:
             raise ObservationPortalConnectionError("failed to retrieve bulk proposals: {}".format(repr(e)))
 
@@ -51,19 +74,31 @@ class ObservationPortalInterface(SendMetricMixin):
                 not self.current_semester_details
                 or self.current_semester_details['start'] > date
                 or self.current_semester_details['end'] < date):
-            try:
-                response = requests.get(self.obs_portal_url + '/api/semesters/' +
-                                        '?semester_contains={}'.format(date.isoformat()), headers=self.headers,
-                                        timeout=15)
-                response.raise_for_status()
-                self.current_semester_details = response.json()['results'][0]
-                self.current_semester_details['start'] = parse(self.current_semester_details['start'], ignoretz=True)
-                self.current_semester_details['end'] = parse(self.current_semester_details['end'], ignoretz=True)
-            except (RequestException, ValueError, Timeout) as e:
-                raise ObservationPortalConnectionError(
-                    "failed to retrieve semester info for date {}: {}".format(date, repr(e)))
+            self.current_semester_details = self._fetch_semester_details(date)
         return self.current_semester_details
 
+    def get_next_semester_details(self, semester_details):
+        ''' Return the details of the semester following semester_details, without replacing the cached details of
+            the current semester.
+        '''
+        if not self.next_semester_details or self.next_semester_details['start'] < semester_details['end']:
+            self.next_semester_details = self._fetch_semester_details(semester_details['end'] + timedelta(seconds=1))
+        return self.next_semester_details
+
+    def _fetch_semester_details(self, date):
+        try:
+            response = requests.get(self.obs_portal_url + '/api/semesters/' +
+                                    '?semester_contains={}'.format(date.isoformat()), headers=self.headers,
+                                    timeout=15)
+            response.raise_for_status()
+            semester_details = response.json()['results'][0]
+            semester_details['start'] = parse(semester_details['start'], ignoretz=True)
+            semester_details['end'] = parse(semester_details['end'], ignoretz=True)
+        except (RequestException, ValueError, Timeout, IndexError) as e:
+            raise ObservationPortalConnectionError(
+                "failed to retrieve semester info for date {}: {}".format(date, repr(e)))
+        return semester_details
+
     @timeit
     @metric_timer('requestdb.get_last_changed')
     def get_last_changed(self, telescope_classes=None):
@@ -0,0 +1,166 @@
+'''
+parallel_visibility.py - Intersects request windows with cached rise_set intervals in worker processes.
+
+Once the rise_set intervals of every target are cached, each request's user windows still have to be
+intersected with the intervals of each of its configurations on each resource, and have the downtime
+and seeing blocked intervals removed. This scales with requests x configurations x resources, and the
+time_intervals Intervals deep copy their timepoints on every operation.
+
+Here every cached interval needed for the run is published once into a single shared memory block, as
+rows of (start, end) microseconds since the epoch. The requests are split into chunks which only refer
+to rows of that block, plus their own user windows, and each worker process returns the resulting
+(start, end) arrays for each request. The array operations reproduce the time_intervals semantics
+exactly, so the windows match those found by the serial path.
+'''
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from adaptive_scheduler.models import Windows
+
+log = logging.getLogger(__name__)
+
+# Number of requests sent to a worker process in each task
+CHUNK_SIZE = 250
+
+# Shared memory blocks which have been attached to in this worker process, by name
+_worker_blocks = {}
+
+
+def datetimes_to_bounds(intervals):
+    '''Converts a list of (start, end) datetime tuples into an (intervals x 2) int64 array of epoch microseconds.'''
+    if not intervals:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.array(intervals, dtype='datetime64[us]').astype(np.int64).reshape(-1, 2)
+
+
+def bounds_to_datetimes(bounds):
+    '''Converts an (intervals x 2) array of epoch microseconds into a list of (start, end) datetime tuples.'''
+    return [tuple(interval) for interval in bounds.astype('datetime64[us]').tolist()]
+
+
+def _join_touching(bounds):
+    '''Drops empty intervals and joins intervals where one ends at the same time as the next starts.'''
+    bounds = bounds[bounds[:, 1] > bounds[:, 0]]
+    if len(bounds) < 2:
+        return bounds
+    first = np.concatenate(([True], bounds[1:, 0] != bounds[:-1, 1]))
+    last = np.concatenate((first[1:], [True]))
+    return np.column_stack((bounds[first, 0], bounds[last, 1]))
+
+
+def _sweep(bounds_list, weights, level_is_inside):
+    ''' Walks the starts and ends of every interval in time order, ends before starts at the same time, adding
+        each interval's weight at its start and removing it at its end. Returns the intervals over which
+        level_is_inside(level) holds.
+    '''
+    starts = np.concatenate([bounds[:, 0] for bounds in bounds_list])
+    ends = np.concatenate([bounds[:, 1] for bounds in bounds_list])
+    interval_weights = np.concatenate([np.full(len(bounds), weight, dtype=np.int64)
+                                       for bounds, weight in zip(bounds_list, weights)])
+    times = np.concatenate((ends, starts))
+    is_start = np.concatenate((np.zeros(len(ends), dtype=np.int8), np.ones(len(starts), dtype=np.int8)))
+    order = np.lexsort((is_start, times))
+    levels = np.cumsum(np.concatenate((-interval_weights, interval_weights))[order])
+    inside = level_is_inside(levels)
+    was_inside = np.concatenate(([False], inside[:-1]))
+    times = times[order]
+    return _join_touching(np.column_stack((times[inside & ~was_inside], times[was_inside & ~inside])))
+
+
+def normalize_bounds(bounds):
+    '''Sorts and merges overlapping and touching intervals, like constructing an Intervals does.'''
+    if len(bounds) == 0:
+        return bounds
+    return _sweep([bounds], [1], lambda levels: levels >= 1)
+
+
+def intersect_bounds(bounds_list):
+    '''Intersects normalized interval arrays, like Intervals.intersect does.'''
+    if any(len(bounds) == 0 for bounds in bounds_list):
+        return np.empty((0, 2), dtype=np.int64)
+    if len(bounds_list) == 1:
+        return bounds_list[0]
+    return _sweep(bounds_list, [1] * len(bounds_list), lambda levels: levels == len(bounds_list))
+
+
+def subtract_bounds(bounds, other):
+    '''Removes the normalized intervals in other from the normalized intervals in bounds, like Intervals.subtract.'''
+    if len(bounds) == 0 or len(other) == 0:
+        return bounds
+    return _sweep([bounds, other], [2, 1], lambda levels: levels == 2)
+
+
+class SharedIntervals(object):
+    ''' Collects kernel Intervals under keys, and publishes them all as rows of a single shared memory array.
+        Each key is given a (first row, last row) slot, which workers use to find its intervals.
+    '''
+
+    def __init__(self):
+        self._bounds = []
+        self._slots = {}
+        self._rows = 0
+        self._block = None
+
+    def add(self, key, intervals):
+        '''Adds the intervals under key, if they have not been added already, and returns the slot for key.'''
+        if key not in self._slots:
+            bounds = datetimes_to_bounds(intervals.toTupleList())
+            self._slots[key] = (self._rows, self._rows + len(bounds))
+            self._bounds.append(bounds)
+            self._rows += len(bounds)
+        return self._slots[key]
+
+    def publish(self):
+        '''Copies every added interval into a new shared memory block, and returns the block name and row count.'''
+        self._block = shared_memory.SharedMemory(create=True, size=max(self._rows, 1) * 2 * 8)
+        shared = np.ndarray((self._rows, 2), dtype=np.int64, buffer=self._block.buf)
+        if self._bounds:
+            shared[:] = np.concatenate(self._bounds)
+        return self._block.name, self._rows
+
+    def close(self):
+        if self._block is not None:
+            self._block.close()
+            self._block.unlink()
+            self._block = None
+
+
+def _attach_shared_intervals(name, rows):
+    if name not in _worker_blocks:
+        # Only the block for the current run is needed, so detach from any earlier ones
+        for block in _worker_blocks.values():
+            block.close()
+        _worker_blocks.clear()
+        _worker_blocks[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray((rows, 2), dtype=np.int64, buffer=_worker_blocks[name].buf)
+
+
+def intersect_windows_in_worker(chunk):
+    ''' Finds the available windows for a chunk of requests in a worker process. The chunk is a tuple of the
+        shared memory block name, its row count and a list of (request index, resource tasks), where each resource
+        task is a tuple of (resource, target interval slots, user window bounds, blocked interval slot). Returns a
+        list of (request index, {resource: window bounds}).
+    '''
+    name, rows, request_tasks = chunk
+    shared = _attach_shared_intervals(name, rows)
+    results = []
+    for request_index, resource_tasks in request_tasks:
+        bounds_by_resource = {}
+        for resource, target_slots, user_bounds, blocked_slot in resource_tasks:
+            bounds_list = [shared[first:last] for first, last in target_slots]
+            bounds_list.append(normalize_bounds(user_bounds))
+            available = intersect_bounds(bounds_list)
+            bounds_by_resource[resource] = subtract_bounds(available, shared[blocked_slot[0]:blocked_slot[1]])
+        results.append((request_index, bounds_by_resource))
+    return results
+
+
+def bounds_to_windows(request, bounds_by_resource):
+    '''Builds the request's new Windows from the window bounds found on each resource, like intervals_to_windows.'''
+    windows = Windows()
+    for resource_name, bounds in bounds_by_resource.items():
+        if len(request.windows.bounds_at(resource_name)) > 0 and len(bounds) > 0:
+            windows.set_bounds(resource_name, bounds)
+    return windows
@@ -0,0 +1,160 @@
+'''
+Precompute the rise_set intervals of every schedulable target, outside of the scheduler.
+
+Building the rise_set cache for a whole target catalogue, when a site is added or a semester
+starts, would otherwise take the first scheduling runs most of a day. This takes a snapshot of
+the schedulable request groups from the observation portal, or from a scheduler input pickle,
+and computes the rise_set intervals of each distinct target, resource and constraint
+combination over the semester, saving them into the redis cache where the scheduler finds them.
+Intervals that are already cached are skipped, so an interrupted run can just be restarted.
+
+The work can be split across machines with --shard i/n. Each combination belongs to exactly
+one shard, chosen by a hash of its cache key, so n machines sharing a redis given the shards
+1/n to n/n compute every combination once between them.
+'''
+from __future__ import division
+
+from adaptive_scheduler.configdb_connections import ConfigDBInterface
+from adaptive_scheduler.kernel_mappings import semester_cache_name, RISE_SET_TARGET_TIMEOUT
+from adaptive_scheduler.models import ModelBuilder
+from adaptive_scheduler.observation_portal_connections import ObservationPortalInterface
+from adaptive_scheduler.rise_set_pool import init_worker
+from adaptive_scheduler.rise_set_prefetch import get_prefetch_tasks, group_prefetch_tasks, prefetch_rise_sets_in_worker
+from adaptive_scheduler.scheduler_input import SchedulerParameters, SchedulingInputUtils, \
+    FileBasedSchedulingInputProvider
+
+from lcogt_logging import LCOGTFormatter
+from multiprocessing import cpu_count, get_context
+from datetime import datetime
+from dateutil.parser import parse
+
+import argparse
+import hashlib
+import logging
+import sys
+
+log = logging.getLogger('adaptive_scheduler')
+
+
+def parse_shard(value):
+    '''Parses a shard given as i/n, for the i-th of n shards counting from 1, into a (index, count) tuple.'''
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be given as i/n, for example 2/4, not '{}'".format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard {} must be between 1 and {}".format(index, count))
+    return index, count
+
+
+def in_shard(cache_key, shard):
+    '''Returns True if the cache key belongs to the shard. The hash does not vary between processes or machines.'''
+    index, count = shard
+    return int(hashlib.sha1(cache_key.encode('utf-8')).hexdigest(), 16) % count == index - 1
+
+
+def parse_args(argv):
+    defaults = SchedulerParameters()
+    arg_parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+
+    arg_parser.add_argument("-p", "--observation_portal_url", type=str, dest='observation_portal_url',
+                            help="Observation Portal base URL", default=defaults.observation_portal_url)
+    arg_parser.add_argument("-c", "--configdb_url", type=str, dest='configdb_url', default=defaults.configdb_url,
+                            help="ConfigDB endpoint URL")
+    arg_parser.add_argument("-f", "--fromfile", type=str, dest='input_file_name', default=defaults.input_file_name,
+                            help="Scheduler input pickle to take the request groups from, instead of the "
+                                 "Observation Portal. Example: -f scheduling_input_20180101.pickle")
+    arg_parser.add_argument("-n", "--now", type=str, dest='simulate_now',
+                            help="A time within the semester to precompute, if not the current one (in isoformat: "
+                                 "%%Y-%%m-%%dT%%H:%%M:%%SZ)")
+    arg_parser.add_argument("--telescope_classes", type=str, default=','.join(defaults.telescope_classes),
+                            help="Only precompute the request groups of the specified telescope_classes (comma "
+                                 "delimited). If not specified, default is all classes.")
+    arg_parser.add_argument("--shard", type=parse_shard, default=(1, 1),
+                            help="Only precompute the i-th of n shards of the targets, given as i/n. Default is 1/1")
+    arg_parser.add_argument("--processes", type=int, default=defaults.rise_set_pool_processes,
+                            help="Number of rise-set worker processes. 0 means one less than the number of CPUs")
+    arg_parser.add_argument("--ignore_ipp", type=bool, dest='ignore_ipp', default=defaults.ignore_ipp,
+                            help="Ignore intra-proposal priority when building the request groups")
+
+    args = arg_parser.parse_args(argv)
+    args.telescope_classes = [tc.strip() for tc in args.telescope_classes.split(',') if tc.strip()]
+    return args
+
+
+def get_json_request_groups(args, observation_portal_interface):
+    ''' Returns the json request groups, proposals and semester details to precompute, from the input pickle if one
+        was given, or else from the Observation Portal.
+    '''
+    now = parse(args.simulate_now).replace(tzinfo=None) if args.simulate_now else datetime.utcnow()
+    if args.input_file_name:
+        pickle_input = FileBasedSchedulingInputProvider._get_pickled_input(args.input_file_name)
+        semester_details = pickle_input.get('semester_details')
+        if semester_details is None:
+            semester_details = observation_portal_interface.get_semester_details(now)
+        return (pickle_input['json_request_group_list'], pickle_input.get('proposals_by_id', {}),
+                semester_details)
+    semester_details = observation_portal_interface.get_semester_details(now)
+    json_rgs = observation_portal_interface.get_all_request_groups(semester_details['start'],
+                                                                   semester_details['end'], args.telescope_classes)
+    return json_rgs, {}, semester_details
+
+
+def precompute_rise_sets(request_groups, telescopes, semester_start, semester_end, shard=(1, 1), processes=0):
+    ''' Computes the rise_set intervals of every distinct target, resource and constraint combination in the
+        request groups that belongs to the shard and is not already cached, and saves them into redis. Returns the
+        number of intervals saved and the number computed.
+    '''
+    semester_name = semester_cache_name(semester_start, semester_end)
+    tasks = [task for task in get_prefetch_tasks(request_groups, semester_name) if in_shard(task[1][0], shard)]
+    if not tasks:
+        log.info('Every rise set in shard {}/{} is already cached'.format(*shard))
+        return 0, 0
+    processes = processes if processes > 0 else max(cpu_count() - 1, 1)
+    log.info('Computing {} rise sets in shard {}/{} with {} processes'.format(len(tasks), shard[0], shard[1],
+                                                                              processes))
+    work_items = group_prefetch_tasks(tasks)
+    saved = 0
+    with get_context('spawn').Pool(processes=processes, initializer=init_worker,
+                                   initargs=(telescopes, semester_start, semester_end,
+                                             RISE_SET_TARGET_TIMEOUT)) as pool:
+        for count, saved_in_item in enumerate(pool.imap_unordered(prefetch_rise_sets_in_worker, work_items),
+                                              start=1):
+            saved += saved_in_item
+            if count % 1000 == 0:
+                log.info('Computed {} of {} rise set work items'.format(count, len(work_items)))
+    log.info('Saved {} of {} rise sets into redis'.format(saved, len(tasks)))
+    return saved, len(tasks)
+
+
+def setup_logging():
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    sh = logging.StreamHandler()
+    sh.setFormatter(LCOGTFormatter())
+    log.addHandler(sh)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging()
+
+    observation_portal_interface = ObservationPortalInterface(args.observation_portal_url)
+    configdb_interface = ConfigDBInterface(configdb_url=args.configdb_url, telescope_classes=args.telescope_classes)
+    json_rgs, proposals_by_id, semester_details = get_json_request_groups(args, observation_portal_interface)
+    model_builder = ModelBuilder(observation_portal_interface, configdb_interface, proposals_by_id=proposals_by_id,
+                                 semester_details=semester_details)
+    request_groups = SchedulingInputUtils(model_builder).json_rgs_to_scheduler_model_rgs(
+        json_rgs, ignore_ipp=args.ignore_ipp)[0]
+    log.info('Precomputing the rise sets of {} request groups for the semester {}'.format(
+        len(request_groups), semester_details['id']))
+    saved, computed = precompute_rise_sets(request_groups, configdb_interface.get_telescope_info(),
+                                           semester_details['start'], semester_details['end'], args.shard,
+                                           args.processes)
+    return 0 if saved == computed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
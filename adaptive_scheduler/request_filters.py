@@ -46,7 +46,9 @@ The remaining filters operate on RGs themselves:
          remain) are filtered out
 
 The convenience method run_all_filters() executes all the filters in the correct
-order.
+order. It runs the window filters on a WindowTable, which holds every window of
+the RGs as a row of numpy columns, so each filter is a mask or clip over all the
+windows at once. The surviving windows are written back to the Requests at the end.
 
 Authors: Eric Saunders, Martin Norbury
 February 2013
@@ -54,8 +56,11 @@ February 2013
 
 from datetime import datetime, timedelta
 from adaptive_scheduler.log import RequestGroupLogger
+from adaptive_scheduler.models import RGCollection
+from adaptive_scheduler.utils import datetime_to_epoch_microseconds
 
 import logging
+import numpy as np
 
 log = logging.getLogger(__name__)
 
@@ -105,10 +110,7 @@ def filter_rgs(rg_list, running_request_ids):
     # Don't use sets here, unless you like non-deterministic orderings
     # The solve may be sensitive to order, so don't mess with it
     schedulable_rgs = run_all_filters(rg_list, running_request_ids)
-    unschedulable_rgs = []
-    for rg in rg_list:
-        if rg not in schedulable_rgs:
-            unschedulable_rgs.append(rg)
+    unschedulable_rgs = list(RGCollection(rg_list).difference(schedulable_rgs))
 
     return schedulable_rgs, unschedulable_rgs
 
@@ -128,131 +130,221 @@ def set_now(user_now):
 def run_all_filters(rg_list, running_request_ids):
     '''Execute all the filters, in the correct order. Windows may be discarded or
        truncated during this process. Unschedulable Request Groups are discarded.'''
-    rg_list = filter_out_windows_for_running_requests(rg_list, running_request_ids)
+    window_table = WindowTable(rg_list)
+    window_table.filter_out_windows_for_running_requests(running_request_ids)
     rg_list = filter_on_pending(rg_list)
     rg_list = filter_on_expiry(rg_list)
-    rg_list = filter_out_past_windows(rg_list)
-    rg_list = truncate_lower_crossing_windows(rg_list)
-    rg_list = truncate_upper_crossing_windows(rg_list)
-    rg_list = filter_out_future_windows(rg_list)
-    rg_list = filter_on_duration(rg_list)
+    window_table.keep_requests_of(rg_list)
+    window_table.filter_out_past_windows(now)
+    window_table.truncate_lower_crossing_windows(now)
+    window_table.truncate_upper_crossing_windows()
+    window_table.filter_out_future_windows()
+    window_table.filter_on_duration()
+    window_table.write_back()
     rg_list = filter_on_type(rg_list, running_request_ids)
 
     return rg_list
 
 
-@log_windows
-def filter_out_windows_for_running_requests(rg_list, running_request_ids):
-    '''Case 1: Remove windows for requests that are already running'''
+def _duration_timedelta(duration):
+    # Transparently handle either float (in seconds) or datetime durations
+    try:
+        return timedelta(seconds=duration)
+    except TypeError:
+        return duration
+
+
+# The feedback of the window filters, formatted with the Request id, the resource name, the window's start and end,
+# and then the detail of the filter
+REQUEST_IS_RUNNING_MSG = 'Request %d Window (at %s) %s -> %s removed because request is currently running'
+WINDOW_IN_PAST_MSG = 'Request %d Window (at %s) %s -> %s falls before %s'
+WINDOW_TRUNCATED_MSG = 'Request %d Window (at %s) %s -> %s truncated to %s'
+WINDOW_BEYOND_HORIZON_MSG = 'Request %d Window (at %s) %s -> %s starts after the scheduling horizon (%s)'
+WINDOW_TOO_SMALL_MSG = "Request %d Window (at %s) %s -> %s too small for duration '%s'"
+
+# The effective horizon of a RequestGroup without an expiry
+_NO_HORIZON = np.iinfo(np.int64).max
+
+
+class WindowTable(object):
+    ''' The windows of every Request of a list of RequestGroups, as columns with a row for each window: the index of
+        its Request, its resource name and its start and end in epoch microseconds. The expiry and duration of each
+        Request are columns too, taken once when the table is built. The window filters are masks and clips over every
+        row at once, which run_all_filters runs on one table and the module level filters of the same name each run on
+        their own. Nothing changes in the Requests until write_back is called.
+    '''
+
+    def __init__(self, rg_list):
+        # The RequestGroup and Request of each request index
+        self.requests = []
+        # The (request index, resource name, first row, end row) of the windows of each Request on each resource
+        self.segments = []
+        request_indices = []
+        bounds = []
+        rows = 0
+        for rg in rg_list:
+            for request in rg.requests:
+                request_index = len(self.requests)
+                self.requests.append((rg, request))
+                for resource_name in request.windows.windows_for_resource:
+                    resource_bounds = request.windows.bounds_at(resource_name)
+                    self.segments.append((request_index, resource_name, rows, rows + len(resource_bounds)))
+                    rows += len(resource_bounds)
+                    bounds.append(resource_bounds)
+                    request_indices.append(np.full(len(resource_bounds), request_index, dtype=np.int64))
+
+        self.request_index = np.concatenate(request_indices) if request_indices else np.empty(0, dtype=np.int64)
+        all_bounds = np.concatenate(bounds) if bounds else np.empty((0, 2), dtype=np.int64)
+        self.start = all_bounds[:, 0].copy()
+        self.end = all_bounds[:, 1].copy()
+        self.keep = np.ones(rows, dtype=bool)
+        self.active_requests = np.ones(len(self.requests), dtype=bool)
+        self.expires = np.array([_NO_HORIZON if rg.expires is None else datetime_to_epoch_microseconds(rg.expires)
+                                 for rg, _ in self.requests], dtype=np.int64)[self.request_index]
+        self.durations = np.array([_duration_timedelta(request.duration) // timedelta(microseconds=1)
+                                   for _, request in self.requests], dtype=np.int64)[self.request_index]
+        self._resource_name_column = None
+
+    def n_windows(self):
+        return int(np.count_nonzero(self.keep))
+
+    def _resource_names(self):
+        if self._resource_name_column is None:
+            self._resource_name_column = np.empty(len(self.keep), dtype=object)
+            for _, resource_name, first_row, end_row in self.segments:
+                self._resource_name_column[first_row:end_row] = resource_name
+        return self._resource_name_column
+
+    def _horizons(self, horizon=None):
+        '''Returns a column of the effective horizon of each row: its RequestGroup's expiry, or horizon if earlier.'''
+        if not horizon:
+            return self.expires
+        return np.minimum(self.expires, datetime_to_epoch_microseconds(horizon))
+
+    def _emit_feedback(self, rows, tag, msg, details):
+        ''' Emits the feedback msg on each row's RequestGroup, formatted with the row's Request id, resource name,
+            start and end, and then its tuple in details. Every row's fields are gathered at once before formatting.
+        '''
+        if len(rows) == 0:
+            return
+        timestamp = datetime.utcnow()
+        starts = self.start[rows].astype('datetime64[us]').tolist()
+        ends = self.end[rows].astype('datetime64[us]').tolist()
+        resource_names = self._resource_names()[rows].tolist()
+        for request_index, resource_name, start, end, detail in zip(self.request_index[rows].tolist(),
+                                                                    resource_names, starts, ends, details):
+            rg, request = self.requests[request_index]
+            rg.emit_rg_feedback(msg % ((request.id, resource_name, start, end) + detail), tag, timestamp)
+
+    def _drop(self, name, to_drop, tag, msg, details_fn):
+        n_windows_before = self.n_windows()
+        dropped = np.flatnonzero(self.keep & to_drop)
+        self._emit_feedback(dropped, tag, msg, details_fn(dropped))
+        self.keep[dropped] = False
+        log.info("%s: windows in (%d); windows out (%d)", name, n_windows_before, self.n_windows())
+
+    def _log_unchanged(self, name):
+        log.info("%s: windows in (%d); windows out (%d)", name, self.n_windows(), self.n_windows())
+
+    def keep_requests_of(self, rg_list):
+        '''Ignores the windows of the Requests no longer in rg_list. They are neither filtered nor written back.'''
+        remaining = {id(request) for rg in rg_list for request in rg.requests}
+        self.active_requests = np.array([id(request) in remaining for _, request in self.requests], dtype=bool)
+        self.keep &= self.active_requests[self.request_index]
+
+    def filter_out_windows_for_running_requests(self, running_request_ids):
+        '''Case 1: Remove windows for requests that are already running'''
+        running = np.array([request.id in running_request_ids for _, request in self.requests],
+                           dtype=bool)[self.request_index]
+        self._drop('filter_out_windows_for_running_requests', running, 'RequestIsRunning', REQUEST_IS_RUNNING_MSG,
+                   lambda rows: [()] * len(rows))
+
+    def filter_out_past_windows(self, now):
+        '''Case 2: The window exists entirely in the past.'''
+        now_epoch = datetime_to_epoch_microseconds(now)
+        self._drop('filter_out_past_windows', self.end <= now_epoch, 'WindowInPast', WINDOW_IN_PAST_MSG,
+                   lambda rows: [(now,)] * len(rows))
+
+    def truncate_lower_crossing_windows(self, now):
+        '''Case 3: The window starts in the past, but finishes at a
+           schedulable time. Remove the unschedulable portion of the window.'''
+        now_epoch = datetime_to_epoch_microseconds(now)
+        crossing = np.flatnonzero(self.keep & (self.start < now_epoch) & (now_epoch < self.end))
+        self._emit_feedback(crossing, 'WindowTruncatedLower', WINDOW_TRUNCATED_MSG, [(now,)] * len(crossing))
+        self.start[crossing] = now_epoch
+        self._log_unchanged('truncate_lower_crossing_windows')
+
+    def truncate_upper_crossing_windows(self, horizon=None):
+        '''Case 4: The window starts at a schedulable time, but finishes beyond the
+           scheduling horizon (provided, or semester end, or expiry date). Remove the
+           unschedulable portion of the window.'''
+        horizons = self._horizons(horizon)
+        crossing = np.flatnonzero(self.keep & (self.start < horizons) & (horizons < self.end))
+        self._emit_feedback(crossing, 'WindowTruncatedUpper', WINDOW_TRUNCATED_MSG,
+                            [(horizon,) for horizon in horizons[crossing].astype('datetime64[us]').tolist()])
+        self.end[crossing] = horizons[crossing]
+        self._log_unchanged('truncate_upper_crossing_windows')
+
+    def filter_out_future_windows(self, horizon=None):
+        '''Case 5: The window lies beyond the scheduling horizon.'''
+        horizons = self._horizons(horizon)
+        self._drop('filter_out_future_windows', self.start >= horizons, 'WindowBeyondHorizon',
+                   WINDOW_BEYOND_HORIZON_MSG,
+                   lambda rows: [(horizon,) for horizon in horizons[rows].astype('datetime64[us]').tolist()])
+
+    def filter_on_duration(self):
+        '''Case 6: Keep only windows which are larger than their Request's duration.'''
+        self._drop('filter_on_duration', self.end - self.start <= self.durations, 'WindowTooSmall',
+                   WINDOW_TOO_SMALL_MSG,
+                   lambda rows: [(timedelta(microseconds=duration),) for duration in self.durations[rows].tolist()])
+
+    def write_back(self):
+        '''Replaces the windows of each remaining Request with its surviving rows.'''
+        for request_index, resource_name, first_row, end_row in self.segments:
+            if not self.active_requests[request_index]:
+                continue
+            keep = self.keep[first_row:end_row]
+            self.requests[request_index][1].windows.set_bounds(
+                resource_name, np.column_stack((self.start[first_row:end_row][keep], self.end[first_row:end_row][keep])))
+
+
+def _filter_windows(rg_list, filter_fn):
+    '''Runs one WindowTable filter over the windows of rg_list, and writes the surviving windows back.'''
+    window_table = WindowTable(rg_list)
+    filter_fn(window_table)
+    window_table.write_back()
+    return rg_list
 
-    def filter_test(w, rg, r):
-        if r.id in running_request_ids:
-            tag = 'RequestIsRunning'
-            msg = 'Request %d Window (at %s) %s -> %s removed because request is currently running' % (
-            r.id, w.get_resource_name(),
-            w.start, w.end)
-            rg.emit_rg_feedback(msg, tag)
-            return False
-        else:
-            return True
 
-    return _for_all_rg_windows(rg_list, filter_test)
+def filter_out_windows_for_running_requests(rg_list, running_request_ids):
+    '''Case 1: Remove windows for requests that are already running'''
+    return _filter_windows(rg_list, lambda window_table:
+                           window_table.filter_out_windows_for_running_requests(running_request_ids))
 
 
 # A) Window Filters
 # ------------------
-@log_windows
 def filter_out_past_windows(rg_list):
     '''Case 2: The window exists entirely in the past.'''
+    return _filter_windows(rg_list, lambda window_table: window_table.filter_out_past_windows(now))
 
-    def filter_test(w, rg, r):
-        if w.end > now:
-            return True
-        else:
-            tag = 'WindowInPast'
-            msg = 'Request %d Window (at %s) %s -> %s falls before %s' % (r.id, w.get_resource_name(),
-                                                                          w.start, w.end, now)
-            rg.emit_rg_feedback(msg, tag)
-            return False
-
-    return _for_all_rg_windows(rg_list, filter_test)
 
-
-@log_windows
 def truncate_lower_crossing_windows(rg_list):
     '''Case 3: The window starts in the past, but finishes at a
        schedulable time. Remove the unschedulable portion of the window.'''
+    return _filter_windows(rg_list, lambda window_table: window_table.truncate_lower_crossing_windows(now))
 
-    def truncate_lower_crossing(w, rg, r):
-        if w.start < now < w.end:
-            tag = 'WindowTruncatedLower'
-            msg = 'Request %d Window (at %s) %s -> %s truncated to %s' % (r.id, w.get_resource_name(),
-                                                                          w.start, w.end, now)
-            rg.emit_rg_feedback(msg, tag)
-            w.start = now
-
-        return True
-
-    filter_test = truncate_lower_crossing
 
-    return _for_all_rg_windows(rg_list, filter_test)
-
-
-@log_windows
 def truncate_upper_crossing_windows(rg_list, horizon=None):
     '''Case 4: The window starts at a schedulable time, but finishes beyond the
        scheduling horizon (provided, or semester end, or expiry date). Remove the
        unschedulable portion of the window.'''
+    return _filter_windows(rg_list, lambda window_table: window_table.truncate_upper_crossing_windows(horizon))
 
-    global now
-
-    def truncate_upper_crossing(w, rg, r):
-        effective_horizon = rg.expires
-        if horizon:
-            if horizon < effective_horizon:
-                effective_horizon = horizon
-        if w.start < effective_horizon < w.end:
-            tag = 'WindowTruncatedUpper'
-            msg = 'Request %d Window (at %s) %s -> %s truncated to %s' % (r.id, w.get_resource_name(),
-                                                                          w.start, w.end, effective_horizon)
-            rg.emit_rg_feedback(msg, tag)
-            w.end = effective_horizon
 
-        return True
-
-    filter_test = truncate_upper_crossing
-
-    return _for_all_rg_windows(rg_list, filter_test)
-
-
-@log_windows
 def filter_out_future_windows(rg_list, horizon=None):
     '''Case 5: The window lies beyond the scheduling horizon.'''
-
-    global now
-
-    def filter_on_future(w, rg, r):
-        effective_horizon = rg.expires
-        if horizon:
-            if horizon < effective_horizon:
-                effective_horizon = horizon
-
-        if w.start < effective_horizon:
-            return True
-        else:
-            tag = 'WindowBeyondHorizon'
-            msg = 'Request %d Window (at %s) %s -> %s starts after the scheduling horizon (%s)' % (
-                r.id,
-                w.get_resource_name(),
-                w.start,
-                w.end,
-                effective_horizon)
-            rg.emit_rg_feedback(msg, tag)
-            return False
-
-    filter_test = filter_on_future
-
-    return _for_all_rg_windows(rg_list, filter_test)
+    return _filter_windows(rg_list, lambda window_table: window_table.filter_out_future_windows(horizon))
 
 
 @log_windows
@@ -260,19 +352,13 @@ def filter_on_duration(rg_list, filter_executor=_for_all_rg_windows):
     '''Case 6: Return only windows which are larger than the RG's child R durations.'''
 
     def filter_on_duration(w, rg, r):
-        # Transparently handle either float (in seconds) or datetime durations
-        try:
-            duration = timedelta(seconds=r.duration)
-        except TypeError:
-            duration = r.duration
+        duration = _duration_timedelta(r.duration)
 
         if w.end - w.start > duration:
             return True
         else:
             tag = 'WindowTooSmall'
-            msg = "Request %d Window (at %s) %s -> %s too small for duration '%s'" % (r.id,
-                                                                                      w.get_resource_name(),
-                                                                                      w.start, w.end, duration)
+            msg = WINDOW_TOO_SMALL_MSG % (r.id, w.get_resource_name(), w.start, w.end, duration)
             rg.emit_rg_feedback(msg, tag)
             return False
 
@@ -0,0 +1,165 @@
+'''
+rise_set_cache.py - A persistent, on-disk cache of rise_set visibility intervals.
+
+The rise_set intervals for a (target, resource, constraints) combination are valid for
+a whole semester, but are expensive to compute. Redis and the in process cache are both
+lost on restart or flush, so this module provides an optional local file backed cache
+that survives those events.
+
+Each semester gets its own directory containing two append-only files:
+
+    intervals.dat - a flat array of int64 microsecond epoch timestamps. Each entry is a
+                    contiguous run of (start, end) pairs.
+    index.jsonl   - one json line per entry, mapping the cache key to the offset and
+                    number of timestamps of that entry within intervals.dat.
+
+The data file is read through a read-only memory map, so many processes can share the
+same cache without copying it. Writes take an exclusive file lock and only ever append,
+so readers never see a partially rewritten entry.
+'''
+import os
+import json
+import mmap
+import fcntl
+import logging
+
+import numpy as np
+from time_intervals.intervals import Intervals
+
+from adaptive_scheduler.utils import datetimes_to_epoch_array, epoch_array_to_datetimes
+
+log = logging.getLogger(__name__)
+
+DATA_FILE = 'intervals.dat'
+INDEX_FILE = 'index.jsonl'
+LOCK_FILE = '.lock'
+TIMESTAMP_DTYPE = np.dtype('<i8')
+
+
+def semester_directory_name(semester_start, semester_end):
+    return '{}_{}'.format(semester_start.strftime('%Y%m%dT%H%M%S'), semester_end.strftime('%Y%m%dT%H%M%S'))
+
+
+class RiseSetDiskCache(object):
+    '''Memory mapped, append-only, per semester cache of rise_set Intervals.
+       Nothing touches the filesystem until set_semester() is called. A cache opened with
+       read_only=True never creates files or takes the write lock, and is safe to use from
+       worker processes while another process appends to the cache.
+    '''
+
+    def __init__(self, cache_dir, read_only=False):
+        self.cache_dir = cache_dir
+        self.read_only = read_only
+        self.semester_dir = None
+        self._index = {}
+        self._index_position = 0
+        self._data_file = None
+        self._mmap = None
+        self._mapped_size = 0
+
+    def set_semester(self, semester_start, semester_end):
+        semester_dir = os.path.join(self.cache_dir, semester_directory_name(semester_start, semester_end))
+        if semester_dir == self.semester_dir:
+            return
+        self.close()
+        self.semester_dir = semester_dir
+        if not self.read_only:
+            os.makedirs(semester_dir, exist_ok=True)
+        self._refresh()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._data_file is not None:
+            self._data_file.close()
+            self._data_file = None
+        self._mapped_size = 0
+        self._index = {}
+        self._index_position = 0
+        self.semester_dir = None
+
+    def __contains__(self, key):
+        if self.semester_dir is None:
+            return False
+        if key not in self._index:
+            self._refresh()
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key):
+        '''Returns the cached Intervals for key, or None if they are not in the cache.'''
+        if key not in self:
+            return None
+        offset, count = self._index[key]
+        timestamps = self._read(offset, count)
+        if timestamps is None:
+            return None
+        return Intervals(list(zip(*[iter(epoch_array_to_datetimes(timestamps))] * 2)))
+
+    def set(self, key, intervals):
+        '''Appends the Intervals for key to the cache. Keys already present are left untouched.'''
+        if self.read_only or self.semester_dir is None:
+            return
+        timestamps = datetimes_to_epoch_array([time for interval in intervals.toTupleList() for time in interval])
+        with open(self._path(LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                if key in self._index:
+                    return
+                with open(self._path(DATA_FILE), 'ab') as data_file:
+                    offset = data_file.tell() // TIMESTAMP_DTYPE.itemsize
+                    data_file.write(timestamps.astype(TIMESTAMP_DTYPE).tobytes())
+                with open(self._path(INDEX_FILE), 'a') as index_file:
+                    index_file.write(json.dumps({'key': key, 'offset': offset, 'count': len(timestamps)}) + '\n')
+                self._index[key] = (offset, len(timestamps))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _path(self, filename):
+        return os.path.join(self.semester_dir, filename)
+
+    def _refresh(self):
+        '''Pick up any index entries appended since we last looked, possibly by another process.'''
+        try:
+            with open(self._path(INDEX_FILE), 'r') as index_file:
+                index_file.seek(self._index_position)
+                for line in iter(index_file.readline, ''):
+                    if not line.endswith('\n'):
+                        # A writer is midway through this line, it will be picked up next time
+                        break
+                    entry = json.loads(line)
+                    self._index[entry['key']] = (entry['offset'], entry['count'])
+                    self._index_position = index_file.tell()
+        except FileNotFoundError:
+            pass
+
+    def _read(self, offset, count):
+        if count == 0:
+            return np.empty(0, dtype=TIMESTAMP_DTYPE)
+        end = (offset + count) * TIMESTAMP_DTYPE.itemsize
+        if end > self._mapped_size:
+            self._remap()
+        if end > self._mapped_size:
+            log.warning('Rise set disk cache index points beyond the end of its data file in {}'.format(self.semester_dir))
+            return None
+        # Slice out a copy so no numpy array holds on to the map, which must be closable when remapping
+        return np.frombuffer(self._mmap[offset * TIMESTAMP_DTYPE.itemsize:end], dtype=TIMESTAMP_DTYPE)
+
+    def _remap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            self._mapped_size = 0
+        if self._data_file is None:
+            try:
+                self._data_file = open(self._path(DATA_FILE), 'rb')
+            except FileNotFoundError:
+                return
+        size = os.fstat(self._data_file.fileno()).st_size
+        if size > 0:
+            self._mmap = mmap.mmap(self._data_file.fileno(), size, access=mmap.ACCESS_READ)
+            self._mapped_size = size
@@ -0,0 +1,165 @@
+'''
+rise_set_pool.py - A long lived pool of worker processes for computing rise_set intervals.
+
+Spawning a fresh process pool every scheduling cycle means every worker re-imports the
+whole package and is sent a pickled Visibility object with every task. The pool here is
+created once and kept warm between cycles. Each worker builds the Visibility objects for
+every telescope when it starts, so tasks only carry the target dict, the resource name and
+the constraints, and results are streamed back as soon as each one is ready.
+
+The pool is only recreated when the semester or the telescope geometry changes.
+'''
+import logging
+from multiprocessing import cpu_count, current_process, get_context, TimeoutError
+
+from adaptive_scheduler.kernel_mappings import (construct_visibilities, duplicate_visibility_with_new_window,
+                                                get_rise_set_timepoint_intervals, RiseSetTimedOut,
+                                                RISE_SET_TARGET_TIMEOUT)
+from adaptive_scheduler.utils import time_limit, TimeLimitExceeded
+
+log = logging.getLogger(__name__)
+
+# The telescope fields which change the result of a rise_set calculation
+VISIBILITY_FIELDS = ('latitude', 'longitude', 'horizon', 'ha_limit_neg', 'ha_limit_pos', 'zenith_blind_spot')
+
+# Visibility objects by resource, built once in each worker process by init_worker
+_worker_visibilities = {}
+# Seconds each worker process may spend on a single task, set by init_worker
+_worker_time_limit = {'target_timeout': None}
+
+
+def init_worker(telescopes, semester_start, semester_end, target_timeout=None):
+    _worker_visibilities.clear()
+    _worker_visibilities.update(construct_visibilities(telescopes, semester_start, semester_end))
+    _worker_time_limit['target_timeout'] = target_timeout
+
+
+def get_worker_visibility(resource):
+    '''Returns the semester long visibility of the resource, built by init_worker in this worker process.'''
+    return _worker_visibilities[resource]
+
+
+def compute_rise_set_in_worker(task):
+    ''' Computes the rise_set intervals for one task in a worker process. Returns a tuple of the cache key and
+        the intervals, the cache key and a RiseSetTimedOut if the computation took longer than the worker's time
+        limit, or the cache key and None if the computation failed so the caller can fall back.
+    '''
+    (cache_key, resource, rise_set_target, max_airmass, min_lunar_distance, max_lunar_phase, window_range) = task
+    try:
+        visibility = _worker_visibilities[resource]
+        if window_range is not None:
+            visibility = duplicate_visibility_with_new_window(visibility, *window_range)
+        with time_limit(_worker_time_limit['target_timeout']):
+            intervals = get_rise_set_timepoint_intervals(rise_set_target, visibility, max_airmass,
+                                                         min_lunar_distance, max_lunar_phase)
+        return cache_key, intervals
+    except TimeLimitExceeded:
+        log.warning('process {} gave up on a rise set for {} after {} seconds'.format(
+            current_process().pid, resource, _worker_time_limit['target_timeout']))
+        return cache_key, RiseSetTimedOut()
+    except Exception as e:
+        log.warning('process {} failed to calculate a rise set for {}: {}'.format(current_process().pid, resource,
+                                                                                  repr(e)))
+        return cache_key, None
+
+
+def visibility_fingerprint(telescopes, semester_start, semester_end):
+    telescope_fields = tuple(sorted(
+        (name, tuple(telescope[field] for field in VISIBILITY_FIELDS)) for name, telescope in telescopes.items()
+    ))
+    return semester_start, semester_end, telescope_fields
+
+
+class RiseSetWorkerPool(object):
+    ''' A process pool which is warmed up once per semester and set of telescopes, and reused across scheduling
+        cycles. No processes are started until the first call to imap_rise_sets.
+    '''
+
+    def __init__(self, processes=0, task_timeout=300, target_timeout=RISE_SET_TARGET_TIMEOUT):
+        self.processes = processes if processes > 0 else max(cpu_count() - 1, 1)
+        self.task_timeout = task_timeout
+        self.target_timeout = target_timeout
+        self._pool = None
+        self._telescopes = None
+        self._semester_start = None
+        self._semester_end = None
+        self._fingerprint = None
+
+    def configure(self, telescopes, semester_start, semester_end):
+        ''' Sets the telescopes and semester that workers build visibilities for. The warm pool is only thrown
+            away if these have changed in a way that affects rise_set calculations.
+        '''
+        fingerprint = visibility_fingerprint(telescopes, semester_start, semester_end)
+        if fingerprint != self._fingerprint:
+            self.shutdown()
+            self._fingerprint = fingerprint
+            self._telescopes = {name: {field: telescope[field] for field in VISIBILITY_FIELDS}
+                                for name, telescope in telescopes.items()}
+            self._semester_start = semester_start
+            self._semester_end = semester_end
+
+    @property
+    def is_configured(self):
+        return self._fingerprint is not None
+
+    @property
+    def is_running(self):
+        return self._pool is not None
+
+    def _ensure_started(self):
+        if self._pool is None:
+            log.info("Starting rise set worker pool with {} processes".format(self.processes))
+            self._pool = get_context('spawn').Pool(processes=self.processes, initializer=init_worker,
+                                                   initargs=(self._telescopes, self._semester_start,
+                                                             self._semester_end, self.target_timeout))
+
+    def imap_rise_sets(self, tasks):
+        ''' Yields (cache_key, intervals) tuples in completion order for each task that does not fail. intervals is
+            a RiseSetTimedOut for a task which ran past the per target time limit in its worker.
+            Tasks are tuples of (cache_key, resource, rise_set_target, max_airmass, min_lunar_distance,
+            max_lunar_phase, window_range) where window_range is None for semester long visibility. If no result
+            arrives within the task timeout, the pool is torn down and iteration stops. Any tasks without a result
+            are left for the caller to compute.
+        '''
+        if not tasks:
+            return
+        if not self.is_configured:
+            raise RuntimeError('RiseSetWorkerPool must be configured before computing rise sets')
+        self._ensure_started()
+        results = self._pool.imap_unordered(compute_rise_set_in_worker, tasks)
+        for _ in range(len(tasks)):
+            try:
+                cache_key, intervals = results.next(self.task_timeout)
+            except TimeoutError:
+                log.warning('{} second timeout reached waiting for a rise set result. Restarting the worker pool'.format(
+                    self.task_timeout))
+                self.shutdown(terminate=True)
+                return
+            except StopIteration:
+                return
+            if intervals is not None:
+                yield cache_key, intervals
+
+    def map_tasks(self, function, tasks):
+        ''' Runs function over each task in the warm workers and returns the results in task order. If the results do
+            not all arrive within the task timeout, the pool is torn down and a TimeoutError is raised.
+        '''
+        if not self.is_configured:
+            raise RuntimeError('RiseSetWorkerPool must be configured before running tasks')
+        self._ensure_started()
+        try:
+            return self._pool.map_async(function, tasks).get(self.task_timeout)
+        except TimeoutError:
+            log.warning('{} second timeout reached waiting for the worker pool. Restarting the worker pool'.format(
+                self.task_timeout))
+            self.shutdown(terminate=True)
+            raise
+
+    def shutdown(self, terminate=False):
+        if self._pool is not None:
+            if terminate:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,186 @@
+'''
+rise_set_prefetch.py - Background computation of next semester's rise_set intervals.
+
+Rise_set intervals are cached per semester, so the first scheduling cycle of a new semester
+would otherwise have to compute the visibility of every target from scratch. During the last
+few days of a semester the RiseSetPrefetcher computes next semester's intervals for the
+targets that are currently being scheduled, in a background process pool, and stores them in
+redis under next semester's namespace, where the first cycle after the rollover will find them.
+With BATCH_SIDEREAL_VISIBILITY on, sidereal targets are computed in batches just as the scheduler
+computes them, so that the intervals match the namespace they are saved under.
+'''
+import logging
+from datetime import timedelta
+from multiprocessing import get_context
+
+from rise_set.utils import is_sidereal_target
+
+from adaptive_scheduler.kernel_mappings import (make_request_cache_key, redis_cache_key, save_to_redis_cache,
+                                                semester_cache_name, compute_sidereal_rise_sets_in_batch,
+                                                local_cache, RiseSetTimedOut, RISE_SET_TARGET_TIMEOUT,
+                                                BATCH_SIDEREAL_VISIBILITY)
+from adaptive_scheduler.models import redis_instance
+from adaptive_scheduler.rise_set_pool import init_worker, compute_rise_set_in_worker, get_worker_visibility
+
+log = logging.getLogger(__name__)
+
+# The most sidereal targets computed together in one prefetch work item
+PREFETCH_BATCH_SIZE = 1000
+
+
+def group_prefetch_tasks(tasks):
+    ''' Groups the tasks from get_prefetch_tasks into work items for prefetch_rise_sets_in_worker. With
+        BATCH_SIDEREAL_VISIBILITY on, sidereal targets are grouped by semester, resource and the constraints a batch
+        shares, PREFETCH_BATCH_SIZE at a time. Every other task is a work item of its own.
+    '''
+    work_items = []
+    batches = {}
+    for semester_name, task in tasks:
+        (cache_key, resource, rise_set_target, max_airmass, min_lunar_distance, max_lunar_phase, window_range) = task
+        if BATCH_SIDEREAL_VISIBILITY and is_sidereal_target(rise_set_target):
+            batches.setdefault((semester_name, resource, max_airmass, min_lunar_distance), []).append(task)
+        else:
+            work_items.append((semester_name, [task]))
+    for (semester_name, _, _, _), batch in batches.items():
+        for batch_start in range(0, len(batch), PREFETCH_BATCH_SIZE):
+            work_items.append((semester_name, batch[batch_start:batch_start + PREFETCH_BATCH_SIZE]))
+    return work_items
+
+
+def prefetch_rise_sets_in_worker(args):
+    ''' Computes the rise_set intervals of one work item from group_prefetch_tasks in a prefetch worker process, and
+        saves them into redis under the given semester. Returns the number of intervals saved.
+    '''
+    semester_name, tasks = args
+    if BATCH_SIDEREAL_VISIBILITY and is_sidereal_target(tasks[0][2]):
+        rise_sets = {}
+        for (cache_key, resource, rise_set_target, max_airmass, min_lunar_distance, max_lunar_phase, _) in tasks:
+            rise_sets[cache_key] = (resource, rise_set_target, get_worker_visibility(resource), max_airmass,
+                                    min_lunar_distance, max_lunar_phase)
+        # A batch which fails is left for the scheduler, rather than computed one target at a time here
+        remaining = compute_sidereal_rise_sets_in_batch(rise_sets, semester_name)
+        for cache_key in rise_sets:
+            local_cache.pop(cache_key, None)
+        return len(rise_sets) - len(remaining)
+
+    saved = 0
+    for task in tasks:
+        cache_key, intervals = compute_rise_set_in_worker(task)
+        if intervals is None or isinstance(intervals, RiseSetTimedOut):
+            continue
+        try:
+            save_to_redis_cache(cache_key, intervals, semester_name)
+        except Exception as e:
+            log.warning('Failed to save prefetched rise_set intervals into redis: {}'.format(repr(e)))
+            continue
+        saved += 1
+    return saved
+
+
+# The number of cache keys checked for in redis in each pipeline
+EXISTS_CHUNK_SIZE = 10000
+
+
+def get_prefetch_tasks(request_groups, semester_name):
+    ''' Returns rise_set worker tasks for each distinct target, resource and constraint combination in
+        request_groups which is not already cached in redis for the semester. Targets which are only cached over a
+        single request's windows are skipped. Whether the keys are cached is checked in pipelines of
+        EXISTS_CHUNK_SIZE keys, rather than one round trip per key.
+    '''
+    candidates = {}
+    for rg in request_groups:
+        for request in rg.requests:
+            for configuration in request.configurations:
+                if configuration.target.has_unbound_orbit():
+                    continue
+                for resource in request.windows.windows_for_resource:
+                    cache_key = make_request_cache_key(request, configuration, resource)
+                    if cache_key not in candidates:
+                        candidates[cache_key] = (resource, configuration)
+
+    cache_keys = list(candidates)
+    tasks = []
+    for chunk_start in range(0, len(cache_keys), EXISTS_CHUNK_SIZE):
+        chunk = cache_keys[chunk_start:chunk_start + EXISTS_CHUNK_SIZE]
+        try:
+            pipeline = redis_instance.pipeline(transaction=False)
+            for cache_key in chunk:
+                pipeline.exists(redis_cache_key(cache_key, semester_name))
+            cached = pipeline.execute()
+        except Exception:
+            log.warning('Redis is unavailable, so rise_set intervals cannot be prefetched')
+            return []
+        for cache_key, is_cached in zip(chunk, cached):
+            if is_cached:
+                continue
+            resource, configuration = candidates[cache_key]
+            tasks.append((semester_name, (cache_key, resource, configuration.target.in_rise_set_format(),
+                                          configuration.constraints['max_airmass'],
+                                          configuration.constraints['min_lunar_distance'],
+                                          configuration.constraints['max_lunar_phase'], None)))
+    return tasks
+
+
+class RiseSetPrefetcher(object):
+    ''' Starts a background process pool to compute next semester's rise_set intervals once the current semester is
+        within lead_days of its end. Only one prefetch runs at a time, and once a semester has been prefetched
+        successfully it is not prefetched again.
+    '''
+
+    def __init__(self, lead_days=7.0, processes=1):
+        self.lead_time = timedelta(days=lead_days)
+        self.processes = processes
+        self.prefetched_semester = None
+        self._pool = None
+        self._result = None
+        self._semester_name = None
+
+    @property
+    def is_running(self):
+        return self._pool is not None
+
+    def poll(self):
+        ''' Collects a prefetch which has finished, recording its semester as prefetched if it succeeded and shutting
+            down its pool. Returns True if a prefetch is still running.
+        '''
+        if self._pool is not None and self._result.ready():
+            if self._result.successful():
+                log.info('Finished prefetching rise sets for the next semester')
+                self.prefetched_semester = self._semester_name
+            else:
+                log.warning('Prefetching rise sets for the next semester failed, it will be retried')
+            self.shutdown()
+        return self.is_running
+
+    def is_due(self, now, semester_details):
+        in_final_days = semester_details['end'] - self.lead_time <= now < semester_details['end']
+        return in_final_days and not self.is_running
+
+    def prefetch(self, request_groups, telescopes, semester_start, semester_end):
+        ''' Starts computing the rise_set intervals over the given semester for the targets in request_groups, and
+            returns the number of intervals being computed. Returns immediately, without waiting for the results.
+        '''
+        semester_name = semester_cache_name(semester_start, semester_end)
+        if semester_name == self.prefetched_semester:
+            return 0
+        tasks = get_prefetch_tasks(request_groups, semester_name)
+        if not tasks:
+            self.prefetched_semester = semester_name
+            return 0
+        log.info('Prefetching {} rise sets for the semester starting {}'.format(len(tasks), semester_start))
+        self._semester_name = semester_name
+        self._pool = get_context('spawn').Pool(processes=self.processes, initializer=init_worker,
+                                               initargs=(telescopes, semester_start, semester_end,
+                                                         RISE_SET_TARGET_TIMEOUT))
+        self._result = self._pool.map_async(prefetch_rise_sets_in_worker, group_prefetch_tasks(tasks))
+        self._pool.close()
+        return len(tasks)
+
+    def shutdown(self, terminate=False):
+        if self._pool is not None:
+            if terminate:
+                self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._result = None
+            self._semester_name = None
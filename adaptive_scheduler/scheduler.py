@@ -32,6 +32,9 @@ from adaptive_scheduler.kernel_mappings import (construct_visibilities,
 from adaptive_scheduler.request_filters import filter_rgs, drop_empty_requests, set_now
 from adaptive_scheduler.observation_portal_connections import ObservationPortalConnectionError
 from adaptive_scheduler.downtime_connections import DowntimeError, DowntimeInterface
+from adaptive_scheduler.rise_set_pool import RiseSetWorkerPool
+from adaptive_scheduler.rise_set_prefetch import RiseSetPrefetcher
+from adaptive_scheduler.visibility_precompute import VisibilityPrecomputer
 
 
 class Scheduler(SendMetricMixin):
@@ -39,6 +42,8 @@ class Scheduler(SendMetricMixin):
     def __init__(self, kernel_class, sched_params, event_bus, network_model, seeing_monitor):
         self.kernel_class = kernel_class
         self.visibility_cache = {}
+        # Optional long lived RiseSetWorkerPool, owned and shut down by the SchedulerRunner
+        self.rise_set_pool = None
         self.saved_semester = {'start': None, 'end': None}
         self.sched_params = sched_params
         self.event_bus = event_bus
@@ -129,7 +134,7 @@ class Scheduler(SendMetricMixin):
         return request_groups, []
 
     def apply_window_filters(self, request_groups, estimated_scheduler_end, semester_details,
-                             extra_downtime_by_resource):
+                             extra_downtime_by_resource, available_resources=None):
         ''' Returns the set of RGs with windows adjusted to include only RGs with windows
         suitable for scheduling
         '''
@@ -381,7 +386,8 @@ class Scheduler(SendMetricMixin):
         self.after_unschedulable_filters(schedulable_rgs)
 
         window_adjusted_rgs = self.apply_window_filters(schedulable_rgs, estimated_scheduler_end, semester_details,
-                                                        scheduler_input.get_block_schedule_by_resource())
+                                                        scheduler_input.get_block_schedule_by_resource(),
+                                                        available_resources)
         self.after_window_filters(window_adjusted_rgs)
 
         # By default, schedule on all resources
@@ -469,9 +475,9 @@ class LCOGTNetworkScheduler(Scheduler):
 
     @metric_timer('apply_window_filters', num_requests=len)
     def apply_window_filters(self, request_groups, estimated_scheduler_end, semester_details,
-                             extra_downtime_by_resource):
+                             extra_downtime_by_resource, available_resources=None):
         ''' Returns the set of RGs with windows adjusted to include only RGs with windows
-        suitable for scheduling
+        suitable for scheduling on the available resources
         '''
         self.log.info("Filtering on dark/rise_set")
 
@@ -492,7 +498,9 @@ class LCOGTNetworkScheduler(Scheduler):
         filtered_window_request_groups = filter_for_kernel(request_groups, self.visibility_cache,
                                                            combined_downtime_intervals, self.seeing_monitor,
                                                            semester_details['start'], semester_end, estimated_scheduler_end,
-                                                           self.scheduling_horizon(estimated_scheduler_end))
+                                                           self.scheduling_horizon(estimated_scheduler_end),
+                                                           rise_set_pool=self.rise_set_pool,
+                                                           available_resources=available_resources)
 
         return filtered_window_request_groups
 
@@ -541,6 +549,10 @@ class LCOGTNetworkScheduler(Scheduler):
             self.log.info("Constructing telescope visibilities")
             self.visibility_cache = construct_visibilities(self.network_model, semester_start, semester_end)
 
+        # The warm worker pool is only restarted if the semester or telescope geometry has changed
+        if self.rise_set_pool is not None:
+            self.rise_set_pool.configure(self.network_model, semester_start, semester_end)
+
     def after_unschedulable_filters(self, request_groups):
         summarise_rgs(request_groups, log_msg="Passed unschedulable filters:")
 
@@ -641,6 +653,20 @@ class SchedulerRunner(object):
         self.avg_save_time_per_reservation_timedelta = timedelta(seconds=sched_params.avg_reservation_save_time_seconds)
         self.first_run = True
         self.semester_details = None
+        self.rise_set_pool = None
+        if sched_params.persistent_rise_set_pool:
+            self.rise_set_pool = RiseSetWorkerPool(processes=sched_params.rise_set_pool_processes,
+                                                   task_timeout=sched_params.rise_set_task_timeout)
+            self.scheduler.rise_set_pool = self.rise_set_pool
+        self.rise_set_prefetcher = None
+        if sched_params.prefetch_next_semester_days > 0:
+            self.rise_set_prefetcher = RiseSetPrefetcher(lead_days=sched_params.prefetch_next_semester_days)
+        self.visibility_precomputer = None
+        if sched_params.precompute_visibility and not sched_params.run_once:
+            self.visibility_precomputer = VisibilityPrecomputer(network_interface, network_model, sched_params,
+                                                                rise_set_pool=self.rise_set_pool,
+                                                                poll_seconds=sched_params.precompute_poll_seconds,
+                                                                input_factory=input_factory)
 
     def scheduler_rerun_required(self):
         ''' Return True if scheduler should be run now
@@ -694,16 +720,52 @@ class SchedulerRunner(object):
             raise ScheduleException("Unable to get current semester details. Skipping run.")
         return self.semester_details
 
+    def prefetch_next_semester(self, request_groups, now):
+        ''' Near the end of the semester, starts computing next semester's rise_set intervals for these request groups
+            in the background so that the first cycles of the next semester find them already cached.
+        '''
+        if self.rise_set_prefetcher is None or self.semester_details is None:
+            return
+        self.rise_set_prefetcher.poll()
+        if not self.rise_set_prefetcher.is_due(now, self.semester_details):
+            return
+        try:
+            next_semester_details = self.network_interface.observation_portal_interface.get_next_semester_details(
+                self.semester_details)
+        except ObservationPortalConnectionError as e:
+            self.log.warning("Unable to get next semester details to prefetch rise sets: {}".format(repr(e)))
+            return
+        self.rise_set_prefetcher.prefetch(request_groups, self.network_model, next_semester_details['start'],
+                                          next_semester_details['end'])
+
     def run(self):
         rerun_required = True
-        while self.run_flag:
-            rerun_required = self.run_once(rerun_required)
-            self.first_run = False
-            if self.sched_params.run_once:
-                self.run_flag = False
-            else:
-                self.log.info("Sleeping for %d seconds", self.sched_params.sleep_seconds)
-                time.sleep(self.sched_params.sleep_seconds)
+        try:
+            while self.run_flag:
+                rerun_required = self.run_once(rerun_required)
+                self.first_run = False
+                if self.sched_params.run_once:
+                    self.run_flag = False
+                else:
+                    self.wait_for_next_run()
+        finally:
+            if self.rise_set_pool is not None:
+                self.rise_set_pool.shutdown()
+            if self.rise_set_prefetcher is not None:
+                self.rise_set_prefetcher.shutdown(terminate=True)
+
+    def wait_for_next_run(self):
+        ''' Sleeps until the next scheduling cycle, precomputing the visibility of any request groups that change
+            in the meantime if enabled.
+        '''
+        if self.visibility_precomputer is None or self.semester_details is None:
+            self.log.info("Sleeping for %d seconds", self.sched_params.sleep_seconds)
+            time.sleep(self.sched_params.sleep_seconds)
+        else:
+            self.log.info("Precomputing visibility of changed request groups for %d seconds",
+                          self.sched_params.sleep_seconds)
+            self.visibility_precomputer.run_until(time.monotonic() + self.sched_params.sleep_seconds,
+                                                  self.semester_details)
 
     @timeit
     @metric_timer('total_scheduling_cycle')
@@ -721,6 +783,9 @@ class SchedulerRunner(object):
             self.network_interface.configdb_interface.update_configdb_structures()
             if self.scheduler_rerun_required() or self.first_run or rerun_required:
                 self.create_new_schedule(scheduler_run_start)
+                if self.visibility_precomputer is not None:
+                    # Everything modified before this run started has now had its visibility computed
+                    self.visibility_precomputer.mark_checked(scheduler_run_start)
                 # Reset the warm starts flag back to the input setting at the end of each run
                 self.sched_params.warm_starts = self.warm_starts_setting
         except (ObservationPortalConnectionError, ScheduleException, EstimateExceededException) as eee:
@@ -1076,6 +1141,7 @@ class SchedulerRunner(object):
                 scheduled_requests_by_rg=self.normal_scheduled_requests_by_rg,
                 rr_schedule=rr_schedule_result.schedule,
                 network_state_timestamp=network_state_timestamp)
+            self.prefetch_next_semester(scheduler_input.request_groups, scheduler_input.scheduler_now)
             result = self.create_normal_schedule(scheduler_input)
         elif schedule_type == RR_OBSERVATION_TYPE:
             scheduler_input = self.input_factory.create_rr_scheduling_input(
@@ -1,4 +1,5 @@
-from adaptive_scheduler.models import ModelBuilder, RequestError, n_base_requests
+from adaptive_scheduler.models import (ModelBuilder, RequestError, RGCollection, RequestGroupModelCache,
+                                       ProposalCache, n_base_requests)
 from adaptive_scheduler.utils import iso_string_to_datetime, to_bool
 from adaptive_scheduler.utils import timeit, metric_timer, SendMetricMixin, get_reservation_datetimes
 from adaptive_scheduler.observation_portal_connections import ObservationPortalConnectionError
@@ -51,7 +52,15 @@ class SchedulerParameters(object):
                  ignore_ipp=to_bool(os.getenv('IGNORE_IPP_VALUES', 'False')),
                  avg_reservation_save_time_seconds=float(os.getenv('INITIAL_PER_RESERVATION_SAVE_TIME', 0.05)),
                  normal_runtime_seconds=float(os.getenv('INITIAL_NORMAL_RUNTIME', 360.0)),
-                 rr_runtime_seconds=float(os.getenv('INITIAL_RAPID_RESPONSE_RUNTIME', 120.0))):
+                 rr_runtime_seconds=float(os.getenv('INITIAL_RAPID_RESPONSE_RUNTIME', 120.0)),
+                 persistent_rise_set_pool=to_bool(os.getenv('PERSISTENT_RISE_SET_POOL', 'True')),
+                 rise_set_pool_processes=int(os.getenv('RISE_SET_POOL_PROCESSES', 0)),
+                 rise_set_task_timeout=float(os.getenv('RISE_SET_TASK_TIMEOUT', 300.0)),
+                 prefetch_next_semester_days=float(os.getenv('PREFETCH_NEXT_SEMESTER_DAYS', 7.0)),
+                 precompute_visibility=to_bool(os.getenv('PRECOMPUTE_VISIBILITY', 'True')),
+                 precompute_poll_seconds=float(os.getenv('PRECOMPUTE_POLL_SECONDS', 30.0)),
+                 request_group_model_cache=to_bool(os.getenv('REQUEST_GROUP_MODEL_CACHE', 'True')),
+                 proposal_cache_max_age_seconds=float(os.getenv('PROPOSAL_CACHE_MAX_AGE_SECONDS', 3600.0))):
         self.dry_run = dry_run
         self.no_weather = no_weather
         self.no_singles = no_singles
@@ -96,6 +105,14 @@ class SchedulerParameters(object):
         else:
             self.opensearch_excluded_observatories = []
         self.seeing_valid_time_period = seeing_valid_time_period
+        self.persistent_rise_set_pool = persistent_rise_set_pool
+        self.rise_set_pool_processes = rise_set_pool_processes
+        self.rise_set_task_timeout = rise_set_task_timeout
+        self.prefetch_next_semester_days = prefetch_next_semester_days
+        self.precompute_visibility = precompute_visibility
+        self.precompute_poll_seconds = precompute_poll_seconds
+        self.request_group_model_cache = request_group_model_cache
+        self.proposal_cache_max_age_seconds = proposal_cache_max_age_seconds
 
 
 class SchedulingInputFactory(object):
@@ -103,6 +120,7 @@ class SchedulingInputFactory(object):
     def __init__(self, input_provider):
         self.input_provider = input_provider
         self.model_builder = None
+        self.model_cache = RequestGroupModelCache() if input_provider.sched_params.request_group_model_cache else None
         self._scheduler_model_normal_request_groups = []
         self._scheduler_model_rr_request_groups = []
         self._invalid_requests = []
@@ -115,7 +133,8 @@ class SchedulingInputFactory(object):
         if self.input_provider.sched_params.ignore_ipp:
             ignore_ipp = self.input_provider.sched_params.ignore_ipp
         scheduler_model_rgs, invalid_request_groups, invalid_requests = utils.json_rgs_to_scheduler_model_rgs(
-            self.input_provider.json_request_group_list, scheduled_requests_by_rg, ignore_ipp=ignore_ipp)
+            self.input_provider.json_request_group_list, scheduled_requests_by_rg, ignore_ipp=ignore_ipp,
+            model_cache=self.model_cache)
 
         self._invalid_request_groups = invalid_request_groups
         self._invalid_requests = invalid_requests
@@ -205,10 +224,25 @@ class SchedulingInputUtils(SendMetricMixin):
         self.model_builder = model_builder
         self.log = logging.getLogger(__name__)
 
+    def _model_cache_context(self, ignore_ipp):
+        '''Returns everything other than its json that a request group model is built from.'''
+        try:
+            semester_details = self.model_builder.get_semester_details(datetime.utcnow())
+        except RequestError:
+            semester_details = None
+        return ignore_ipp, self.model_builder.configdb_interface.active_instruments_fingerprint, semester_details
+
     @timeit
-    def json_rgs_to_scheduler_model_rgs(self, json_request_group_list, scheduled_requests_by_rg=None, ignore_ipp=False):
+    def json_rgs_to_scheduler_model_rgs(self, json_request_group_list, scheduled_requests_by_rg=None, ignore_ipp=False,
+                                        model_cache=None, partial=False):
+        ''' Builds the RequestGroup models of the json request groups. If a RequestGroupModelCache is given, the
+            models of request groups which are unchanged since they were last built are reused from it. A partial
+            list of request groups leaves the cached models of the other request groups in place.
+        '''
         if scheduled_requests_by_rg is None:
             scheduled_requests_by_rg = {}
+        if model_cache is not None:
+            model_cache.start_cycle(self._model_cache_context(ignore_ipp))
         scheduler_model_rgs = []
         invalid_json_request_groups = []
         invalid_json_requests = []
@@ -217,9 +251,12 @@ class SchedulingInputUtils(SendMetricMixin):
                 scheduled_requests = {}
                 if json_rg['id'] in scheduled_requests_by_rg:
                     scheduled_requests = scheduled_requests_by_rg[json_rg['id']]
-                scheduler_model_rg, invalid_children = self.model_builder.build_request_group(json_rg,
-                                                                                              scheduled_requests,
-                                                                                              ignore_ipp=ignore_ipp)
+                if model_cache is not None:
+                    scheduler_model_rg, invalid_children = model_cache.build_request_group(
+                        self.model_builder, json_rg, scheduled_requests, ignore_ipp=ignore_ipp)
+                else:
+                    scheduler_model_rg, invalid_children = self.model_builder.build_request_group(
+                        json_rg, scheduled_requests, ignore_ipp=ignore_ipp)
 
                 scheduler_model_rgs.append(scheduler_model_rg)
                 invalid_json_requests.extend(invalid_children)
@@ -227,6 +264,13 @@ class SchedulingInputUtils(SendMetricMixin):
                 self.log.warn(e)
                 invalid_json_request_groups.append(json_rg)
 
+        if model_cache is not None and not partial:
+            model_cache.finish_cycle()
+            self.log.info("Reused {} and built {} request group models".format(model_cache.hits, model_cache.misses))
+            self.send_metric('request_group_model_cache.hits', model_cache.hits)
+            self.send_metric('request_group_model_cache.misses', model_cache.misses)
+        self.model_builder.configdb_interface.send_telescope_resolution_metrics()
+        self.model_builder.send_proposal_cache_metrics()
         self.send_metric('invalid_child_requests.num_requests', len(invalid_json_requests))
         self.send_metric('invalid_request_groups.num_requests', len(invalid_json_request_groups))
 
@@ -234,8 +278,8 @@ class SchedulingInputUtils(SendMetricMixin):
 
     def sort_scheduler_models_rgs_by_type(self, scheduler_model_request_groups):
         scheduler_models_rgs_by_type = {
-            'rr': [],
-            'normal': []
+            'rr': RGCollection(),
+            'normal': RGCollection()
         }
         for scheduler_model_rg in scheduler_model_request_groups:
             if scheduler_model_rg.is_rapid_response():
@@ -363,6 +407,7 @@ class SchedulingInputProvider(object):
         self.is_rr_input = is_rr_input
         self.estimated_rr_run_time = timedelta(seconds=self.sched_params.rr_runtime_seconds)
         self.estimated_normal_run_time = timedelta(seconds=self.sched_params.normal_runtime_seconds)
+        self.proposal_cache = ProposalCache(self.sched_params.proposal_cache_max_age_seconds)
 
         # TODO: Hide these behind read only properties
         self.scheduler_now = None
@@ -463,7 +508,8 @@ class SchedulingInputProvider(object):
 
     def get_model_builder(self):
         mb = ModelBuilder(self.network_interface.observation_portal_interface,
-                          self.network_interface.configdb_interface)
+                          self.network_interface.configdb_interface,
+                          proposal_cache=self.proposal_cache)
 
         return mb
 
@@ -0,0 +1,190 @@
+'''
+site_ephemeris.py - Per site caching of the target independent parts of rise_set calculations.
+
+The dark intervals, moon rise and set times, lunar phase and lunar position at a site are the
+same for every target observed there, but rise_set recomputes the moon related ones for every
+target it is asked about. A SiteEphemeris computes them once per site and semester so that the
+per target cost of the moon distance and moon phase constraints only covers the target's own
+geometry.
+'''
+from datetime import timedelta
+from collections import OrderedDict
+import logging
+
+import numpy as np
+from rise_set.astrometry import (date_to_tdb, apparent_planet_pos, calculate_moon_phase, mean_to_apparent,
+                                 elem_to_topocentric_apparent)
+from rise_set.utils import (coalesce_adjacent_intervals, intersect_intervals, inverse_intervals, is_sidereal_target,
+                            target_to_jform)
+from time_intervals.intervals import Intervals
+
+log = logging.getLogger(__name__)
+
+# rise_set evaluates lunar constraints over chunks of this size
+LUNAR_CHUNK_SIZE = timedelta(minutes=30)
+# The moon's apparent position is sampled on a grid with this spacing and linearly interpolated in between.
+# The resulting error is a few thousandths of a degree, far below the resolution of the lunar distance constraint.
+MOON_GRID_STEP = timedelta(minutes=30)
+# Number of SiteEphemeris objects to keep around. This only needs to cover one per telescope, plus a few of the
+# request specific visibilities used for unbound orbits.
+MAX_CACHED_EPHEMERIDES = 64
+
+_ephemeris_cache = OrderedDict()
+
+
+def _chunks(intervals, chunk_size):
+    '''Splits each (start, end) interval into consecutive chunks of at most chunk_size, in the same way as rise_set.'''
+    for start, end in intervals:
+        chunk_start = start
+        chunk_end = min(chunk_start + chunk_size, end)
+        while chunk_start != chunk_end and chunk_end <= end:
+            yield chunk_start, chunk_end
+            chunk_start = chunk_end
+            chunk_end = min(chunk_start + chunk_size, end)
+
+
+def _unit_vector(ra, dec):
+    return np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def visibility_key(visibility):
+    '''A hashable key describing the parts of a Visibility that the site ephemeris depends on.'''
+    site = visibility.site
+    return (site['latitude'].in_degrees(), site['longitude'].in_degrees(), visibility.start_date,
+            visibility.end_date, visibility.horizon.in_degrees(), visibility.twilight)
+
+
+def get_site_ephemeris(visibility):
+    '''Returns the shared SiteEphemeris for the site and date range of this visibility, creating it if necessary.'''
+    key = visibility_key(visibility)
+    if key in _ephemeris_cache:
+        _ephemeris_cache.move_to_end(key)
+        return _ephemeris_cache[key]
+    ephemeris = SiteEphemeris(visibility)
+    _ephemeris_cache[key] = ephemeris
+    if len(_ephemeris_cache) > MAX_CACHED_EPHEMERIDES:
+        _ephemeris_cache.popitem(last=False)
+    return ephemeris
+
+
+def clear_site_ephemeris_cache():
+    _ephemeris_cache.clear()
+
+
+class SiteEphemeris(object):
+    '''Lazily computed, cached ephemeris data for a single Visibility (site and date range).
+       Each piece is only computed the first time a target needs it.
+    '''
+
+    def __init__(self, visibility, moon_grid_step=MOON_GRID_STEP):
+        self.visibility = visibility
+        self.site = visibility.site
+        self.zenith_blind_spot = visibility.zenith_blind_spot
+        self.moon_grid_step = moon_grid_step
+        self._moon_up_intervals = None
+        self._dark_kernel_intervals = None
+        self._moon_phase_chunks = None
+        self._moon_grid_start = None
+        self._moon_grid_vectors = None
+
+    @property
+    def dark_intervals(self):
+        # Visibility already memoizes its dark intervals
+        return self.visibility.get_dark_intervals()
+
+    @property
+    def dark_kernel_intervals(self):
+        '''The dark intervals as an Intervals object, which is only built once since Intervals deep copies its input.'''
+        if self._dark_kernel_intervals is None:
+            self._dark_kernel_intervals = Intervals(self.dark_intervals)
+        return self._dark_kernel_intervals
+
+    @property
+    def moon_up_intervals(self):
+        if self._moon_up_intervals is None:
+            self._moon_up_intervals = self.visibility.get_target_intervals(target='moon', up=True)
+        return self._moon_up_intervals
+
+    def _get_moon_phase_chunks(self):
+        '''The lunar phase at the start of each chunk of time that the moon is up at this site, by chunk start.'''
+        if self._moon_phase_chunks is None:
+            self._moon_phase_chunks = {
+                chunk_start: self._calculate_moon_phase(chunk_start)
+                for chunk_start, chunk_end in _chunks(self.moon_up_intervals, LUNAR_CHUNK_SIZE)
+            }
+        return self._moon_phase_chunks
+
+    def _calculate_moon_phase(self, time):
+        return calculate_moon_phase(time, self.site['latitude'].in_radians(), self.site['longitude'].in_radians())
+
+    def get_moon_phase_intervals(self, target_intervals, max_moon_phase=1.0):
+        '''Equivalent to Visibility.get_moon_phase_intervals. The lunar phase is evaluated over the same chunks of the
+           time that both the target and the moon are up, but the chunks which start with a moonrise, which every
+           target shares, use the phase computed once for the site.
+        '''
+        if not target_intervals:
+            return target_intervals
+        moon_phase_chunks = self._get_moon_phase_chunks()
+        bad_intervals = []
+        for chunk_start, chunk_end in _chunks(intersect_intervals(target_intervals, self.moon_up_intervals),
+                                              LUNAR_CHUNK_SIZE):
+            moon_phase = moon_phase_chunks.get(chunk_start)
+            if moon_phase is None:
+                moon_phase = self._calculate_moon_phase(chunk_start)
+            if moon_phase > max_moon_phase:
+                bad_intervals.append((chunk_start, chunk_end))
+        bad_intervals = coalesce_adjacent_intervals(bad_intervals)
+        good_intervals = inverse_intervals(bad_intervals, target_intervals[0][0], target_intervals[-1][1])
+        return intersect_intervals(good_intervals, target_intervals)
+
+    def _build_moon_grid(self):
+        self._moon_grid_start = self.visibility.start_date - self.moon_grid_step
+        n_samples = int((self.visibility.end_date - self._moon_grid_start) / self.moon_grid_step) + 3
+        vectors = np.empty((n_samples, 3))
+        for i in range(n_samples):
+            tdb = date_to_tdb(self._moon_grid_start + i * self.moon_grid_step)
+            moon_app_ra, moon_app_dec, _ = apparent_planet_pos('moon', tdb, self.site)
+            vectors[i] = _unit_vector(moon_app_ra.in_radians(), moon_app_dec.in_radians())
+        self._moon_grid_vectors = vectors
+
+    def moon_unit_vector(self, time):
+        '''The apparent topocentric direction of the moon at time, interpolated from the site's moon grid.'''
+        if self._moon_grid_vectors is None:
+            self._build_moon_grid()
+        position = (time - self._moon_grid_start) / self.moon_grid_step
+        index = min(max(int(position), 0), len(self._moon_grid_vectors) - 2)
+        fraction = position - index
+        vector = (1.0 - fraction) * self._moon_grid_vectors[index] + fraction * self._moon_grid_vectors[index + 1]
+        return vector / np.linalg.norm(vector)
+
+    def moon_unit_vectors(self, offsets):
+        '''Vectorized moon_unit_vector for an array of offsets in seconds from the start of the visibility.
+           Returns an (offsets x 3) array.
+        '''
+        if self._moon_grid_vectors is None:
+            self._build_moon_grid()
+        step_seconds = self.moon_grid_step.total_seconds()
+        position = (np.asarray(offsets) + (self.visibility.start_date - self._moon_grid_start).total_seconds()) / step_seconds
+        index = np.clip(position.astype(int), 0, len(self._moon_grid_vectors) - 2)
+        fraction = (position - index)[:, np.newaxis]
+        vectors = (1.0 - fraction) * self._moon_grid_vectors[index] + fraction * self._moon_grid_vectors[index + 1]
+        return vectors / np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+
+    def get_moon_distance_intervals(self, target, target_intervals, moon_distance):
+        '''Equivalent to Visibility.get_moon_distance_intervals, taking the moon's position from the site ephemeris.
+           moon_distance is the minimum allowed separation as an Angle.
+        '''
+        min_cos_distance = np.cos(moon_distance.in_radians())
+        intervals = []
+        for chunk_start, chunk_end in _chunks(target_intervals, LUNAR_CHUNK_SIZE):
+            tdb = date_to_tdb(chunk_start)
+            if is_sidereal_target(target):
+                target_app_ra, target_app_dec = mean_to_apparent(target, tdb)
+            else:
+                target_app_ra, target_app_dec = elem_to_topocentric_apparent(chunk_start, target, self.site,
+                                                                             target_to_jform(target))
+            target_vector = _unit_vector(target_app_ra.in_radians(), target_app_dec.in_radians())
+            # A larger separation means a smaller cosine
+            if np.dot(target_vector, self.moon_unit_vector(chunk_start)) <= min_cos_distance:
+                intervals.append((chunk_start, chunk_end))
+        return coalesce_adjacent_intervals(intervals)
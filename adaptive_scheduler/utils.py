@@ -7,10 +7,16 @@ March 2012
 '''
 
 import calendar
+import hashlib
+import json
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import signal
+import threading
 import time
 import enum
 from math import cos, radians
+import numpy as np
 import logging
 from unidecode import unidecode
 from time_intervals.intervals import Intervals
@@ -33,6 +39,8 @@ metric_wrappers.project_name = 'adaptive_scheduler'
 NORMAL_OBSERVATION_TYPE = 'normal'
 RR_OBSERVATION_TYPE = 'rr'
 
+EPOCH = datetime(1970, 1, 1)
+
 
 def to_bool(str_or_bool):
     if isinstance(str_or_bool, str):
@@ -59,17 +67,55 @@ def case_insensitive_equals(str1, str2):
 
 class EqualityMixin(object):
     '''Inherit from this class if you want your object to have simple equality
-       properties based on common attributes (this is what you usually want).'''
+       properties based on common attributes (this is what you usually want).
+       Attributes named in _eq_exclude, such as memoized values, are not compared.'''
+    _eq_exclude = ()
 
     def __eq__(self, other):
         if type(other) is type(self):
-            return self.__dict__ == other.__dict__
+            if not self._eq_exclude:
+                return self.__dict__ == other.__dict__
+            return ({key: value for key, value in self.__dict__.items() if key not in self._eq_exclude} ==
+                    {key: value for key, value in other.__dict__.items() if key not in self._eq_exclude})
         return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
 
+def canonical_value(value):
+    ''' Returns a canonical string for a value in a rise_set target dict or constraint, so that equal quantities
+        give equal strings regardless of whether they are ints, floats or rise_set Angles.
+    '''
+    if hasattr(value, 'in_degrees_per_year'):
+        value = value.in_degrees_per_year()
+    elif hasattr(value, 'in_degrees'):
+        value = value.in_degrees()
+    if isinstance(value, (bool, int, float, np.number)):
+        return '{:.12g}'.format(float(value))
+    return str(value)
+
+
+def rise_set_target_fingerprint(rs_target):
+    '''Returns a fixed size hex digest identifying a rise_set target dict by the values of its fields.'''
+    canonical = ';'.join('{}={}'.format(key, canonical_value(rs_target[key])) for key in sorted(rs_target))
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def json_fingerprint(value):
+    ''' Returns a fixed size hex digest identifying a json structure by its contents, regardless of the order of its
+        keys. Any objects within it, such as the Targets a ModelBuilder puts into configurations, are identified by
+        their attributes.'''
+    canonical = json.dumps(value, sort_keys=True, default=lambda obj: getattr(obj, '__dict__', str(obj)))
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def deterministic_fraction(value):
+    '''Returns a fraction in [0, 1) derived from a hash of the value, which is the same in every process and run.'''
+    digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
 def set_schedule_type(schedule_type):
     '''
         Function takes in a schedule type and adjusts the global tags used in saving metrics accordingly
@@ -165,6 +211,16 @@ def iso_string_to_datetime(iso_string):
        datetime objects. It's no coincidence that this also happens to be the string
        representation of datetime objects.'''
 
+    # Strings of exactly that form are parsed by fromisoformat, which is much faster than strptime
+    if (isinstance(iso_string, str) and iso_string[-1:] == 'Z' and iso_string[10:11] == 'T' and
+            (len(iso_string) == 20 or iso_string[19:20] == '.')):
+        try:
+            d = datetime.fromisoformat(iso_string[:-1])
+            if d.tzinfo is None:
+                return d
+        except ValueError:
+            pass
+
     # Set the format to the string representation of a datetime
     date_format = '%Y-%m-%dT%H:%M:%SZ'
     try:
@@ -187,6 +243,28 @@ def datetime_to_normalised_epoch(dt, dt_start):
     return normalise(datetime_to_epoch(dt), datetime_to_epoch(dt_start))
 
 
+def datetime_to_epoch_microseconds(dt):
+    '''Convert a naive UTC datetime to integer Unix epoch microseconds. This is lossless, unlike
+       float epoch seconds.'''
+    return datetime_to_epoch(dt) * 1000000 + dt.microsecond
+
+
+def epoch_microseconds_to_datetime(epoch_us):
+    '''Perform the inverse of datetime_to_epoch_microseconds().'''
+    return EPOCH + timedelta(microseconds=int(epoch_us))
+
+
+def datetimes_to_epoch_array(datetimes):
+    '''Convert a sequence of naive UTC datetimes to a numpy array of integer Unix epoch
+       microseconds.'''
+    return np.array([datetime_to_epoch_microseconds(dt) for dt in datetimes], dtype=np.int64)
+
+
+def epoch_array_to_datetimes(epoch_array):
+    '''Perform the inverse of datetimes_to_epoch_array().'''
+    return [epoch_microseconds_to_datetime(epoch_us) for epoch_us in epoch_array]
+
+
 def epoch_to_datetime(epoch_time):
     '''Convert a Unix epoch time to a datetime.'''
     return datetime.utcfromtimestamp(epoch_time)
@@ -278,6 +356,33 @@ def timeit(method):
     return timed
 
 
+class TimeLimitExceeded(Exception):
+    pass
+
+
+@contextmanager
+def time_limit(seconds):
+    '''Context manager which raises TimeLimitExceeded inside the block if it runs for longer than seconds. Only
+       enforced in the main thread of a process on platforms with interval timers, and not at all if seconds is
+       None or 0.
+    '''
+    if (not seconds or not hasattr(signal, 'setitimer') or
+            threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+
+    def raise_time_limit_exceeded(signum, frame):
+        raise TimeLimitExceeded('Exceeded the time limit of {} seconds'.format(seconds))
+
+    previous_handler = signal.signal(signal.SIGALRM, raise_time_limit_exceeded)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
 @metric_wrapper('estimate_runtime', value=lambda x: x.total_seconds() * 1000.0)
 def estimate_runtime(estimated_runtime, actual_runtime, backoff_rate=2.0, pad_percent=5.0):
     '''Estimate the next scheduler runtime given a previous estimate and actual.
@@ -0,0 +1,151 @@
+'''
+visibility_cache.py - A size bounded, instrumented in process cache of rise_set intervals.
+
+The rise_set intervals of every target the scheduler has seen are kept in process between
+scheduling runs, in front of the disk and redis caches. The VisibilityCache behaves like the
+dict it replaces, but keeps its entries in least recently used order and evicts the oldest
+rise_set intervals once they take up more than a maximum number of bytes. The span that the
+intervals of a horizon limited target cover is kept under its coverage key, and is evicted
+along with them. Evictions only happen at the end of a run, so every entry looked up during a
+run stays available until then.
+
+It also counts the hits and misses of each cache tier, the rise sets that had to be computed
+and the time spent computing them, and the lookups skipped because their resource could not be
+scheduled on, and sends these with its size as metrics after each run.
+'''
+import logging
+import sys
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from time_intervals.intervals import Intervals
+
+from adaptive_scheduler.utils import SendMetricMixin
+
+log = logging.getLogger(__name__)
+
+# The cache tiers whose lookups are counted, in the order they are consulted
+TIERS = ('local', 'disk', 'redis')
+
+
+def coverage_cache_key(cache_key):
+    '''Returns the key that the span covered by the rise_set intervals of cache_key is stored under.'''
+    return 'coverage_{}'.format(cache_key)
+
+
+def intervals_size_bytes(intervals):
+    '''Returns the approximate number of bytes of memory taken by an Intervals object's timepoints.'''
+    return sys.getsizeof(intervals.timepoints) + sum(sys.getsizeof(timepoint) + sys.getsizeof(timepoint['time'])
+                                                     for timepoint in intervals.timepoints)
+
+
+class VisibilityCache(MutableMapping, SendMetricMixin):
+    ''' A dict of rise_set Intervals by cache key, in least recently used order. Deleting or evicting Intervals also
+        deletes the span they cover. Any other values, such as the current semester, are kept outside the size limit
+        and are never evicted. A max_bytes of 0 means the cache is never trimmed.
+    '''
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self.size_bytes = 0
+        self.evictions = 0
+        self._reset_counters()
+
+    def _reset_counters(self):
+        self.hits = {tier: 0 for tier in TIERS}
+        self.misses = {tier: 0 for tier in TIERS}
+        self.computed = 0
+        self.compute_seconds = 0.0
+        self.skipped = 0
+
+    def __getitem__(self, key):
+        value = self._entries[key]
+        self._entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._discard_size(key)
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if isinstance(value, Intervals):
+            self._sizes[key] = intervals_size_bytes(value)
+            self.size_bytes += self._sizes[key]
+
+    def __delitem__(self, key):
+        del self._entries[key]
+        if key in self._sizes:
+            self._discard_size(key)
+            self._entries.pop(coverage_cache_key(key), None)
+
+    def __contains__(self, key):
+        # Checking for a key does not count as using it
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Iterating over the cache does not count as using its entries either, and must not reorder them
+    def items(self):
+        return self._entries.items()
+
+    def values(self):
+        return self._entries.values()
+
+    def _discard_size(self, key):
+        self.size_bytes -= self._sizes.pop(key, 0)
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.size_bytes = 0
+
+    def record_lookup(self, tier, hit):
+        if hit:
+            self.hits[tier] += 1
+        else:
+            self.misses[tier] += 1
+
+    def record_compute(self, count, seconds):
+        self.computed += count
+        self.compute_seconds += seconds
+
+    def record_skipped(self, count):
+        self.skipped += count
+
+    def trim(self):
+        '''Evicts the least recently used rise_set intervals until the cache is within its size limit.'''
+        if self.max_bytes <= 0 or self.size_bytes <= self.max_bytes:
+            return 0
+        evicted = 0
+        for key in list(self._entries.keys()):
+            if self.size_bytes <= self.max_bytes:
+                break
+            if key in self._sizes:
+                del self[key]
+                evicted += 1
+        self.evictions += evicted
+        log.info('Evicted {} rise sets from the local cache, which now holds {:.1f} MB'.format(
+            evicted, self.size_bytes / 2 ** 20))
+        return evicted
+
+    def finish_run(self):
+        '''Trims the cache to its size limit, then sends the metrics for this run and starts counting afresh.'''
+        evicted = self.trim()
+        for tier in TIERS:
+            self.send_metric('rise_set_cache.{}.hits'.format(tier), self.hits[tier])
+            self.send_metric('rise_set_cache.{}.misses'.format(tier), self.misses[tier])
+        lookups = self.hits['local'] + self.misses['local']
+        if lookups:
+            self.send_metric('rise_set_cache.local.hit_rate', self.hits['local'] / lookups)
+        self.send_metric('rise_set_cache.computed', self.computed)
+        self.send_metric('rise_set_cache.compute_seconds', self.compute_seconds)
+        self.send_metric('rise_set_cache.skipped', self.skipped)
+        self.send_metric('rise_set_cache.entries', len(self._sizes))
+        self.send_metric('rise_set_cache.size_bytes', self.size_bytes)
+        self.send_metric('rise_set_cache.evictions', evicted)
+        self._reset_counters()
@@ -0,0 +1,169 @@
+'''
+visibility_precompute.py - Background visibility precomputation for newly changed request groups.
+
+Between scheduling cycles the SchedulerRunner would otherwise sleep. The VisibilityPrecomputer uses
+that time to poll the observation portal's last_changed time, and when something has changed it
+fetches the schedulable request groups, keeps only those modified since the last check, and puts
+the rise_set intervals of their targets into the local, disk and redis caches. While request groups keep
+changing, the fetches back off so a busy portal isn't downloaded in full on every poll. The airmass samples
+of requests which are optimized for airmass are cached in redis too. When the next cycle picks up
+these request groups their visibility is then just a cache lookup.
+'''
+import logging
+import time
+from datetime import datetime, timedelta
+
+from dateutil.parser import parse
+
+from adaptive_scheduler.kernel_mappings import (construct_visibilities, fill_rise_set_cache, make_request_cache_key,
+                                                filter_on_scheduling_horizon, compute_request_availability,
+                                                AvailabilityContext, local_cache)
+from adaptive_scheduler.models import ModelBuilder, cache_airmasses_for_requests
+from adaptive_scheduler.monitoring.seeing import DummySeeingMonitor
+from adaptive_scheduler.scheduler_input import SchedulingInputUtils
+from adaptive_scheduler.utils import OptimizationType
+
+log = logging.getLogger(__name__)
+
+
+def modified_since(json_request_group, checked_time):
+    '''Returns True if the request group was modified after checked_time, or if its modified time is unknown.'''
+    if not json_request_group.get('modified'):
+        return True
+    return parse(json_request_group['modified']).replace(tzinfo=None) > checked_time
+
+
+class VisibilityPrecomputer(object):
+    ''' Precomputes the visibility of request groups which have changed since the last check, while the scheduler
+        is waiting for its next cycle. The last_changed check used to decide whether to reschedule is left untouched,
+        so the next cycle still sees every change. Given the runner's SchedulingInputFactory, its proposal cache and
+        request group model cache are shared with the scheduling cycles.
+    '''
+
+    def __init__(self, network_interface, network_model, sched_params, rise_set_pool=None, poll_seconds=30.0,
+                 input_factory=None, max_backoff_seconds=600.0):
+        self.network_interface = network_interface
+        self.network_model = network_model
+        self.sched_params = sched_params
+        self.rise_set_pool = rise_set_pool
+        self.poll_seconds = poll_seconds
+        self.input_factory = input_factory
+        self.max_backoff_seconds = max_backoff_seconds
+        self.last_checked = None
+        self._visibilities = {}
+        self._fetch_interval = poll_seconds
+        self._next_fetch = None
+
+    def mark_checked(self, checked_time):
+        '''Records that every request group modified before checked_time has already been through a cycle.'''
+        self.last_checked = checked_time
+        self._fetch_interval = self.poll_seconds
+        self._next_fetch = None
+
+    def run_until(self, deadline, semester_details):
+        ''' Polls for changed request groups and precomputes their visibility until the time.monotonic() deadline.
+            Failures are logged and only delay the precomputation until the next poll.
+        '''
+        while True:
+            try:
+                self.precompute_changes(semester_details)
+            except Exception as e:
+                log.warning('Failed to precompute the visibility of changed request groups: {}'.format(repr(e)))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(self.poll_seconds, remaining))
+
+    def get_changed_request_groups(self, now, semester_details):
+        ''' Returns the json request groups within the scheduling horizon which were modified since the last check.
+            Each fetch that follows another without a quiet poll in between waits twice as long as the one before,
+            up to max_backoff_seconds. Changes seen while backing off are picked up by the next fetch.
+        '''
+        observation_portal_interface = self.network_interface.observation_portal_interface
+        last_changed = observation_portal_interface.get_last_changed(self.sched_params.telescope_classes)
+        if last_changed <= self.last_checked:
+            self._fetch_interval = self.poll_seconds
+            self._next_fetch = None
+            return []
+        fetch_time = time.monotonic()
+        if self._next_fetch is not None and fetch_time < self._next_fetch:
+            return []
+        self._next_fetch = fetch_time + self._fetch_interval
+        self._fetch_interval = min(self._fetch_interval * 2, self.max_backoff_seconds)
+        json_rgs = self.network_interface.get_all_request_groups(
+            semester_details['start'], min(now + timedelta(days=self.sched_params.horizon_days),
+                                           semester_details['end']),
+            self.sched_params.telescope_classes)
+        # The schedulable requests endpoint can't filter by modified time, so it is done here
+        changed = [json_rg for json_rg in json_rgs if modified_since(json_rg, self.last_checked)]
+        self.last_checked = now
+        return changed
+
+    def get_visibilities(self, semester_details):
+        semester_key = (semester_details['start'], semester_details['end'])
+        if semester_key not in self._visibilities:
+            self._visibilities = {semester_key: construct_visibilities(self.network_model, semester_details['start'],
+                                                                       semester_details['end'])}
+        return self._visibilities[semester_key]
+
+    def get_model_builder(self):
+        ''' Returns the model builder of the runner's last scheduling cycle, so proposals already fetched aren't
+            fetched again.
+        '''
+        if self.input_factory is None:
+            return ModelBuilder(self.network_interface.observation_portal_interface,
+                                self.network_interface.configdb_interface)
+        if self.input_factory.model_builder is None:
+            return self.input_factory.input_provider.get_model_builder()
+        return self.input_factory.model_builder
+
+    def precompute_changes(self, semester_details):
+        ''' Caches the rise_set intervals, and airmasses where needed, of the request groups changed since the last
+            check. Returns the number of request groups that were precomputed.
+        '''
+        if self.last_checked is None or semester_details is None:
+            return 0
+        now = datetime.utcnow()
+        json_rgs = self.get_changed_request_groups(now, semester_details)
+        if not json_rgs:
+            return 0
+        model_cache = self.input_factory.model_cache if self.input_factory is not None else None
+        rgs = SchedulingInputUtils(self.get_model_builder()).json_rgs_to_scheduler_model_rgs(
+            json_rgs, ignore_ipp=self.sched_params.ignore_ipp, model_cache=model_cache, partial=True)[0]
+        rgs = filter_on_scheduling_horizon(rgs, now + timedelta(days=self.sched_params.horizon_days))
+        if not rgs:
+            return 0
+        log.info('Precomputing the visibility of {} changed request groups'.format(len(rgs)))
+        # Unbound orbits are only computed over a single request's windows, which change every cycle
+        retry_later = fill_rise_set_cache(rgs, self.get_visibilities(semester_details), semester_details['start'],
+                                          semester_details['end'], self.rise_set_pool, include_unbound_orbits=False)
+        try:
+            self.cache_airmasses(rgs, now, semester_details['start'])
+        finally:
+            for cache_key in retry_later:
+                local_cache.pop(cache_key, None)
+        return len(rgs)
+
+    def cache_airmasses(self, rgs, now, semester_start):
+        ''' Caches the airmass samples of requests optimized for airmass, over their windows intersected with the
+            target's visibility. Downtime and seeing are ignored, so the cached samples may cover more than is used.
+        '''
+        availability_context = AvailabilityContext({}, DummySeeingMonitor(), now)
+        requests = []
+        for rg in rgs:
+            for request in rg.requests:
+                if request.optimization_type != OptimizationType.AIRMASS:
+                    continue
+                intervals_by_resource = {}
+                for resource in request.windows.windows_for_resource:
+                    cache_keys = [make_request_cache_key(request, conf, resource) for conf in request.configurations]
+                    if not all(cache_key in local_cache for cache_key in cache_keys):
+                        break
+                    intervals_by_resource[resource] = local_cache[cache_keys[0]].intersect(
+                        [local_cache[cache_key] for cache_key in cache_keys[1:]])
+                else:
+                    compute_request_availability(request, intervals_by_resource, {}, None, now,
+                                                 availability_context=availability_context)
+                    if request.has_windows():
+                        requests.append(request)
+        cache_airmasses_for_requests(requests, self.network_model, semester_start)
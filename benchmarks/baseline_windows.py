@@ -0,0 +1,66 @@
+'''
+baseline_windows.py - The window model as it was before windows were stored as shared epoch arrays.
+
+Kept only as the baseline the benchmarks compare against. Every window is parsed with strptime, and a
+Window object holding two datetimes is made for each window on each telescope.
+'''
+from datetime import datetime
+
+from time_intervals.intervals import Intervals
+
+from adaptive_scheduler.utils import normalise_datetime_intervals
+
+
+def iso_string_to_datetime(iso_string):
+    date_format = '%Y-%m-%dT%H:%M:%SZ'
+    try:
+        d = datetime.strptime(iso_string, date_format)
+    except ValueError:
+        format_milli = '%Y-%m-%dT%H:%M:%S.%fZ'
+        d = datetime.strptime(iso_string, format_milli)
+    return d
+
+
+class Window(object):
+
+    def __init__(self, window_dict, resource):
+        try:
+            self.start = iso_string_to_datetime(window_dict['start'])
+            self.end = iso_string_to_datetime(window_dict['end'])
+        except TypeError:
+            self.start = window_dict['start']
+            self.end = window_dict['end']
+
+        self.resource = resource
+
+    def get_resource_name(self):
+        return self.resource
+
+
+class Windows(object):
+
+    def __init__(self):
+        self.windows_for_resource = {}
+
+    def append(self, window):
+        if window.get_resource_name() in self.windows_for_resource:
+            self.windows_for_resource[window.get_resource_name()].append(window)
+        else:
+            self.windows_for_resource[window.get_resource_name()] = [window]
+
+    def to_kernel_intervals(self, semester_start):
+        window_dict = {}
+        for resource_name, windows in self.windows_for_resource.items():
+            intervals = Intervals([(window.start, window.end) for window in windows])
+            window_dict[resource_name] = normalise_datetime_intervals(intervals, semester_start)
+        return window_dict
+
+
+def build_windows(window_dicts, telescopes):
+    '''Builds the windows of a request on each telescope the way ModelBuilder.build_request used to.'''
+    windows = Windows()
+    for telescope in telescopes:
+        for window_dict in window_dicts:
+            window = Window(window_dict=window_dict, resource=telescope)
+            windows.append(window)
+    return windows
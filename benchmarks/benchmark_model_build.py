@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+'''
+benchmark_model_build.py - Measures the time taken to build the model of a request with windows on many telescopes.
+
+Builds synthetic requests with the ModelBuilder, then compares building their windows the way build_request used
+to, parsing every window with strptime and making a Window for each telescope, with the shared window bounds built
+now. Each measurement gets a fresh ModelBuilder, so none of them starts with the window times already parsed.
+
+    python benchmarks/benchmark_model_build.py --requests 5000 --telescopes 20 --windows 4
+'''
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from adaptive_scheduler.models import ModelBuilder, Proposal, Windows
+
+import baseline_windows
+
+START = datetime(2021, 1, 1)
+
+
+class TelescopeResolver(object):
+    '''Stands in for the ConfigDBInterface, resolving every request to the same telescopes.'''
+
+    def __init__(self, telescopes):
+        self.telescopes = telescopes
+
+    def get_telescopes_for_instruments(self, instrument_types_to_requirements, location, is_staff=False):
+        return set(self.telescopes)
+
+
+def make_request_dicts(num_requests, num_windows):
+    request_dicts = []
+    for index in range(num_requests):
+        windows = []
+        for window_index in range(num_windows):
+            start = START + timedelta(days=window_index * 2, minutes=index % 1440)
+            windows.append({'start': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                            'end': (start + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ')})
+        request_dicts.append({
+            'id': index, 'state': 'PENDING', 'duration': 600, 'location': {'telescope_class': '1m0'},
+            'windows': windows,
+            'configurations': [{
+                'id': index, 'type': 'EXPOSE', 'instrument_type': '1M0-SCICAM-SINISTRO', 'priority': 1,
+                'instrument_configs': [{'optical_elements': {'filter': 'V'}}], 'acquisition_config': {},
+                'guiding_config': {'optical_elements': {}}, 'constraints': {}, 'extra_params': {},
+                'target': {'type': 'ICRS', 'name': 'target', 'ra': index % 360, 'dec': 20.0, 'epoch': 2000},
+            }],
+        })
+    return request_dicts
+
+
+def shared_windows(model_builder, request_dict, telescopes):
+    window_bounds = model_builder.build_window_bounds(request_dict['windows'])
+    windows = Windows()
+    for telescope in telescopes:
+        windows.set_bounds(telescope, window_bounds)
+    return windows
+
+
+def time_per_request(function, request_dicts):
+    start = time.perf_counter()
+    for request_dict in request_dicts:
+        function(request_dict)
+    return (time.perf_counter() - start) / len(request_dicts) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--telescopes', type=int, default=20)
+    parser.add_argument('--windows', type=int, default=4)
+    args = parser.parse_args()
+
+    telescopes = ['1m0a.doma.site{}'.format(index) for index in range(args.telescopes)]
+    request_dicts = make_request_dicts(args.requests, args.windows)
+
+    def make_model_builder():
+        return ModelBuilder(None, TelescopeResolver(telescopes), proposals_by_id={'prop': Proposal(id='prop')})
+
+    baseline_us = time_per_request(
+        lambda request_dict: baseline_windows.build_windows(request_dict['windows'], telescopes), request_dicts)
+    model_builder = make_model_builder()
+    shared_us = time_per_request(lambda request_dict: shared_windows(model_builder, request_dict, telescopes),
+                                 request_dicts)
+    build_us = time_per_request(make_model_builder().build_request, request_dicts)
+
+    print('{} requests with {} windows on {} telescopes'.format(args.requests, args.windows, args.telescopes))
+    print('  baseline windows per telescope: {:.1f} us/request'.format(baseline_us))
+    print('  shared window bounds:           {:.1f} us/request'.format(shared_us))
+    print('  build_request:                  {:.1f} us/request'.format(build_us))
+
+if __name__ == '__main__':
+    main()
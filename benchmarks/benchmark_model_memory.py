@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+'''
+benchmark_model_memory.py - Measures the memory taken by the windows of a large set of request groups.
+
+Builds synthetic request groups with windows on every telescope, and reports the memory allocated for their
+windows and the time taken to convert them into kernel intervals. The same window dicts are built into both the
+old layout, a Window object for each window on each telescope, and the per-resource epoch arrays used now.
+
+    python benchmarks/benchmark_model_memory.py --request-groups 20000 --telescopes 20 --windows 4
+'''
+import argparse
+import gc
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from adaptive_scheduler.models import Window, Windows
+
+import baseline_windows
+
+START = datetime(2021, 1, 1)
+
+
+def make_telescopes(num_telescopes):
+    return ['{}m0a.doma.site{}'.format(i % 3, i) for i in range(num_telescopes)]
+
+
+def make_window_dicts(num_request_groups, num_windows):
+    all_window_dicts = []
+    for index in range(num_request_groups):
+        window_dicts = []
+        for window_index in range(num_windows):
+            start = START + timedelta(days=window_index * 2, minutes=index % 1440)
+            window_dicts.append({'start': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                 'end': (start + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ')})
+        all_window_dicts.append(window_dicts)
+    return all_window_dicts
+
+
+def make_windows(window_dicts, telescopes):
+    windows = Windows()
+    for telescope in telescopes:
+        windows.windows_for_resource[telescope] = [Window(window_dict, telescope) for window_dict in window_dicts]
+    return windows
+
+
+def measure(build_windows, all_window_dicts, telescopes):
+    '''Returns the bytes allocated for the windows built from every request group's window dicts, and the seconds
+       taken to convert them into kernel intervals.'''
+    gc.collect()
+    tracemalloc.start()
+    all_windows = [build_windows(window_dicts, telescopes) for window_dicts in all_window_dicts]
+    gc.collect()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for windows in all_windows:
+        windows.to_kernel_intervals(START)
+    return allocated, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--request-groups', type=int, default=20000)
+    parser.add_argument('--telescopes', type=int, default=20)
+    parser.add_argument('--windows', type=int, default=4)
+    args = parser.parse_args()
+
+    telescopes = make_telescopes(args.telescopes)
+    all_window_dicts = make_window_dicts(args.request_groups, args.windows)
+    num_windows = args.request_groups * len(telescopes) * args.windows
+    print('{} request groups with {} windows on {} telescopes'.format(args.request_groups, args.windows,
+                                                                      args.telescopes))
+    for name, build_windows in (('baseline Window objects', baseline_windows.build_windows),
+                                ('epoch arrays', make_windows)):
+        allocated, kernel_seconds = measure(build_windows, all_window_dicts, telescopes)
+        print('  {}:'.format(name))
+        print('    windows memory:      {:.1f} MB'.format(allocated / 2 ** 20))
+        print('    bytes per window:    {:.0f}'.format(allocated / num_windows))
+        print('    to_kernel_intervals: {:.2f}s'.format(kernel_seconds))
+
+
+if __name__ == '__main__':
+    main()
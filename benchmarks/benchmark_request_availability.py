@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+benchmark_request_availability.py - Times the downtime and seeing filter of compute_request_availability.
+
+Compares building the blocked downtime and seeing intervals separately for every request, which is what
+happens without an AvailabilityContext, against sharing a single AvailabilityContext over the whole run.
+
+    python benchmarks/benchmark_request_availability.py --requests 20000 --telescopes 20
+'''
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from mock import Mock
+from time_intervals.intervals import Intervals
+
+from adaptive_scheduler.kernel_mappings import AvailabilityContext, compute_request_availability
+from adaptive_scheduler.models import Request, Configuration, Window, Windows
+
+START = datetime(2021, 1, 1)
+END = START + timedelta(days=7)
+INSTRUMENT_TYPES = ['1M0-SCICAM-SINISTRO', '2M0-FLOYDS-SCICAM', '0M4-SCICAM-SBIG']
+
+
+def make_telescopes(num_telescopes):
+    return ['{}m0a.doma.site{}'.format(i % 3, i) for i in range(num_telescopes)]
+
+
+def make_downtime_and_seeing(telescopes):
+    downtime_intervals = {}
+    seeing_by_resource = {}
+    for index, telescope in enumerate(telescopes):
+        # A few hours of downtime each night, and a shorter instrument specific downtime
+        downtime_intervals[telescope] = {
+            'all': [(START + timedelta(days=day, hours=index % 12), START + timedelta(days=day, hours=index % 12 + 3))
+                    for day in range(7)],
+            INSTRUMENT_TYPES[index % len(INSTRUMENT_TYPES)]: [(START + timedelta(days=3),
+                                                               START + timedelta(days=3, hours=8))]
+        }
+        seeing_by_resource[telescope] = {'time': START, 'seeing': 1.0 + index % 3}
+    seeing_monitor = Mock()
+    seeing_monitor.seeing_valid_time_period = 60.0
+    seeing_monitor.retrieve_data = Mock(return_value=seeing_by_resource)
+    return downtime_intervals, seeing_monitor
+
+
+def make_requests(num_requests, telescopes):
+    requests = []
+    for index in range(num_requests):
+        configuration = Configuration(
+            id=index, target=None, type='EXPOSE', instrument_type=INSTRUMENT_TYPES[index % len(INSTRUMENT_TYPES)],
+            priority=1, instrument_configs=[], acquisition_config={}, guiding_config={},
+            constraints={'max_airmass': 2.0, 'min_lunar_distance': 30.0, 'max_seeing': 1.5 + index % 2}
+        )
+        windows = Windows()
+        for telescope in telescopes:
+            windows.append(Window({'start': START, 'end': END}, telescope))
+        requests.append(Request(configurations=[configuration], windows=windows, request_id=index, duration=600))
+    return requests
+
+
+def make_target_intervals(telescopes):
+    nights = [(START + timedelta(days=day, hours=1), START + timedelta(days=day, hours=11)) for day in range(7)]
+    return {telescope: Intervals(nights) for telescope in telescopes}
+
+
+def time_availability(requests, target_intervals, downtime_intervals, seeing_monitor, share_context):
+    context = None
+    if share_context:
+        context = AvailabilityContext(downtime_intervals, seeing_monitor, START)
+    start = time.perf_counter()
+    for request in requests:
+        compute_request_availability(request, target_intervals, downtime_intervals, seeing_monitor, START,
+                                     availability_context=context)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--telescopes', type=int, default=20)
+    args = parser.parse_args()
+
+    telescopes = make_telescopes(args.telescopes)
+    downtime_intervals, seeing_monitor = make_downtime_and_seeing(telescopes)
+    target_intervals = make_target_intervals(telescopes)
+
+    timings = {}
+    for share_context in (False, True):
+        requests = make_requests(args.requests, telescopes)
+        timings[share_context] = time_availability(requests, target_intervals, downtime_intervals, seeing_monitor,
+                                                   share_context)
+
+    print('{} requests on {} telescopes'.format(args.requests, args.telescopes))
+    print('  blocked intervals built per request: {:.2f}s'.format(timings[False]))
+    print('  shared availability context:         {:.2f}s'.format(timings[True]))
+    print('  speedup:                             {:.1f}x'.format(timings[False] / timings[True]))
+
+
+if __name__ == '__main__':
+    main()
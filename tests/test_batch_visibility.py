@@ -0,0 +1,122 @@
+#!/usr/bin/python
+from __future__ import division
+
+from adaptive_scheduler.batch_visibility import SiderealVisibilityBatch
+from adaptive_scheduler.site_ephemeris import clear_site_ephemeris_cache
+from adaptive_scheduler.kernel_mappings import (construct_visibilities, get_rise_set_timepoint_intervals,
+                                                make_cache_key, compute_sidereal_rise_sets_in_batch, local_cache)
+from adaptive_scheduler.models import ICRSTarget
+from adaptive_scheduler.utils import rise_set_target_fingerprint
+from rise_set.angle import Angle
+from time_intervals.intervals import Intervals
+from datetime import datetime
+
+from mock import patch
+import pytest
+
+
+class TestSiderealVisibilityBatch(object):
+
+    def setup(self):
+        clear_site_ephemeris_cache()
+        self.start = datetime(2011, 11, 1, 0, 0, 0)
+        self.end = datetime(2011, 11, 8, 0, 0, 0)
+        self.tels = {
+            '1m0a.doma.bpl': dict(name='1m0a.doma.bpl', tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                  horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0, zenith_blind_spot=0.0),
+            '1m0a.doma.lsc': dict(name='1m0a.doma.lsc', tel_class='1m0', latitude=-30.1673833333,
+                                  longitude=-70.8047888889, horizon=15, ha_limit_neg=-4.6, ha_limit_pos=4.6,
+                                  zenith_blind_spot=0.0)
+        }
+        self.visibilities = construct_visibilities(self.tels, self.start, self.end)
+        self.targets = [ICRSTarget(ra=ra, dec=dec).in_rise_set_format()
+                        for ra, dec in [(310.35795833333333, 45.280338888888885), (0.0, 0.0), (300.0, -20.0),
+                                        (83.8, -5.4), (150.0, -75.0)]]
+
+    def teardown(self):
+        clear_site_ephemeris_cache()
+
+    def _difference_in_seconds(self, received, expected):
+        received, expected = Intervals(received), Intervals(expected)
+        difference = [received.subtract(expected).get_total_time(), expected.subtract(received).get_total_time()]
+        return sum(d.total_seconds() if hasattr(d, 'total_seconds') else d for d in difference)
+
+    @pytest.mark.parametrize('resource', ['1m0a.doma.bpl', '1m0a.doma.lsc'])
+    @pytest.mark.parametrize('airmass', [None, 1.6])
+    def test_intervals_match_rise_set(self, resource, airmass):
+        visibility = self.visibilities[resource]
+        results = SiderealVisibilityBatch(visibility).get_intervals(self.targets, airmass)
+
+        assert len(results) == len(self.targets)
+        for target, (up_intervals, ha_intervals) in zip(self.targets, results):
+            expected_up = visibility.get_target_intervals(target, up=True, airmass=airmass)
+            expected_ha = visibility.get_ha_intervals(target)
+            # rise_set works a day at a time and can clip an interval at midnight, a few minutes short of the
+            # true set time, so allow a few minutes of difference over the week
+            assert self._difference_in_seconds(up_intervals, expected_up) < 600
+            assert self._difference_in_seconds(ha_intervals, expected_ha) < 60
+
+    def test_moon_distance_matches_rise_set(self):
+        visibility = self.visibilities['1m0a.doma.bpl']
+        results = SiderealVisibilityBatch(visibility).get_intervals(self.targets, None, 30.0)
+
+        for target, (up_intervals, _) in zip(self.targets, results):
+            expected = visibility.get_moon_distance_intervals(target, visibility.get_target_intervals(target),
+                                                              Angle(degrees=30.0))
+            # Chunks close to the limit may fall either side of it, as the chunks start from slightly different
+            # rise times
+            assert self._difference_in_seconds(up_intervals, expected) < 2 * 1800
+
+    def test_targets_are_evaluated_in_batches(self):
+        visibility = self.visibilities['1m0a.doma.bpl']
+        with patch('adaptive_scheduler.batch_visibility.BATCH_SIZE', 2):
+            results = SiderealVisibilityBatch(visibility).get_intervals(self.targets)
+
+        assert results == SiderealVisibilityBatch(visibility).get_intervals(self.targets)
+
+    def test_precomputed_intervals_are_not_recomputed(self):
+        visibility = self.visibilities['1m0a.doma.bpl']
+        target = self.targets[0]
+        up_intervals, ha_intervals = SiderealVisibilityBatch(visibility).get_intervals([target], None, 30.0)[0]
+        # The visibility memoizes its dark intervals, which are found from the sun's target intervals
+        visibility.get_dark_intervals()
+
+        with patch.object(visibility, 'get_target_intervals') as mock_target_intervals, \
+                patch.object(visibility, 'get_ha_intervals') as mock_ha_intervals:
+            intervals = get_rise_set_timepoint_intervals(target, visibility, None, 30.0, 1.0,
+                                                         up_intervals=up_intervals, ha_intervals=ha_intervals)
+
+        mock_target_intervals.assert_not_called()
+        mock_ha_intervals.assert_not_called()
+        expected = get_rise_set_timepoint_intervals(target, visibility, None, 30.0, 1.0)
+        assert self._difference_in_seconds(intervals.toTupleList(), expected.toTupleList()) < 2 * 1800
+
+    def test_only_semester_long_sidereal_targets_are_batched(self):
+        resource = '1m0a.doma.bpl'
+        visibility = self.visibilities[resource]
+        sidereal_target = self.targets[0]
+        request_target = dict(self.targets[1], request_id=5)
+        to_compute = {}
+        for target in [sidereal_target, request_target]:
+            cache_key = make_cache_key(resource, rise_set_target_fingerprint(target), None, 30.0, 1.0)
+            to_compute[cache_key] = (resource, target, visibility, None, 30.0, 1.0)
+        sidereal_key, request_key = list(to_compute.keys())
+
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance') as mock_redis:
+            remaining = compute_sidereal_rise_sets_in_batch(to_compute)
+
+        assert list(remaining.keys()) == [request_key]
+        assert isinstance(local_cache.pop(sidereal_key), Intervals)
+        assert request_key not in local_cache
+        mock_redis.set.assert_called_once()
+
+    def test_failed_batch_is_left_for_the_pool(self):
+        resource = '1m0a.doma.bpl'
+        cache_key = make_cache_key(resource, rise_set_target_fingerprint(self.targets[0]), None, 0, 1.0)
+        to_compute = {cache_key: (resource, self.targets[0], self.visibilities[resource], None, 0, 1.0)}
+
+        with patch('adaptive_scheduler.kernel_mappings.SiderealVisibilityBatch', side_effect=ValueError('bad site')):
+            remaining = compute_sidereal_rise_sets_in_batch(to_compute)
+
+        assert remaining == to_compute
+        assert cache_key not in local_cache
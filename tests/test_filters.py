@@ -2,10 +2,10 @@
 
 from __future__ import division
 
-from mock import patch, Mock
+from mock import patch, Mock, PropertyMock
 from datetime import datetime, timedelta
 
-from adaptive_scheduler.models import (RequestGroup, Request, Windows)
+from adaptive_scheduler.models import (RequestGroup, Request, Window, Windows)
 
 from . import helpers
 
@@ -20,6 +20,7 @@ from adaptive_scheduler.request_filters import (
     filter_on_type,
     drop_empty_requests,
     filter_on_pending,
+    filter_on_expiry,
     run_all_filters,
 )
 
@@ -662,3 +663,89 @@ class TestWindowFilters(object):
                 assert 0 == r.windows.size()
             if r.id == 6:
                 assert 2 == r.windows.size()
+
+
+class TestWindowTable(object):
+    '''The columnar filters of run_all_filters must match running the window filters one after another.'''
+
+    def setup(self):
+        self.current_time = datetime(2013, 2, 27)
+        adaptive_scheduler.request_filters.now = self.current_time
+
+    def _make_request(self, request_id, windows_by_resource, state='PENDING', duration=3600):
+        windows = Windows()
+        for resource_name, window_times in windows_by_resource.items():
+            for start, end in window_times:
+                windows.append(Window({'start': start, 'end': end}, resource_name))
+        return Request(configurations=[], windows=windows, request_id=request_id, duration=duration, state=state)
+
+    def _make_request_groups(self):
+        day = timedelta(days=1)
+        now = self.current_time
+        many_windows = {
+            'Martin': [(now - 3 * day, now - 2 * day), (now - day, now + day / 2), (now + day, now + day),
+                       (now + day, now + day + timedelta(minutes=30))],
+            'Eric': [(now + 10 * day, now + 12 * day), (now + 13 * day, now + 14 * day), (now + 2 * day, now + 3 * day)],
+        }
+        rgs = [
+            RequestGroup(operator='many', requests=[self._make_request(5, many_windows),
+                                                    self._make_request(6, many_windows),
+                                                    self._make_request(7, many_windows, state='COMPLETED')],
+                         proposal=None, expires=now + 11 * day, rg_id=1, is_staff=False, name=None, ipp_value=1.0,
+                         observation_type='NORMAL', submitter=''),
+            RequestGroup(operator='single', requests=[self._make_request(8, many_windows)], proposal=None,
+                         expires=now - day, rg_id=2, is_staff=False, name=None, ipp_value=1.0,
+                         observation_type='NORMAL', submitter=''),
+            RequestGroup(operator='and', requests=[self._make_request(9, many_windows),
+                                                   self._make_request(10, {'Martin': [(now - 3 * day, now - day)]})],
+                         proposal=None, expires=now + 20 * day, rg_id=3, is_staff=False, name=None, ipp_value=1.0,
+                         observation_type='NORMAL', submitter=''),
+        ]
+        return rgs
+
+    def _run_filters_one_by_one(self, rg_list, running_request_ids):
+        rg_list = filter_out_windows_for_running_requests(rg_list, running_request_ids)
+        rg_list = filter_on_pending(rg_list)
+        rg_list = filter_on_expiry(rg_list)
+        rg_list = filter_out_past_windows(rg_list)
+        rg_list = truncate_lower_crossing_windows(rg_list)
+        rg_list = truncate_upper_crossing_windows(rg_list)
+        rg_list = filter_out_future_windows(rg_list)
+        rg_list = filter_on_duration(rg_list)
+        return filter_on_type(rg_list, running_request_ids)
+
+    def _filter(self, filter_fn):
+        running_request_ids = [6]
+        with patch.object(RequestGroup, 'expires', create=True, new=None), \
+                patch.object(RequestGroup, 'emit_rg_feedback', autospec=True) as mock_feedback:
+            rg_list = filter_fn(self._make_request_groups(), running_request_ids)
+        feedback = [(call[0][0].id, call[0][1], call[0][2]) for call in mock_feedback.call_args_list]
+        windows = {(rg.id, request.id, resource_name): [(window.start, window.end) for window in window_list]
+                   for rg in rg_list for request in rg.requests
+                   for resource_name, window_list in request.windows.windows_for_resource.items()}
+        return windows, feedback
+
+    def test_columnar_filters_match_the_window_filters(self):
+        expected_windows, expected_feedback = self._filter(self._run_filters_one_by_one)
+        windows, feedback = self._filter(run_all_filters)
+
+        assert windows == expected_windows
+        assert feedback == expected_feedback
+        now = self.current_time
+        assert windows[(1, 5, 'Martin')] == [(now, now + timedelta(hours=12))]
+        assert windows[(1, 5, 'Eric')] == [(now + timedelta(days=10), now + timedelta(days=11)),
+                                           (now + timedelta(days=2), now + timedelta(days=3))]
+        assert windows[(1, 6, 'Martin')] == []
+        assert {tag for _, _, tag in feedback} == {
+            'RequestIsRunning', 'RequestGroupExpired', 'WindowInPast', 'WindowTruncatedLower', 'WindowTruncatedUpper',
+            'WindowBeyondHorizon', 'WindowTooSmall', 'RequestGroupImpossible'}
+
+    def test_request_values_are_read_once_when_the_table_is_built(self):
+        rg_list = self._make_request_groups()
+        with patch.object(Request, 'duration', new_callable=PropertyMock, return_value=3600) as mock_duration, \
+                patch.object(RequestGroup, 'emit_rg_feedback', autospec=True) as mock_feedback:
+            run_all_filters(rg_list, [6])
+
+        assert mock_duration.call_count == sum(len(rg.requests) for rg in self._make_request_groups())
+        too_small = [call[0][1] for call in mock_feedback.call_args_list if call[0][2] == 'WindowTooSmall']
+        assert too_small and all(msg.endswith("too small for duration '1:00:00'") for msg in too_small)
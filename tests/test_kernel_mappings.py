@@ -2,8 +2,13 @@
 from __future__ import division
 
 import copy
+import pickle
+import threading
+import time
+from multiprocessing import get_context
+from multiprocessing.managers import BaseManager
 
-from adaptive_scheduler.models import (ICRSTarget, Request, Proposal,
+from adaptive_scheduler.models import (ICRSTarget, OrbitalElementsTarget, Request, Proposal,
                                        RequestGroup, Window, Windows, Configuration)
 from adaptive_scheduler.monitoring.seeing import DummySeeingMonitor
 from adaptive_scheduler.utils import (datetime_to_epoch, normalise_datetime_intervals,
@@ -16,13 +21,57 @@ from adaptive_scheduler.kernel_mappings import (construct_visibilities,
                                                 filter_on_scheduling_horizon,
                                                 compute_request_availability,
                                                 get_rise_set_timepoint_intervals,
-                                                make_cache_key)
+                                                make_cache_key, make_request_cache_key,
+                                                AvailabilityContext,
+                                                update_cached_semester, save_to_redis_cache,
+                                                get_from_redis_cache, redis_cache_key, semester_cache_name,
+                                                fill_rise_set_cache, coverage_redis_key, span_cache_key,
+                                                lease_redis_key, acquire_rise_set_leases, release_rise_set_leases,
+                                                wait_for_rise_set_leases, renew_rise_set_leases, RiseSetLeaseRenewer,
+                                                filter_on_resource_availability, filter_on_visibility,
+                                                RiseSetTimedOut, local_cache)
+from adaptive_scheduler.rise_set_pool import init_worker, compute_rise_set_in_worker
 from datetime import datetime, timedelta
 
-from mock import Mock
+from mock import Mock, patch
+import fakeredis
 import pytest
 
 
+class FakeRedisManager(BaseManager):
+    pass
+
+
+# Serves a single fakeredis to several scheduler processes
+FakeRedisManager.register('FakeStrictRedis', fakeredis.FakeStrictRedis)
+
+
+class SharedFakeRedis(object):
+    '''A client of the fakeredis served by a FakeRedisManager, whose pipelines send their commands one at a time.'''
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def __getattr__(self, name):
+        return getattr(self._proxy, name)
+
+    def pipeline(self, transaction=True):
+        return SharedFakeRedisPipeline(self._proxy)
+
+
+class SharedFakeRedisPipeline(object):
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self._commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self._proxy, name)(*args, **kwargs) for name, args, kwargs in self._commands]
+
+
 class TestKernelMappings(object):
 
     def setup(self):
@@ -183,10 +232,23 @@ class TestKernelMappings(object):
         min_lunar_distance = 30.0
         max_lunar_phase = 0.75
         resource = '1m0a.doma.lsc'
-        rs_target = self.make_constrained_request().configurations[0].target.in_rise_set_format()
+        target_fingerprint = self.make_constrained_request().configurations[0].target.get_rise_set_fingerprint()
+
+        assert (make_cache_key(resource, target_fingerprint, max_airmass, min_lunar_distance, max_lunar_phase) ==
+                '{}_2.5_30_0.75_{}'.format(resource, target_fingerprint))
+        # Equal constraint values give the same key whatever their type
+        assert (make_cache_key(resource, target_fingerprint, 2.5, 30, 0.75) ==
+                make_cache_key(resource, target_fingerprint, max_airmass, min_lunar_distance, max_lunar_phase))
 
-        assert (make_cache_key(resource, rs_target, max_airmass, min_lunar_distance, max_lunar_phase) ==
-                     '{}_{}_{}_{}_{}'.format(resource, max_airmass, min_lunar_distance, max_lunar_phase, repr(sorted(rs_target.items()))))
+    def test_make_request_cache_key_includes_request_id_for_unbound_orbits(self):
+        request = self.make_constrained_request()
+        configuration = request.configurations[0]
+        cache_key = make_request_cache_key(request, configuration, '1m0a.doma.lsc')
+        assert cache_key.endswith(configuration.target.get_rise_set_fingerprint())
+
+        configuration.target = Mock(has_unbound_orbit=Mock(return_value=True),
+                                    get_rise_set_fingerprint=Mock(return_value='abc'))
+        assert make_request_cache_key(request, configuration, '1m0a.doma.lsc').endswith('abc_{}'.format(request.id))
 
     def test_compute_request_availability_lunar_phase_removes_window(self):
         request = self.make_constrained_request(max_lunar_phase=1.0)
@@ -284,6 +346,43 @@ class TestKernelMappings(object):
         assert len(base_windows[resource]) == 2
         assert request.windows.size() == 2
 
+    def test_unavailable_resources_are_dropped_before_looking_up_rise_sets(self):
+        request = self.make_constrained_request()
+        for resource in ['1m0a.doma.elp', '1m0a.doma.ogg']:
+            request.windows.append(Window({'start': datetime(2011, 11, 1, 6), 'end': datetime(2011, 11, 2, 6)},
+                                          resource))
+        downtime_intervals = {'1m0a.doma.bpl': {'all': [(datetime(2011, 11, 1, 5), datetime(2011, 11, 1, 8))]},
+                              '1m0a.doma.ogg': {'all': [(datetime(2011, 11, 1), datetime(2011, 11, 3))]}}
+        context = AvailabilityContext(downtime_intervals, self.seeing_monitor, self.start)
+
+        skipped = filter_on_resource_availability([self.make_request_group([request])],
+                                                  ['1m0a.doma.bpl', '1m0a.doma.ogg'], context)
+
+        assert skipped == 2
+        assert list(request.windows.windows_for_resource.keys()) == ['1m0a.doma.bpl']
+        assert request.windows.size() == 1
+
+    def test_every_resource_is_kept_without_available_resources_or_downtime(self):
+        request = self.make_constrained_request()
+        context = AvailabilityContext({}, self.seeing_monitor, self.start)
+
+        assert filter_on_resource_availability([self.make_request_group([request])], None, context) == 0
+        assert request.windows.size() == 1
+
+    def test_skipped_rise_set_lookups_are_reported(self):
+        request = self.make_constrained_request()
+        visibilities = construct_visibilities(self.tels, self.start, self.end)
+
+        with patch('adaptive_scheduler.kernel_mappings.fill_rise_set_cache', return_value=set()) as mock_fill, \
+                patch.object(local_cache, 'send_metric') as mock_send, \
+                patch.object(RequestGroup, 'emit_request_group_feedback'):
+            filter_on_visibility([self.make_request_group([request])], visibilities, {}, self.seeing_monitor,
+                                 self.start, self.end, self.start, available_resources=['1m0a.doma.elp'])
+
+        assert not mock_fill.call_args[0][0][0].requests[0].windows.has_windows()
+        metrics = {call[0][0]: call[0][1] for call in mock_send.call_args_list}
+        assert metrics['rise_set_cache.skipped'] == 1
+
     def test_compute_request_availability_full_seeing_constraint_violated(self):
         request = self.make_constrained_request()
         resource = '1m0a.doma.bpl'
@@ -386,6 +485,36 @@ class TestKernelMappings(object):
         assert request.windows.at(resource)[0] == base_windows[resource][0]
         assert request.windows.at(resource)[1] == base_windows[resource][1]
 
+    def test_availability_context_builds_blocked_intervals_once_per_resource(self):
+        resource = '1m0a.doma.bpl'
+        visibilities = construct_visibilities(self.tels, self.start, self.end)
+        estimated_scheduler_end = datetime(2011, 11, 1, 6)
+        downtime_intervals = {resource: {'all': [(datetime(2011, 11, 1, 5), datetime(2011, 11, 1, 8)), ]}}
+        seeing_monitor = Mock()
+        seeing_monitor.seeing_valid_time_period = 20.0
+        seeing_monitor.retrieve_data = Mock(return_value={resource: {'time': estimated_scheduler_end,
+                                                                     'seeing': 2.0}})
+        context = AvailabilityContext(downtime_intervals, seeing_monitor, estimated_scheduler_end)
+        requests = [self.make_constrained_request(), self.make_constrained_request(),
+                    self.make_constrained_request(max_seeing=1.5)]
+
+        with patch.object(context, '_build_blocked_intervals',
+                          wraps=context._build_blocked_intervals) as mock_build_blocked_intervals:
+            for request in requests:
+                intervals_for_resource = self.make_rise_set_intervals(request, visibilities)
+                compute_request_availability(request, intervals_for_resource, downtime_intervals, seeing_monitor,
+                                             estimated_scheduler_end, availability_context=context)
+
+        # Once for the requests whose seeing constraint is met, and once for the request whose constraint is violated
+        assert mock_build_blocked_intervals.call_count == 2
+        seeing_monitor.retrieve_data.assert_called_once()
+        for request in requests:
+            expected = self.make_constrained_request(max_seeing=request.configurations[0].constraints['max_seeing'])
+            intervals_for_resource = self.make_rise_set_intervals(expected, visibilities)
+            compute_request_availability(expected, intervals_for_resource, downtime_intervals, seeing_monitor,
+                                         estimated_scheduler_end)
+            assert request.windows.at(resource) == expected.windows.at(resource)
+
     def test_construct_compound_reservation(self):
         request = self.make_constrained_request()
         requests = [request, request]
@@ -875,3 +1004,467 @@ class TestKernelMappings(object):
 
         assert received_airmass1 != received_no_airmass
         assert len(received_airmass1) == 0
+
+
+class TestSemesterRedisCache(object):
+
+    def setup(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.semester_start = datetime(2011, 10, 1)
+        self.semester_end = datetime(2012, 4, 1)
+        local_cache.clear()
+
+    def teardown(self):
+        local_cache.clear()
+
+    def test_semester_rollover_does_not_flush_redis(self):
+        self.redis.set('unrelated_key', 'value')
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            update_cached_semester(self.semester_start, self.semester_end)
+
+        semester_name = semester_cache_name(self.semester_start, self.semester_end)
+        assert self.redis.get('unrelated_key') == b'value'
+        assert self.redis.get('current_semester').decode() == semester_name
+        assert local_cache['current_semester'] == semester_name
+
+    def test_intervals_are_saved_under_the_semester_with_an_expiry(self):
+        intervals = Intervals([{'time': datetime(2011, 11, 1), 'type': 'start'},
+                               {'time': datetime(2011, 11, 2), 'type': 'end'}])
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            update_cached_semester(self.semester_start, self.semester_end)
+            save_to_redis_cache('key', intervals)
+            received = get_from_redis_cache('key')
+
+        assert received.toTupleList() == intervals.toTupleList()
+        assert self.redis.ttl(redis_cache_key('key')) > 0
+
+    def test_intervals_from_another_semester_are_not_used(self):
+        intervals = Intervals([])
+        other_semester = semester_cache_name(self.semester_end, datetime(2012, 10, 1))
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            update_cached_semester(self.semester_start, self.semester_end)
+            save_to_redis_cache('key', intervals, other_semester)
+            with pytest.raises(KeyError):
+                get_from_redis_cache('key')
+
+    def test_intervals_computed_in_batch_are_not_used_by_exact_schedulers(self):
+        intervals = Intervals([])
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            update_cached_semester(self.semester_start, self.semester_end)
+            with patch('adaptive_scheduler.kernel_mappings.RISE_SET_CACHE_NAMESPACE', 'rise_set_v2_batch'):
+                save_to_redis_cache('key', intervals)
+                assert get_from_redis_cache('key').toTupleList() == []
+            with patch('adaptive_scheduler.kernel_mappings.RISE_SET_CACHE_NAMESPACE', 'rise_set_v2'):
+                with pytest.raises(KeyError):
+                    get_from_redis_cache('key')
+
+    def test_unbound_orbits_can_be_left_out_of_the_rise_set_cache(self):
+        target = OrbitalElementsTarget({'scheme': 'MPC_COMET', 'eccentricity': 1.5})
+        windows = Windows()
+        windows.append(Window({'start': datetime(2011, 11, 1), 'end': datetime(2011, 11, 2)}, '1m0a.doma.bpl'))
+        configuration = Configuration(id=5, target=target, type='expose', instrument_type='1M0-SCICAM-SBIG',
+                                      priority=1, instrument_configs=[], acquisition_config={}, guiding_config={},
+                                      constraints={'max_airmass': None, 'min_lunar_distance': 0,
+                                                   'max_lunar_phase': 1.0})
+        request = Request(configurations=[configuration], windows=windows, request_id=1, duration=60)
+        rg = RequestGroup(operator='single', requests=[request], proposal=Proposal(id='prop', tac_priority=1),
+                          expires=datetime(2050, 1, 1), rg_id=1, is_staff=False, observation_type='NORMAL',
+                          ipp_value=1.0, name='rg', submitter='')
+
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.kernel_mappings.get_rise_set_timepoint_intervals') as mock_rise_set:
+            retry_later = fill_rise_set_cache([rg], {}, self.semester_start, self.semester_end,
+                                              include_unbound_orbits=False)
+
+        assert retry_later == set()
+        mock_rise_set.assert_not_called()
+        assert list(local_cache.keys()) == ['current_semester']
+
+
+class TestHorizonLimitedRiseSets(object):
+
+    def setup(self):
+        self.semester_start = datetime(2011, 11, 1)
+        self.semester_end = datetime(2011, 12, 1)
+        self.resource = '1m0a.doma.bpl'
+        self.tels = {
+            self.resource: dict(name=self.resource, tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0, zenith_blind_spot=0.0)
+        }
+        self.visibilities = construct_visibilities(self.tels, self.semester_start, self.semester_end)
+        self.redis = fakeredis.FakeStrictRedis()
+        init_worker(self.tels, self.semester_start, self.semester_end)
+        self.rise_set_pool = Mock(processes=1)
+        self.rise_set_pool.imap_rise_sets.side_effect = lambda tasks: iter(
+            [compute_rise_set_in_worker(task) for task in tasks])
+        local_cache.clear()
+
+    def teardown(self):
+        local_cache.clear()
+
+    def _make_request_group(self, window_end):
+        configuration = Configuration(
+            id=5, target=ICRSTarget(ra=310.35795833333333, dec=45.280338888888885), type='expose',
+            instrument_type='1M0-SCICAM-SBIG', priority=1, instrument_configs=[], acquisition_config={},
+            guiding_config={}, constraints={'max_airmass': None, 'min_lunar_distance': 0, 'max_lunar_phase': 1.0})
+        windows = Windows()
+        windows.append(Window({'start': datetime(2011, 11, 5, 3), 'end': window_end}, self.resource))
+        request = Request(configurations=[configuration], windows=windows, request_id=1, duration=60)
+        return RequestGroup(operator='single', requests=[request], proposal=Proposal(id='prop', tac_priority=1),
+                            expires=datetime(2050, 1, 1), rg_id=1, is_staff=False, observation_type='NORMAL',
+                            ipp_value=1.0, name='rg', submitter='')
+
+    def _fill(self, window_end, horizon_limited=True):
+        rg = self._make_request_group(window_end)
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.kernel_mappings.RISE_SET_HORIZON_LIMITED', horizon_limited), \
+                patch('adaptive_scheduler.kernel_mappings.RISE_SET_COVERAGE_MARGIN_DAYS', 3.0), \
+                patch('adaptive_scheduler.kernel_mappings.BATCH_SIDEREAL_VISIBILITY', False):
+            retry_later = fill_rise_set_cache([rg], self.visibilities, self.semester_start, self.semester_end,
+                                              rise_set_pool=self.rise_set_pool)
+        request = rg.requests[0]
+        self.cache_key = make_request_cache_key(request, request.configurations[0], self.resource)
+        return retry_later
+
+    def _window_ranges_sent_to_pool(self):
+        return [task[-1] for task in self.rise_set_pool.imap_rise_sets.call_args[0][0]]
+
+    def _cached_coverage(self):
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            return pickle.loads(self.redis.get(coverage_redis_key(self.cache_key)))
+
+    def _semester_intervals(self, start, end):
+        intervals = get_rise_set_timepoint_intervals(ICRSTarget(ra=310.35795833333333,
+                                                                dec=45.280338888888885).in_rise_set_format(),
+                                                     self.visibilities[self.resource], None, 0, 1.0)
+        return intervals.intersect([Intervals([(start, end)])])
+
+    def _difference_in_seconds(self, received, expected):
+        difference = received.subtract(expected).get_total_time() + expected.subtract(received).get_total_time()
+        return difference.total_seconds() if hasattr(difference, 'total_seconds') else difference
+
+    @pytest.mark.parametrize('horizon_limited', [True, False])
+    def test_cache_lookups_and_computations_are_recorded(self, horizon_limited):
+        self._fill(datetime(2011, 11, 9), horizon_limited)
+        assert (local_cache.hits['local'], local_cache.misses['local']) == (0, 1)
+        assert (local_cache.hits['redis'], local_cache.misses['redis']) == (0, 1)
+        assert local_cache.computed == 1
+
+        self._fill(datetime(2011, 11, 9), horizon_limited)
+        assert (local_cache.hits['local'], local_cache.misses['local']) == (1, 1)
+        assert local_cache.computed == 1
+
+        with patch.object(local_cache, 'send_metric') as mock_send:
+            local_cache.finish_run()
+        assert mock_send.call_count > 0
+        assert local_cache.hits['local'] == 0
+
+    def test_rise_sets_are_only_computed_over_the_window_days_and_margin(self):
+        assert self._fill(datetime(2011, 11, 6, 12)) == set()
+
+        coverage = (datetime(2011, 11, 5), datetime(2011, 11, 10))
+        assert self._window_ranges_sent_to_pool() == [coverage]
+        assert self._cached_coverage() == coverage
+        intervals = local_cache[self.cache_key]
+        assert intervals.toTupleList()[0][0] >= coverage[0]
+        assert intervals.toTupleList()[-1][1] <= coverage[1]
+        # rise_set works a day at a time, so intervals may be clipped slightly differently at the span's edges
+        assert self._difference_in_seconds(intervals, self._semester_intervals(*coverage)) < 600
+
+    def test_covered_windows_are_not_recomputed(self):
+        self._fill(datetime(2011, 11, 6, 12))
+        self._fill(datetime(2011, 11, 7))
+        assert self._window_ranges_sent_to_pool() == []
+
+        # A fresh process finds the covered span in redis
+        local_cache.clear()
+        self._fill(datetime(2011, 11, 7))
+        assert self._window_ranges_sent_to_pool() == []
+        assert local_cache[self.cache_key].toTupleList()
+
+    def test_coverage_is_extended_by_only_the_missing_days(self):
+        self._fill(datetime(2011, 11, 6, 12))
+        first_intervals = local_cache[self.cache_key]
+        old_key = redis_cache_key(span_cache_key(self.cache_key, (datetime(2011, 11, 5), datetime(2011, 11, 10))))
+
+        self._fill(datetime(2011, 11, 12))
+
+        assert self._window_ranges_sent_to_pool() == [(datetime(2011, 11, 10), datetime(2011, 11, 15))]
+        assert self._cached_coverage() == (datetime(2011, 11, 5), datetime(2011, 11, 15))
+        intervals = local_cache[self.cache_key]
+        assert first_intervals.subtract(intervals).is_empty()
+        assert self._difference_in_seconds(intervals, self._semester_intervals(datetime(2011, 11, 5),
+                                                                               datetime(2011, 11, 15))) < 1200
+        assert not self.redis.exists(old_key)
+
+    def test_semester_long_intervals_are_used_when_cached(self):
+        rg = self._make_request_group(datetime(2011, 11, 6, 12))
+        request = rg.requests[0]
+        cache_key = make_request_cache_key(request, request.configurations[0], self.resource)
+        intervals = Intervals([(datetime(2011, 11, 5), datetime(2011, 11, 6))])
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            update_cached_semester(self.semester_start, self.semester_end)
+            save_to_redis_cache(cache_key, intervals)
+        local_cache.clear()
+
+        self._fill(datetime(2011, 11, 6, 12))
+
+        assert self._window_ranges_sent_to_pool() == []
+        assert local_cache[cache_key].toTupleList() == intervals.toTupleList()
+
+    def test_timed_out_span_is_retried(self):
+        self.rise_set_pool.imap_rise_sets.side_effect = lambda tasks: iter(
+            [(task[0], RiseSetTimedOut()) for task in tasks])
+
+        retry_later = self._fill(datetime(2011, 11, 6, 12))
+
+        assert retry_later == {self.cache_key}
+        assert local_cache[self.cache_key].is_empty()
+        assert not self.redis.exists(coverage_redis_key(self.cache_key))
+
+
+def fill_rise_set_cache_in_instance(redis, tels, rg, semester_start, semester_end, results):
+    '''Runs fill_rise_set_cache as a separate scheduler instance would, with its own local cache and worker pool.'''
+    local_cache.clear()
+    init_worker(tels, semester_start, semester_end)
+
+    def slowly_compute(tasks):
+        for task in tasks:
+            redis.incr('computations')
+            time.sleep(0.5)
+            yield compute_rise_set_in_worker(task)
+
+    rise_set_pool = Mock(processes=1)
+    rise_set_pool.imap_rise_sets.side_effect = slowly_compute
+    with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=SharedFakeRedis(redis)), \
+            patch('adaptive_scheduler.kernel_mappings.BATCH_SIDEREAL_VISIBILITY', False), \
+            patch('adaptive_scheduler.kernel_mappings.RISE_SET_LEASE_POLL_SECONDS', 0.05):
+        fill_rise_set_cache([rg], construct_visibilities(tels, semester_start, semester_end), semester_start,
+                            semester_end, rise_set_pool=rise_set_pool)
+    results.put([value.toTupleList() for key, value in local_cache.items() if key != 'current_semester'])
+
+
+def release_leases(keys, args, client):
+    '''Does what the lease release script does in redis, for a fakeredis which cannot run lua.'''
+    released = 0
+    for key in keys:
+        if client.get(key) == args[0].encode():
+            released += client.delete(key)
+    return released
+
+
+def renew_leases(keys, args, client):
+    '''Does what the lease renewal script does in redis, for a fakeredis which cannot run lua.'''
+    renewed = 0
+    for key in keys:
+        if client.get(key) == args[0].encode():
+            renewed += client.pexpire(key, args[1])
+    return renewed
+
+
+@pytest.fixture
+def lease_scripts_without_lua():
+    # fakeredis only runs lua scripts when lupa is installed
+    try:
+        import lupa  # noqa: F401
+    except ImportError:
+        with patch('adaptive_scheduler.kernel_mappings._release_leases_script', new=release_leases), \
+                patch('adaptive_scheduler.kernel_mappings._renew_leases_script', new=renew_leases):
+            yield
+    else:
+        yield
+
+
+@pytest.mark.usefixtures('lease_scripts_without_lua')
+class TestRiseSetLeases(object):
+
+    def setup(self):
+        self.semester_start = datetime(2011, 11, 1)
+        self.semester_end = datetime(2011, 11, 8)
+        self.resource = '1m0a.doma.bpl'
+        self.tels = {
+            self.resource: dict(name=self.resource, tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0, zenith_blind_spot=0.0)
+        }
+        self.redis = fakeredis.FakeStrictRedis()
+        configuration = Configuration(
+            id=5, target=ICRSTarget(ra=310.35795833333333, dec=45.280338888888885), type='expose',
+            instrument_type='1M0-SCICAM-SBIG', priority=1, instrument_configs=[], acquisition_config={},
+            guiding_config={}, constraints={'max_airmass': None, 'min_lunar_distance': 0, 'max_lunar_phase': 1.0})
+        windows = Windows()
+        windows.append(Window({'start': self.semester_start, 'end': self.semester_end}, self.resource))
+        request = Request(configurations=[configuration], windows=windows, request_id=1, duration=60)
+        self.rg = RequestGroup(operator='single', requests=[request], proposal=Proposal(id='prop', tac_priority=1),
+                               expires=datetime(2050, 1, 1), rg_id=1, is_staff=False, observation_type='NORMAL',
+                               ipp_value=1.0, name='rg', submitter='')
+        self.cache_key = make_request_cache_key(request, configuration, self.resource)
+        init_worker(self.tels, self.semester_start, self.semester_end)
+        self.rise_set_pool = Mock(processes=1)
+        self.rise_set_pool.imap_rise_sets.side_effect = lambda tasks: iter(
+            [compute_rise_set_in_worker(task) for task in tasks])
+        local_cache.clear()
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            update_cached_semester(self.semester_start, self.semester_end)
+
+    def teardown(self):
+        local_cache.clear()
+
+    def _fill(self, lease_seconds=600.0):
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.kernel_mappings.BATCH_SIDEREAL_VISIBILITY', False), \
+                patch('adaptive_scheduler.kernel_mappings.RISE_SET_LEASE_SECONDS', lease_seconds), \
+                patch('adaptive_scheduler.kernel_mappings.RISE_SET_LEASE_POLL_SECONDS', 0.01):
+            fill_rise_set_cache([self.rg], construct_visibilities(self.tels, self.semester_start, self.semester_end),
+                                self.semester_start, self.semester_end, rise_set_pool=self.rise_set_pool)
+
+    def _computed_keys(self):
+        return [task[0] for call in self.rise_set_pool.imap_rise_sets.call_args_list for task in call[0][0]]
+
+    def test_leases_are_released_after_computing(self):
+        self._fill()
+
+        assert self._computed_keys() == [self.cache_key]
+        assert local_cache[self.cache_key].toTupleList()
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            assert not self.redis.exists(lease_redis_key(self.cache_key))
+
+    def test_only_the_lease_owner_releases_it(self):
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            self.redis.set(lease_redis_key(self.cache_key), 'another_instance')
+            assert acquire_rise_set_leases([self.cache_key]) == set()
+            release_rise_set_leases([self.cache_key])
+            assert self.redis.get(lease_redis_key(self.cache_key)) == b'another_instance'
+
+    def test_leases_are_acquired_together(self):
+        cache_keys = [self.cache_key, self.cache_key + '_other', self.cache_key + '_mine']
+        self.redis.set(lease_redis_key(cache_keys[1]), 'another_instance')
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis), \
+                patch.object(self.redis, 'set', side_effect=AssertionError('set called once per lease')):
+            assert acquire_rise_set_leases(cache_keys[2:]) == {cache_keys[2]}
+            # A lease this process already holds is acquired again
+            assert acquire_rise_set_leases(cache_keys) == {cache_keys[0], cache_keys[2]}
+
+    def test_owned_leases_are_released_together(self):
+        other_key = self.cache_key + '_other'
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            assert acquire_rise_set_leases([self.cache_key]) == {self.cache_key}
+            self.redis.set(lease_redis_key(other_key), 'another_instance')
+            release_rise_set_leases([self.cache_key, other_key])
+
+            assert not self.redis.exists(lease_redis_key(self.cache_key))
+            assert self.redis.get(lease_redis_key(other_key)) == b'another_instance'
+
+    def test_leases_are_renewed_until_they_are_released(self):
+        other_key = self.cache_key + '_other'
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.kernel_mappings.RISE_SET_LEASE_SECONDS', 0.3):
+            assert acquire_rise_set_leases([self.cache_key]) == {self.cache_key}
+            self.redis.set(lease_redis_key(other_key), 'another_instance', px=300)
+            lease_renewer = RiseSetLeaseRenewer([self.cache_key, other_key])
+            lease_renewer.start()
+            try:
+                time.sleep(0.9)
+                assert self.redis.exists(lease_redis_key(self.cache_key))
+                # Leases held by other instances are left to expire
+                assert not self.redis.exists(lease_redis_key(other_key))
+            finally:
+                lease_renewer.stop()
+            release_rise_set_leases([self.cache_key])
+
+            assert not self.redis.exists(lease_redis_key(self.cache_key))
+
+    def test_lease_scripts_run_in_redis(self):
+        pytest.importorskip('lupa')
+        other_key = self.cache_key + '_other'
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            assert acquire_rise_set_leases([self.cache_key]) == {self.cache_key}
+            self.redis.set(lease_redis_key(other_key), 'another_instance', px=60000)
+            self.redis.pexpire(lease_redis_key(self.cache_key), 1000)
+            renew_rise_set_leases([self.cache_key, other_key])
+
+            assert self.redis.pttl(lease_redis_key(self.cache_key)) > 1000
+            assert self.redis.pttl(lease_redis_key(other_key)) <= 60000
+            release_rise_set_leases([self.cache_key, other_key])
+            assert not self.redis.exists(lease_redis_key(self.cache_key))
+            assert self.redis.get(lease_redis_key(other_key)) == b'another_instance'
+
+    def test_leases_held_elsewhere_are_polled_in_a_pipeline(self):
+        cache_keys = [self.cache_key, self.cache_key + '_other']
+        for cache_key in cache_keys:
+            self.redis.set(lease_redis_key(cache_key), 'another_instance', px=100)
+        start = time.monotonic()
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.kernel_mappings.RISE_SET_LEASE_POLL_SECONDS', 0.01), \
+                patch.object(self.redis, 'exists', side_effect=AssertionError('exists called once per lease')):
+            wait_for_rise_set_leases(cache_keys)
+
+        assert 0.1 <= time.monotonic() - start < 5
+        assert not any(self.redis.exists(lease_redis_key(cache_key)) for cache_key in cache_keys)
+
+    def test_waiters_wait_for_as_long_as_a_lease_is_renewed(self):
+        lease_key = lease_redis_key(self.cache_key)
+        self.redis.set(lease_key, 'another_instance', px=100)
+
+        def keep_renewing():
+            for _ in range(12):
+                time.sleep(0.05)
+                self.redis.pexpire(lease_key, 100)
+            self.redis.delete(lease_key)
+        other_instance = threading.Thread(target=keep_renewing)
+        start = time.monotonic()
+        other_instance.start()
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.kernel_mappings.RISE_SET_LEASE_SECONDS', 0.1), \
+                patch('adaptive_scheduler.kernel_mappings.RISE_SET_LEASE_POLL_SECONDS', 0.01):
+            wait_for_rise_set_leases([self.cache_key])
+        other_instance.join()
+
+        assert time.monotonic() - start >= 0.6
+        assert not self.redis.exists(lease_key)
+
+    def test_rise_set_leased_elsewhere_is_read_from_redis(self):
+        intervals = Intervals([(datetime(2011, 11, 2), datetime(2011, 11, 3))])
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            lease_key = lease_redis_key(self.cache_key)
+            self.redis.set(lease_key, 'another_instance')
+
+            def finish_computing():
+                save_to_redis_cache(self.cache_key, intervals)
+                self.redis.delete(lease_key)
+            other_instance = threading.Timer(0.1, finish_computing)
+            other_instance.start()
+            self._fill()
+            other_instance.join()
+
+        assert self._computed_keys() == []
+        assert local_cache[self.cache_key].toTupleList() == intervals.toTupleList()
+
+    def test_expired_lease_is_taken_over(self):
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            self.redis.set(lease_redis_key(self.cache_key), 'another_instance', px=50)
+
+        start = time.monotonic()
+        self._fill(lease_seconds=1.0)
+
+        assert time.monotonic() - start < 1.0
+        assert self._computed_keys() == [self.cache_key]
+        assert local_cache[self.cache_key].toTupleList()
+
+    def test_only_one_instance_computes_a_shared_rise_set(self):
+        with FakeRedisManager() as manager:
+            redis = manager.FakeStrictRedis()
+            context = get_context('fork')
+            results = context.Queue()
+            instances = [context.Process(target=fill_rise_set_cache_in_instance,
+                                         args=(redis, self.tels, self.rg, self.semester_start, self.semester_end,
+                                               results))
+                         for _ in range(2)]
+            for instance in instances:
+                instance.start()
+            received = [results.get(timeout=30) for _ in instances]
+            for instance in instances:
+                instance.join(timeout=30)
+
+            assert int(redis.get('computations')) == 1
+        assert received[0] == received[1]
+        assert received[0][0]
@@ -4,17 +4,26 @@ from __future__ import division
 import os
 import mock
 import copy
-from datetime import datetime
+import json
+import random
+from datetime import datetime, timedelta
 
 # Import the modules to test
-from adaptive_scheduler.models import (ICRSTarget, OrbitalElementsTarget,
+from adaptive_scheduler.models import (ICRSTarget, OrbitalElementsTarget, NullTarget,
                                        Proposal, Configuration,
                                        Request, RequestGroup,
                                        Windows, Window,
-                                       ModelBuilder,
-                                       RequestError)
+                                       ModelBuilder, RGCollection, RequestGroupModelCache,
+                                       RequestError, ProposalCache, cache_airmasses_for_requests,
+                                       AIRMASS_WEIGHTING_COEFFICIENT)
 from adaptive_scheduler.configdb_connections import ConfigDBInterface
+from adaptive_scheduler.observation_portal_connections import (ObservationPortalInterface,
+                                                               ObservationPortalConnectionError)
+from adaptive_scheduler.utils import OptimizationType
+from rise_set.astrometry import calculate_airmass_at_times
+from rise_set.angle import Angle
 
+import fakeredis
 import pytest
 
 
@@ -117,6 +126,57 @@ class TestRequest(object):
                      rg_id=1, is_staff=False, observation_type='NORMAL', ipp_value=1.0,
                      expires=datetime(2999, 1, 1), submitter='')
 
+    def _make_airmass_request(self, request_id, start, end):
+        windows = Windows()
+        windows.append(Window({'start': start, 'end': end}, self.telescope['name']))
+        return Request(configurations=[self.configuration], windows=windows, request_id=request_id,
+                       duration=self.duration, optimization_type=OptimizationType.AIRMASS)
+
+    def test_batched_airmasses_are_calculated_once_per_target_and_site(self):
+        network_model = {self.telescope['name']: dict(self.telescope, elevation=3055.0)}
+        window_start = datetime(2011, 11, 1, 6, 0, 0)
+        requests = [self._make_airmass_request(1, window_start, window_start + timedelta(hours=2)),
+                    self._make_airmass_request(2, window_start + timedelta(hours=1), window_start + timedelta(hours=3))]
+        redis = fakeredis.FakeStrictRedis()
+
+        with mock.patch('adaptive_scheduler.models.redis_instance', new=redis), \
+                mock.patch('adaptive_scheduler.models.calculate_airmass_at_times',
+                           wraps=calculate_airmass_at_times) as mock_calculate:
+            assert cache_airmasses_for_requests(requests, network_model, self.semester_start) == 1
+            assert mock_calculate.call_count == 1
+            # Both requests' samples were calculated together, at half hourly spacing
+            assert len(mock_calculate.call_args[0][0]) == 7
+            # Cached requests are not calculated again
+            assert cache_airmasses_for_requests(requests, network_model, self.semester_start) == 0
+            assert mock_calculate.call_count == 1
+            cached = requests[1].get_airmasses_within_kernel_windows(self.telescope['name'])
+
+        datetimes = [window_start + timedelta(minutes=30 * index) for index in range(2, 7)]
+        airmasses = calculate_airmass_at_times(datetimes, self.target.in_rise_set_format(),
+                                               Angle(degrees=self.telescope['latitude']),
+                                               Angle(degrees=self.telescope['longitude']), 3055.0)
+        best, worst = min(airmasses), max(airmasses)
+        expected = [float(AIRMASS_WEIGHTING_COEFFICIENT) * (1 - (airmass - best) / (worst - best))
+                    for airmass in airmasses]
+        assert cached['airmasses'] == pytest.approx(expected)
+        assert cached['times'] == [(sample - self.semester_start).total_seconds() for sample in datetimes]
+        assert redis.ttl('{}_{}_airmass_at_times'.format(requests[0].id, self.telescope['name'])) > 0
+
+    def test_request_caches_its_own_airmasses(self):
+        network_model = {self.telescope['name']: dict(self.telescope, elevation=3055.0)}
+        window_start = datetime(2011, 11, 1, 6, 0, 0)
+        request = self._make_airmass_request(1, window_start, window_start + timedelta(hours=1))
+        redis = fakeredis.FakeStrictRedis()
+
+        with mock.patch('adaptive_scheduler.models.redis_instance', new=redis):
+            request.cache_airmasses_within_kernel_windows(request.windows.to_kernel_intervals(self.semester_start),
+                                                          network_model, self.semester_start)
+            cached = request.get_airmasses_within_kernel_windows(self.telescope['name'])
+
+        assert len(cached['airmasses']) == 3
+        assert max(cached['airmasses']) == float(AIRMASS_WEIGHTING_COEFFICIENT)
+        assert json.loads(redis.get('1_maui_airmass_at_times')) == cached
+
 
 class TestRequestGroup(object):
     '''Unit tests for the adaptive scheduler RequestGroup object.'''
@@ -249,6 +309,30 @@ class TestRequestGroup(object):
     def test_priority_ipp_1_5(self):
         self._test_priority(base_priority=20.0, ipp_value=1.5)
 
+    def test_priority_does_not_touch_the_global_random_state(self):
+        ur = self._build_request_group()
+        random_state = random.getstate()
+
+        priority = ur.get_priority()
+
+        assert random.getstate() == random_state
+        assert self._build_request_group().get_priority() == priority
+
+    def test_priority_is_memoized_until_its_inputs_change(self):
+        ur = self._build_request_group(base_priority=2.0)
+        priority = ur.get_priority()
+
+        with mock.patch('adaptive_scheduler.models.deterministic_fraction') as mock_fraction:
+            assert ur.get_priority() == priority
+            assert not mock_fraction.called
+
+        ur.ipp_value = 2.0
+        assert abs(ur.get_priority() - 2.0 * priority) < 1e-9
+        ur.proposal.tac_priority = 4.0
+        assert abs(ur.get_priority() - 4.0 * priority) < 1e-9
+        # The memoized priorities are not compared
+        assert ur == self._build_request_group(base_priority=4.0, ipp_value=2.0)
+
     def test_drop_empty_children(self):
         r_mock1 = mock.MagicMock()
         r_mock1.has_windows.return_value = True
@@ -266,6 +350,50 @@ class TestRequestGroup(object):
         assert rg.requests[0] == r_mock1
 
 
+class TestRGCollection(object):
+
+    def setup(self):
+        self.rgs = []
+        for rg_id in [3, 1, 2]:
+            requests = [mock.MagicMock(id=rg_id * 10 + index) for index in range(2)]
+            self.rgs.append(RequestGroup(operator='many', requests=requests, name='Group {}'.format(rg_id),
+                                         proposal=Proposal(), rg_id=rg_id, is_staff=False, observation_type='NORMAL',
+                                         ipp_value=1.0, expires=datetime(2999, 1, 1), submitter=''))
+
+    def test_request_groups_are_kept_in_order(self):
+        rg_collection = RGCollection(self.rgs)
+
+        assert list(rg_collection) == self.rgs
+        assert len(rg_collection) == 3
+        assert rg_collection[1] is self.rgs[1]
+        assert list(rg_collection[1:]) == self.rgs[1:]
+        assert list(rg_collection.ids()) == [3, 1, 2]
+
+    def test_membership_is_by_id(self):
+        rg_collection = RGCollection(self.rgs[:2])
+
+        assert self.rgs[0] in rg_collection
+        assert 1 in rg_collection
+        assert self.rgs[2] not in rg_collection
+        assert rg_collection.get(3) is self.rgs[0]
+        assert rg_collection.get(2) is None
+
+    def test_difference_keeps_the_original_order(self):
+        rg_collection = RGCollection(self.rgs)
+
+        assert list(rg_collection.difference([self.rgs[1]])) == [self.rgs[0], self.rgs[2]]
+        assert list(rg_collection.difference(RGCollection(self.rgs))) == []
+
+    def test_lookup_by_request_id(self):
+        rg_collection = RGCollection(self.rgs)
+
+        assert rg_collection.get_by_request_id(11) is self.rgs[1]
+        # A request dropped from its request group is no longer found
+        self.rgs[1].requests.pop()
+        assert rg_collection.get_by_request_id(11) is None
+        assert rg_collection.get_by_request_id(10) is self.rgs[1]
+
+
 class TestWindows(object):
 
     def setup(self):
@@ -316,6 +444,55 @@ class TestWindows(object):
         assert windows.has_windows() == True
         assert windows.size() == 1
 
+    def test_window_times_are_kept_to_the_microsecond(self):
+        start = datetime(2013, 3, 1, 0, 0, 0, 123456)
+        end = datetime(2013, 3, 1, 0, 30, 0, 999999)
+        w = Window(window_dict={'start': start, 'end': end}, resource=self.t1['name'])
+
+        assert w.start == start
+        assert w.end == end
+        assert w == Window.from_epochs(w.start_epoch, w.end_epoch, self.t1['name'])
+        assert w != Window.from_epochs(w.start_epoch, w.end_epoch, self.t2['name'])
+
+        w.start = datetime(2013, 3, 1, 0, 10)
+        assert w.start == datetime(2013, 3, 1, 0, 10)
+
+    def test_windows_read_back_as_appended(self):
+        windows = Windows()
+        for hour in [0, 4, 2]:
+            windows.append(Window({'start': datetime(2013, 3, 1, hour), 'end': datetime(2013, 3, 1, hour + 1)},
+                                  self.t1['name']))
+        windows.append(Window({'start': datetime(2013, 3, 2), 'end': datetime(2013, 3, 3)}, self.t2['name']))
+
+        assert [w.start.hour for w in windows.at(self.t1['name'])] == [0, 4, 2]
+        assert windows.range_at(self.t1['name']) == (datetime(2013, 3, 1, 0), datetime(2013, 3, 1, 5))
+        assert windows.intervals_at(self.t2['name']).toTupleList() == [(datetime(2013, 3, 2), datetime(2013, 3, 3))]
+        assert set(windows.windows_for_resource) == {self.t1['name'], self.t2['name']}
+        assert windows.size() == 4
+
+        windows_copy = Windows()
+        for resource_name, resource_windows in windows:
+            windows_copy.windows_for_resource[resource_name] = resource_windows
+        assert windows_copy == windows
+
+        windows.remove_resource(self.t2['name'])
+        assert windows_copy != windows
+        assert windows.range_at(self.t1['name']) == (datetime(2013, 3, 1, 0), datetime(2013, 3, 1, 5))
+
+    def test_windows_are_converted_to_kernel_intervals(self):
+        semester_start = datetime(2013, 3, 1)
+        windows = Windows()
+        windows.append(Window({'start': datetime(2013, 3, 1, 1, 0, 0, 500000), 'end': datetime(2013, 3, 1, 2)},
+                              self.t1['name']))
+        windows.append(Window({'start': datetime(2013, 3, 1, 1, 30), 'end': datetime(2013, 3, 1, 3)},
+                              self.t1['name']))
+        windows.windows_for_resource[self.t2['name']] = []
+
+        kernel_intervals = windows.to_kernel_intervals(semester_start)
+
+        assert kernel_intervals[self.t1['name']].toTupleList() == [(3600, 3 * 3600)]
+        assert kernel_intervals[self.t2['name']].is_empty()
+
 
 class TestOrbitalElementsTarget(object):
 
@@ -344,6 +521,76 @@ class TestOrbitalElementsTarget(object):
         assert 'meandist' in target.required_fields
 
 
+class TestTargetFingerprint(object):
+
+    def test_identical_targets_share_a_fingerprint(self):
+        target = ICRSTarget(name='a', ra=83.8, dec=-5.4)
+        other_target = ICRSTarget(name='b', ra='83.8', dec=-5.4)
+
+        assert target.get_rise_set_fingerprint() == other_target.get_rise_set_fingerprint()
+        assert target.get_rise_set_fingerprint() != ICRSTarget(name='a', ra=83.8, dec=-5.5).get_rise_set_fingerprint()
+
+    def test_fingerprint_is_only_computed_once(self):
+        target = ICRSTarget(name='a', ra=83.8, dec=-5.4)
+        with mock.patch.object(ICRSTarget, 'in_rise_set_format', wraps=target.in_rise_set_format) as mock_format:
+            fingerprint = target.get_rise_set_fingerprint()
+            assert target.get_rise_set_fingerprint() == fingerprint
+
+        mock_format.assert_called_once()
+
+    def test_fingerprint_is_recomputed_when_target_changes(self):
+        target = ICRSTarget(name='a', ra=83.8, dec=-5.4)
+        fingerprint = target.get_rise_set_fingerprint()
+        target.dec = -5.5
+
+        assert target.get_rise_set_fingerprint() != fingerprint
+        assert target.get_rise_set_fingerprint() == ICRSTarget(ra=83.8, dec=-5.5).get_rise_set_fingerprint()
+
+    def test_memoized_fingerprint_does_not_affect_equality(self):
+        target = ICRSTarget(name='a', ra=83.8, dec=-5.4)
+        target.get_rise_set_fingerprint()
+
+        assert target == ICRSTarget(name='a', ra=83.8, dec=-5.4)
+
+    def test_rise_set_format_is_only_built_once(self):
+        target = ICRSTarget(name='a', ra=83.8, dec=-5.4, proper_motion_ra=10.0, proper_motion_dec=-5.0)
+        with mock.patch.object(ICRSTarget, 'make_rise_set_format', wraps=target.make_rise_set_format) as mock_make:
+            rs_target = target.in_rise_set_format()
+            target.get_rise_set_fingerprint()
+            assert target.in_rise_set_format() == rs_target
+
+        mock_make.assert_called_once()
+        assert rs_target['ra'].in_degrees() == pytest.approx(83.8)
+
+    def test_rise_set_format_is_a_copy(self):
+        target = ICRSTarget(name='a', ra=83.8, dec=-5.4)
+        rs_target = target.in_rise_set_format()
+        rs_target['ra'] = None
+
+        assert target.in_rise_set_format()['ra'].in_degrees() == pytest.approx(83.8)
+        assert target == ICRSTarget(name='a', ra=83.8, dec=-5.4)
+
+    def test_rise_set_format_is_rebuilt_when_target_changes(self):
+        target = ICRSTarget(name='a', ra=83.8, dec=-5.4)
+        target.in_rise_set_format()
+        target.dec = -5.5
+
+        assert target.in_rise_set_format()['dec'].in_degrees() == pytest.approx(-5.5)
+
+    def test_null_target_has_no_rise_set_format(self):
+        target = NullTarget(name='a')
+
+        with pytest.raises(AttributeError, match='targets of type NullTarget have no rise_set format'):
+            target.in_rise_set_format()
+        with pytest.raises(AttributeError):
+            target.get_rise_set_fingerprint()
+
+    def test_unbound_orbits(self):
+        assert not ICRSTarget(name='a', ra=83.8, dec=-5.4).has_unbound_orbit()
+        assert OrbitalElementsTarget({'scheme': 'MPC_COMET', 'eccentricity': 1.2}).has_unbound_orbit()
+        assert not OrbitalElementsTarget({'scheme': 'MPC_COMET', 'eccentricity': 0.8}).has_unbound_orbit()
+
+
 class TestModelBuilder(object):
 
     def setup(self):
@@ -426,6 +673,67 @@ class TestModelBuilder(object):
         assert (set(['1m0a.doma.lsc', '1m0a.domb.lsc', '1m0a.domc.lsc']) ==
                      set(request.windows.windows_for_resource.keys()))
 
+    def test_telescopes_share_the_parsed_windows_of_a_request(self):
+        location = self.location.copy()
+        location['site'] = 'lsc'
+        req_dict = {
+            'configurations': self.configurations,
+            'location': location,
+            'windows': [{'start': '2013-01-01T00:00:00Z', 'end': '2013-01-02T00:00:00.500000Z'},
+                        {'start': datetime(2013, 1, 3), 'end': datetime(2013, 1, 4)}],
+            'id': self.id,
+            'duration': 10,
+            'state': self.state,
+        }
+
+        request = self.mb.build_request(req_dict)
+
+        bounds = [request.windows.bounds_at(telescope) for telescope in request.windows.windows_for_resource]
+        assert len(bounds) == 3
+        assert all(telescope_bounds is bounds[0] for telescope_bounds in bounds)
+        assert not bounds[0].flags.writeable
+        assert [(window.start, window.end) for window in request.windows.at('1m0a.doma.lsc')] == [
+            (datetime(2013, 1, 1), datetime(2013, 1, 2, 0, 0, 0, 500000)), (datetime(2013, 1, 3), datetime(2013, 1, 4))]
+        # Each timestamp is only parsed once by the builder
+        with mock.patch('adaptive_scheduler.models.iso_string_to_datetime') as mock_parse:
+            self.mb.build_request(req_dict)
+        mock_parse.assert_not_called()
+
+    def test_telescopes_are_resolved_once_per_distinct_requirements(self, tmp_path):
+        configdb_interface = self.mb.configdb_interface
+        location = self.location.copy()
+        location['site'] = 'lsc'
+        req_dict = {
+            'configurations': self.configurations,
+            'location': location,
+            'windows': self.windows,
+            'id': self.id,
+            'duration': 10,
+            'state': self.state,
+        }
+        self.mb.build_request(req_dict)
+        # The same requirements, named in a different case, are served from the cache
+        location['site'] = 'LSC'
+        request = self.mb.build_request(req_dict)
+
+        assert {'1m0a.doma.lsc', '1m0a.domb.lsc', '1m0a.domc.lsc'} == set(request.windows.windows_for_resource)
+        assert configdb_interface.telescope_resolution_misses == 1
+        assert configdb_interface.telescope_resolution_hits == 1
+
+        with mock.patch.object(configdb_interface, 'send_metric') as mock_send:
+            configdb_interface.send_telescope_resolution_metrics()
+        mock_send.assert_any_call('telescope_resolution.hits', 1)
+        mock_send.assert_any_call('telescope_resolution.misses', 1)
+        assert configdb_interface.telescope_resolution_hits == 0
+
+        # Updating the active instruments resolves the telescopes afresh
+        configdb_interface.active_instruments_file = str(tmp_path / 'active_instruments.json')
+        with mock.patch.object(configdb_interface, 'get_all_active_instruments',
+                               return_value=configdb_interface.active_instruments):
+            configdb_interface.update_active_instruments()
+        self.mb.build_request(req_dict)
+        assert configdb_interface.telescope_resolution_misses == 1
+
     def test_build_request_2m_sbig_doesnt_resolve_when_not_staff(self):
         with pytest.raises(RequestError):
             location = self.location.copy()
@@ -599,6 +907,66 @@ class TestModelBuilder(object):
         request_group_model, _ = self.mb.build_request_group(cr_dict)
         assert request_group_model.observation_type == 'NORMAL'
 
+    @mock.patch('adaptive_scheduler.models.ModelBuilder.get_semester_details')
+    @mock.patch('adaptive_scheduler.models.ModelBuilder.get_proposal_details')
+    def test_unchanged_request_groups_are_reused_from_the_model_cache(self, mock_proposal, mock_semester):
+        mock_semester.return_value = {'id': '2013A', 'start': datetime(2013, 1, 1), 'end': datetime(2014, 1, 1)}
+        mock_proposal.return_value = Proposal({'id': 'TestProposal', 'pi': '', 'tag': '', 'tac_priority': 10})
+        req_dict = {
+            'configurations': self.configurations,
+            'location': self.location,
+            'windows': self.windows,
+            'id': self.id,
+            'duration': 10,
+            'state': self.state,
+        }
+        cr_dict = {
+            'proposal': 'TestProposal',
+            'name': '',
+            'id': '1',
+            'ipp_value': '1.0',
+            'operator': 'many',
+            'requests': [req_dict, ],
+            'observation_type': 'NORMAL',
+        }
+        model_cache = RequestGroupModelCache()
+        model_cache.start_cycle('context')
+        request_group, _ = model_cache.build_request_group(self.mb, cr_dict)
+        request = request_group.requests[0]
+        n_windows = request_group.n_windows()
+        # The filters of a cycle change the windows and requests
+        for resource_name in list(request.windows.windows_for_resource):
+            request.windows.windows_for_resource[resource_name] = []
+        request_group.drop_empty_children()
+        model_cache.finish_cycle()
+
+        model_cache.start_cycle('context')
+        with mock.patch.object(self.mb, 'build_request_group') as mock_build:
+            reused_group, _ = model_cache.build_request_group(self.mb, copy.deepcopy(cr_dict),
+                                                              {self.id: 'scheduled'})
+        assert not mock_build.called
+        assert reused_group is request_group
+        assert reused_group.requests == [request]
+        assert reused_group.n_windows() == n_windows
+        assert request.scheduled_reservation == 'scheduled'
+        assert (model_cache.hits, model_cache.misses) == (1, 0)
+
+        changed_dict = copy.deepcopy(cr_dict)
+        changed_dict['ipp_value'] = '2.0'
+        changed_group, _ = model_cache.build_request_group(self.mb, changed_dict)
+        assert changed_group is not request_group
+        assert changed_group.ipp_value == '2.0'
+        assert (model_cache.hits, model_cache.misses) == (1, 1)
+
+        # Request groups which are no longer seen are forgotten, and a new context rebuilds everything
+        model_cache.start_cycle('context')
+        model_cache.finish_cycle()
+        model_cache.start_cycle('context')
+        assert model_cache.build_request_group(self.mb, changed_dict)[0] is not changed_group
+        model_cache.start_cycle('new context')
+        model_cache.build_request_group(self.mb, changed_dict)
+        assert model_cache.misses == 1
+
     @mock.patch('adaptive_scheduler.models.ModelBuilder.get_semester_details')
     @mock.patch('adaptive_scheduler.models.ModelBuilder.get_proposal_details')
     def test_build_request_observation_type_rapid_response(self, mock_proposal, mock_semester):
@@ -699,3 +1067,74 @@ class TestModelBuilder(object):
         assert 1 == len(request_group_model.requests)
         assert 1 == len(invalid_requests)
         assert bad_req_dict == invalid_requests[0]
+
+
+class TestProposalCache(object):
+
+    def setup(self):
+        self.now = datetime(2021, 1, 1)
+        self.proposals = [{'id': 'prop{}'.format(index), 'tac_priority': index} for index in range(5)]
+        self.portal = ObservationPortalInterface('http://portal')
+        self.cache = ProposalCache(max_age_seconds=3600)
+
+    def _get(self, url, params=None, **kwargs):
+        response = mock.MagicMock()
+        if params is None:
+            response.json.return_value = {'id': 'other', 'tac_priority': 10}
+        else:
+            offset = params['offset']
+            response.json.return_value = {'count': len(self.proposals),
+                                          'results': self.proposals[offset:offset + 2]}
+        return response
+
+    def test_proposals_are_fetched_a_page_at_a_time(self):
+        with mock.patch('adaptive_scheduler.observation_portal_connections.requests.get',
+                        side_effect=self._get) as mock_get:
+            proposals = self.portal.get_proposals()
+
+        assert proposals == self.proposals
+        assert sorted(call[1]['params']['offset'] for call in mock_get.call_args_list) == [0, 2, 4]
+
+    def test_proposals_are_only_fetched_when_unknown_or_stale(self):
+        with mock.patch('adaptive_scheduler.observation_portal_connections.requests.get',
+                        side_effect=self._get) as mock_get:
+            self.cache.refresh(self.portal, now=self.now)
+            assert self.cache.get('prop3', self.portal, now=self.now).tac_priority == 3
+            assert self.cache.get('other', self.portal, now=self.now).tac_priority == 10
+            assert mock_get.call_count == 4
+            assert (self.cache.hits, self.cache.misses, self.cache.http_calls) == (1, 1, 4)
+
+            with mock.patch.object(self.cache, 'send_metric') as mock_send:
+                self.cache.send_metrics()
+            mock_send.assert_any_call('proposal_cache.http_calls', 4)
+            assert self.cache.http_calls == 0
+
+            # The next cycle is served from the cache
+            later = self.now + timedelta(minutes=30)
+            self.cache.refresh(self.portal, now=later)
+            self.cache.get('prop3', self.portal, now=later)
+            self.cache.get('other', self.portal, now=later)
+            self.cache.get('other', self.portal, now=later)
+            assert mock_get.call_count == 4
+            assert (self.cache.hits, self.cache.http_calls, self.cache.http_calls_avoided) == (3, 0, 4)
+
+            # Once stale, the proposals are fetched again
+            stale = self.now + timedelta(hours=2)
+            self.cache.refresh(self.portal, now=stale)
+            self.cache.get('prop3', self.portal, now=stale)
+            self.cache.get('other', self.portal, now=stale)
+            assert mock_get.call_count == 8
+
+    def test_model_builder_looks_up_proposals_in_the_cache(self):
+        portal = mock.MagicMock()
+        portal.get_proposal_pages.return_value = [self.proposals]
+        portal.get_proposal_by_id.side_effect = ObservationPortalConnectionError('down')
+        model_builder = ModelBuilder(portal, mock.MagicMock(), proposal_cache=self.cache)
+
+        assert model_builder.get_proposal_details('prop1').tac_priority == 1
+        assert model_builder.proposals_by_id is self.cache.proposals_by_id
+        with pytest.raises(RequestError):
+            model_builder.get_proposal_details('unknown')
+        # A new builder in the next cycle doesn't fetch the proposals again
+        ModelBuilder(portal, mock.MagicMock(), proposal_cache=self.cache)
+        assert portal.get_proposal_pages.call_count == 1
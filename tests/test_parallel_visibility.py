@@ -0,0 +1,205 @@
+#!/usr/bin/python
+from __future__ import division
+
+from adaptive_scheduler.parallel_visibility import (SharedIntervals, intersect_windows_in_worker, normalize_bounds,
+                                                    intersect_bounds, subtract_bounds, datetimes_to_bounds,
+                                                    bounds_to_datetimes)
+from adaptive_scheduler.kernel_mappings import (construct_visibilities, get_rise_set_timepoint_intervals,
+                                                make_request_cache_key, compute_availability_in_worker_pool,
+                                                process_request_visibility, AvailabilityContext, local_cache)
+from adaptive_scheduler.rise_set_pool import RiseSetWorkerPool
+from adaptive_scheduler.monitoring.seeing import DummySeeingMonitor
+from adaptive_scheduler.models import (ICRSTarget, Request, Window, Windows, Configuration, RequestGroup, Proposal)
+from time_intervals.intervals import Intervals
+from multiprocessing import shared_memory
+from datetime import datetime, timedelta
+import copy
+import random
+
+from mock import Mock, patch
+import pytest
+
+
+def random_intervals(rng, count, start=datetime(2011, 11, 1)):
+    intervals = []
+    for _ in range(count):
+        interval_start = start + timedelta(minutes=rng.randint(0, 600))
+        intervals.append((interval_start, interval_start + timedelta(minutes=rng.choice([0, 5, 10, 60, 120]))))
+    return intervals
+
+
+class TestIntervalArrays(object):
+
+    def setup(self):
+        self.rng = random.Random(12345)
+
+    def _to_bounds(self, intervals):
+        return datetimes_to_bounds(intervals.toTupleList())
+
+    def test_normalize_matches_intervals(self):
+        for _ in range(200):
+            intervals = random_intervals(self.rng, self.rng.randint(0, 8))
+            expected = Intervals(intervals).toTupleList() if intervals else []
+            assert bounds_to_datetimes(normalize_bounds(datetimes_to_bounds(intervals))) == expected
+
+    def test_intersect_matches_intervals(self):
+        for _ in range(200):
+            intervals = [Intervals(random_intervals(self.rng, self.rng.randint(0, 8))) for _ in range(3)]
+            expected = intervals[0].intersect(intervals[1:]).toTupleList()
+            received = intersect_bounds([self._to_bounds(i) for i in intervals])
+            assert bounds_to_datetimes(received) == expected
+
+    def test_subtract_matches_intervals(self):
+        for _ in range(200):
+            intervals = Intervals(random_intervals(self.rng, self.rng.randint(0, 8)))
+            other = Intervals(random_intervals(self.rng, self.rng.randint(0, 8)))
+            expected = intervals.subtract(other).toTupleList()
+            received = subtract_bounds(self._to_bounds(intervals), self._to_bounds(other))
+            assert bounds_to_datetimes(received) == expected
+
+    def test_microseconds_are_preserved(self):
+        intervals = [(datetime(2011, 11, 1, 3, 4, 5, 123456), datetime(2011, 11, 2, 0, 0, 0, 1))]
+        assert bounds_to_datetimes(datetimes_to_bounds(intervals)) == intervals
+
+
+class TestSharedIntervals(object):
+
+    def test_workers_read_published_intervals(self):
+        shared_intervals = SharedIntervals()
+        intervals = Intervals([(datetime(2011, 11, 1, 1), datetime(2011, 11, 1, 5)),
+                               (datetime(2011, 11, 1, 8), datetime(2011, 11, 1, 12))])
+        blocked = Intervals([(datetime(2011, 11, 1, 4), datetime(2011, 11, 1, 9))])
+        target_slot = shared_intervals.add('target', intervals)
+        assert shared_intervals.add('target', intervals) == target_slot
+        blocked_slot = shared_intervals.add('blocked', blocked)
+        user_bounds = datetimes_to_bounds([(datetime(2011, 11, 1), datetime(2011, 11, 2))])
+
+        name, rows = shared_intervals.publish()
+        try:
+            results = intersect_windows_in_worker((name, rows, [(7, [('1m0a.doma.bpl', [target_slot], user_bounds,
+                                                                                         blocked_slot)])]))
+        finally:
+            shared_intervals.close()
+
+        request_index, bounds_by_resource = results[0]
+        assert request_index == 7
+        assert bounds_to_datetimes(bounds_by_resource['1m0a.doma.bpl']) == intervals.subtract(blocked).toTupleList()
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+class TestParallelAvailability(object):
+
+    def setup(self):
+        self.start = datetime(2011, 11, 1, 0, 0, 0)
+        self.end = datetime(2011, 11, 4, 0, 0, 0)
+        self.tels = {
+            '1m0a.doma.bpl': dict(name='1m0a.doma.bpl', tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                  horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0, zenith_blind_spot=0.0),
+            '1m0a.doma.lsc': dict(name='1m0a.doma.lsc', tel_class='1m0', latitude=-30.1673833333,
+                                  longitude=-70.8047888889, horizon=15, ha_limit_neg=-4.6, ha_limit_pos=4.6,
+                                  zenith_blind_spot=0.0)
+        }
+        self.visibilities = construct_visibilities(self.tels, self.start, self.end)
+        self.downtime_intervals = {'1m0a.doma.bpl': {'all': [(datetime(2011, 11, 2, 3), datetime(2011, 11, 2, 9))]},
+                                   '1m0a.doma.lsc': {'1M0-SCICAM-SBIG': [(datetime(2011, 11, 1, 23),
+                                                                          datetime(2011, 11, 2, 2))]}}
+        self.seeing_monitor = DummySeeingMonitor()
+        self.rgs = [self._make_request_group(index, ra, dec)
+                    for index, (ra, dec) in enumerate([(310.35795833333333, 45.280338888888885), (0.0, 0.0),
+                                                       (300.0, -20.0), (83.8, -5.4)])]
+        self.cache_keys = set()
+        for rg in self.rgs:
+            for request in rg.requests:
+                for conf in request.configurations:
+                    for resource in request.windows.windows_for_resource:
+                        cache_key = make_request_cache_key(request, conf, resource)
+                        self.cache_keys.add(cache_key)
+                        local_cache[cache_key] = get_rise_set_timepoint_intervals(
+                            conf.target.in_rise_set_format(), self.visibilities[resource],
+                            conf.constraints['max_airmass'], conf.constraints['min_lunar_distance'],
+                            conf.constraints['max_lunar_phase'])
+
+    def teardown(self):
+        for cache_key in self.cache_keys:
+            local_cache.pop(cache_key, None)
+
+    def _make_configuration(self, ra, dec, max_airmass):
+        return Configuration(
+            id=5, target=ICRSTarget(ra=ra, dec=dec), type='expose', instrument_type='1M0-SCICAM-SBIG', priority=1,
+            instrument_configs=[dict(exposure_count=1, bin_x=2, bin_y=2, exposure_time=30,
+                                     optical_elements={'filter': 'B'})],
+            acquisition_config=dict(mode='OFF'),
+            guiding_config=dict(mode='ON', optional=True, optical_elements={}, exposure_time=10),
+            constraints={'max_airmass': max_airmass, 'min_lunar_distance': 0, 'max_lunar_phase': 1.0}
+        )
+
+    def _make_request_group(self, index, ra, dec):
+        windows = Windows()
+        for resource in self.tels:
+            windows.append(Window({'start': self.start + timedelta(hours=index), 'end': self.end}, resource))
+            windows.append(Window({'start': self.start + timedelta(days=1, hours=index),
+                                   'end': self.end - timedelta(hours=10)}, resource))
+        configurations = [self._make_configuration(ra, dec, None), self._make_configuration(ra, dec + 1.0, 2.0)]
+        request = Request(configurations=configurations, windows=windows, request_id=index, duration=60)
+        return RequestGroup(operator='single', requests=[request], proposal=Proposal(id='prop', tac_priority=1),
+                            expires=datetime(2050, 1, 1), rg_id=index, is_staff=False, observation_type='NORMAL',
+                            ipp_value=1.0, name='rg {}'.format(index), submitter='')
+
+    def _serial_windows(self):
+        rgs = copy.deepcopy(self.rgs)
+        context = AvailabilityContext(self.downtime_intervals, self.seeing_monitor, self.start)
+        for rg in rgs:
+            for request in rg.requests:
+                intervals_by_resource = {}
+                for conf in request.configurations:
+                    for resource in request.windows.windows_for_resource:
+                        target_intervals = local_cache[make_request_cache_key(request, conf, resource)]
+                        if resource in intervals_by_resource:
+                            intervals_by_resource[resource] = intervals_by_resource[resource].intersect(
+                                [target_intervals])
+                        else:
+                            intervals_by_resource[resource] = target_intervals
+                with patch.object(RequestGroup, 'emit_request_group_feedback'):
+                    process_request_visibility(rg.id, request, intervals_by_resource, self.downtime_intervals,
+                                               self.seeing_monitor, self.start, availability_context=context)
+        return [rg.requests[0].windows for rg in rgs]
+
+    def _parallel_windows(self, rise_set_pool):
+        rgs = copy.deepcopy(self.rgs)
+        context = AvailabilityContext(self.downtime_intervals, self.seeing_monitor, self.start)
+        with patch.object(RequestGroup, 'emit_request_group_feedback') as mock_feedback:
+            assert compute_availability_in_worker_pool(rise_set_pool, rgs, context)
+        assert mock_feedback.call_count == len(rgs)
+        return [rg.requests[0].windows for rg in rgs]
+
+    def test_parallel_windows_are_identical_to_serial(self):
+        rise_set_pool = Mock(processes=1)
+        rise_set_pool.map_tasks.side_effect = lambda function, tasks: [function(task) for task in tasks]
+
+        with patch('adaptive_scheduler.kernel_mappings.CHUNK_SIZE', 3):
+            parallel_windows = self._parallel_windows(rise_set_pool)
+
+        serial_windows = self._serial_windows()
+        assert any(windows.has_windows() for windows in serial_windows)
+        assert parallel_windows == serial_windows
+        assert len(rise_set_pool.map_tasks.call_args[0][1]) == 2
+
+    def test_windows_from_worker_processes_are_identical_to_serial(self):
+        rise_set_pool = RiseSetWorkerPool(processes=1, task_timeout=120)
+        rise_set_pool.configure(self.tels, self.start, self.end)
+        try:
+            parallel_windows = self._parallel_windows(rise_set_pool)
+        finally:
+            rise_set_pool.shutdown()
+
+        assert parallel_windows == self._serial_windows()
+
+    def test_requests_are_untouched_if_the_workers_fail(self):
+        rise_set_pool = Mock(processes=1)
+        rise_set_pool.map_tasks.side_effect = RuntimeError('worker died')
+        context = AvailabilityContext(self.downtime_intervals, self.seeing_monitor, self.start)
+        original_windows = [copy.deepcopy(rg.requests[0].windows) for rg in self.rgs]
+
+        assert not compute_availability_in_worker_pool(rise_set_pool, self.rgs, context)
+        assert [rg.requests[0].windows for rg in self.rgs] == original_windows
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+from __future__ import division
+
+from adaptive_scheduler.precompute_cli import parse_shard, in_shard, precompute_rise_sets, parse_args
+from adaptive_scheduler.rise_set_pool import init_worker
+from adaptive_scheduler.models import (ICRSTarget, Request, Window, Windows, Configuration, RequestGroup, Proposal)
+from adaptive_scheduler.kernel_mappings import make_request_cache_key, redis_cache_key, semester_cache_name
+from datetime import datetime
+import argparse
+
+from mock import patch
+import fakeredis
+import pytest
+
+
+class TestPrecomputeCli(object):
+
+    def setup(self):
+        self.start = datetime(2011, 11, 1, 0, 0, 0)
+        self.end = datetime(2011, 11, 3, 0, 0, 0)
+        self.resource = '1m0a.doma.bpl'
+        self.tels = {
+            self.resource: dict(name=self.resource, tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0, zenith_blind_spot=0.0)
+        }
+        self.semester_name = semester_cache_name(self.start, self.end)
+        self.redis = fakeredis.FakeStrictRedis()
+
+    def _make_request_group(self, rg_id, target):
+        configuration = Configuration(
+            id=5, target=target, type='expose', instrument_type='1M0-SCICAM-SBIG', priority=1,
+            instrument_configs=[], acquisition_config={}, guiding_config={},
+            constraints={'max_airmass': None, 'min_lunar_distance': 0, 'max_lunar_phase': 1.0})
+        windows = Windows()
+        windows.append(Window({'start': self.start, 'end': self.end}, self.resource))
+        request = Request(configurations=[configuration], windows=windows, request_id=rg_id, duration=60)
+        return RequestGroup(operator='single', requests=[request], proposal=Proposal(id='prop', tac_priority=1),
+                            expires=datetime(2050, 1, 1), rg_id=rg_id, is_staff=False, observation_type='NORMAL',
+                            ipp_value=1.0, name='rg {}'.format(rg_id), submitter='')
+
+    def _precompute(self, rgs, shard):
+        init_worker(self.tels, self.start, self.end)
+        with patch('adaptive_scheduler.rise_set_prefetch.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.precompute_cli.get_context') as mock_context:
+            # Run the worker tasks in this process, where the fake redis is patched in
+            mock_pool = mock_context.return_value.Pool.return_value.__enter__.return_value
+            mock_pool.imap_unordered.side_effect = lambda function, tasks: map(function, tasks)
+            return precompute_rise_sets(rgs, self.tels, self.start, self.end, shard, processes=1)
+
+    def test_shards_are_parsed(self):
+        assert parse_shard('2/4') == (2, 4)
+        assert parse_args(['--shard', '3/3']).shard == (3, 3)
+        assert parse_args([]).shard == (1, 1)
+        for value in ['0/4', '5/4', '2', 'a/b']:
+            with pytest.raises(argparse.ArgumentTypeError):
+                parse_shard(value)
+
+    def test_every_key_belongs_to_exactly_one_shard(self):
+        cache_keys = ['{}_key_{}'.format(self.resource, index) for index in range(200)]
+        shards = [(index, 4) for index in range(1, 5)]
+        for cache_key in cache_keys:
+            assert sum(in_shard(cache_key, shard) for shard in shards) == 1
+        # The keys are spread over every shard
+        assert all(any(in_shard(cache_key, shard) for cache_key in cache_keys) for shard in shards)
+
+    def test_shards_together_compute_every_target_once(self):
+        rgs = [self._make_request_group(index, ICRSTarget(ra=10.0 * index, dec=20.0)) for index in range(1, 7)]
+        cache_keys = {make_request_cache_key(rg.requests[0], rg.requests[0].configurations[0], self.resource)
+                      for rg in rgs}
+
+        computed = [self._precompute(rgs, (index, 3))[1] for index in range(1, 4)]
+
+        assert sum(computed) == len(cache_keys)
+        for cache_key in cache_keys:
+            assert self.redis.exists(redis_cache_key(cache_key, self.semester_name))
+
+    def test_cached_targets_are_skipped(self):
+        rgs = [self._make_request_group(1, ICRSTarget(ra=310.35795833333333, dec=45.280338888888885))]
+
+        assert self._precompute(rgs, (1, 1)) == (1, 1)
+        assert self._precompute(rgs, (1, 1)) == (0, 0)
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+from __future__ import division
+
+from adaptive_scheduler.rise_set_cache import RiseSetDiskCache
+from adaptive_scheduler.models import ICRSTarget, Request, Window, Windows, Configuration, RequestGroup, Proposal
+from adaptive_scheduler.monitoring.seeing import DummySeeingMonitor
+from adaptive_scheduler.kernel_mappings import (construct_visibilities, filter_on_visibility, make_cache_key,
+                                                local_cache)
+from time_intervals.intervals import Intervals
+from datetime import datetime, timedelta
+
+from mock import patch, Mock
+import fakeredis
+
+
+class TestRiseSetDiskCache(object):
+
+    def setup(self):
+        self.semester_start = datetime(2011, 11, 1)
+        self.semester_end = datetime(2012, 5, 1)
+        self.intervals = Intervals([(datetime(2011, 11, 1, 2, 2, 43, 257196), datetime(2011, 11, 1, 7, 52, 0, 564199)),
+                                    (datetime(2011, 11, 2, 2, 1, 50, 423880), datetime(2011, 11, 2, 7, 48, 4, 692316))])
+
+    def test_nothing_cached_before_semester_is_set(self, tmp_path):
+        cache = RiseSetDiskCache(str(tmp_path))
+        cache.set('key', self.intervals)
+
+        assert 'key' not in cache
+        assert cache.get('key') is None
+        assert list(tmp_path.iterdir()) == []
+
+    def test_intervals_round_trip_exactly(self, tmp_path):
+        cache = RiseSetDiskCache(str(tmp_path))
+        cache.set_semester(self.semester_start, self.semester_end)
+        cache.set('key', self.intervals)
+        cache.set('empty', Intervals([]))
+
+        assert cache.get('key').toTupleList() == self.intervals.toTupleList()
+        assert cache.get('empty').toTupleList() == []
+        assert cache.get('missing') is None
+
+    def test_cache_persists_across_instances(self, tmp_path):
+        cache = RiseSetDiskCache(str(tmp_path))
+        cache.set_semester(self.semester_start, self.semester_end)
+        cache.set('key', self.intervals)
+        cache.close()
+
+        new_cache = RiseSetDiskCache(str(tmp_path))
+        new_cache.set_semester(self.semester_start, self.semester_end)
+        assert len(new_cache) == 1
+        assert new_cache.get('key').toTupleList() == self.intervals.toTupleList()
+
+    def test_read_only_cache_sees_later_writes_but_cannot_write(self, tmp_path):
+        writer = RiseSetDiskCache(str(tmp_path))
+        writer.set_semester(self.semester_start, self.semester_end)
+        reader = RiseSetDiskCache(str(tmp_path), read_only=True)
+        reader.set_semester(self.semester_start, self.semester_end)
+        assert reader.get('key') is None
+
+        writer.set('key', self.intervals)
+        writer.set('other_key', Intervals([(self.semester_start, self.semester_end)]))
+        reader.set('reader_key', self.intervals)
+
+        assert reader.get('key').toTupleList() == self.intervals.toTupleList()
+        assert reader.get('other_key').toTupleList() == [(self.semester_start, self.semester_end)]
+        assert 'reader_key' not in writer
+
+    def test_existing_keys_are_not_overwritten(self, tmp_path):
+        cache = RiseSetDiskCache(str(tmp_path))
+        cache.set_semester(self.semester_start, self.semester_end)
+        cache.set('key', self.intervals)
+        cache.set('key', Intervals([(self.semester_start, self.semester_end)]))
+
+        assert cache.get('key').toTupleList() == self.intervals.toTupleList()
+
+    def test_semesters_are_cached_separately(self, tmp_path):
+        cache = RiseSetDiskCache(str(tmp_path))
+        cache.set_semester(self.semester_start, self.semester_end)
+        cache.set('key', self.intervals)
+
+        cache.set_semester(self.semester_end, self.semester_end + timedelta(days=180))
+        assert cache.get('key') is None
+
+        cache.set_semester(self.semester_start, self.semester_end)
+        assert cache.get('key').toTupleList() == self.intervals.toTupleList()
+
+
+class TestFilterOnVisibilityDiskCache(object):
+
+    def setup(self):
+        self.start = datetime(2011, 11, 1, 0, 0, 0)
+        self.end = datetime(2011, 11, 3, 0, 0, 0)
+        self.resource = '1m0a.doma.bpl'
+        self.tels = {
+            self.resource: dict(name=self.resource, tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0, zenith_blind_spot=0.0)
+        }
+        self.configuration = Configuration(
+            id=5,
+            target=ICRSTarget(ra=310.35795833333333, dec=45.280338888888885),
+            type='expose',
+            instrument_type='1M0-SCICAM-SBIG',
+            priority=1,
+            instrument_configs=[dict(exposure_count=1, bin_x=2, bin_y=2, exposure_time=30,
+                                     optical_elements={'filter': 'B'})],
+            acquisition_config=dict(mode='OFF'),
+            guiding_config=dict(mode='ON', optional=True, optical_elements={}, exposure_time=10),
+            constraints={'max_airmass': None, 'min_lunar_distance': 0, 'max_lunar_phase': 1.0}
+        )
+        local_cache.clear()
+
+    def teardown(self):
+        local_cache.clear()
+
+    def _make_request_group(self):
+        windows = Windows()
+        windows.append(Window({'start': self.start, 'end': self.end}, self.resource))
+        request = Request(configurations=[self.configuration], windows=windows, request_id=1, duration=60)
+        return RequestGroup(operator='single', requests=[request], proposal=Proposal(id='prop', tac_priority=1),
+                            expires=datetime(2050, 1, 1), rg_id=1, is_staff=False, observation_type='NORMAL',
+                            ipp_value=1.0, name='rg 1', submitter='')
+
+    def _filter(self, disk_cache):
+        visibilities = construct_visibilities(self.tels, self.start, self.end)
+        with patch('adaptive_scheduler.kernel_mappings.disk_cache', new=disk_cache), \
+                patch('adaptive_scheduler.kernel_mappings.redis_instance', new=fakeredis.FakeStrictRedis()):
+            return filter_on_visibility([self._make_request_group()], visibilities, {}, DummySeeingMonitor(),
+                                        self.start, self.end, self.start)
+
+    def test_disk_cache_is_used_before_redis_and_computation(self, tmp_path):
+        disk_cache = RiseSetDiskCache(str(tmp_path))
+        disk_cache.set_semester(self.start, self.end)
+        cache_key = make_cache_key(self.resource, self.configuration.target.get_rise_set_fingerprint(), None, 0, 1.0)
+        cached_interval = (datetime(2011, 11, 1, 3), datetime(2011, 11, 1, 4))
+        disk_cache.set(cache_key, Intervals([cached_interval]))
+
+        with patch('adaptive_scheduler.kernel_mappings.get_context') as mock_context:
+            rgs = self._filter(disk_cache)
+
+        mock_context.assert_not_called()
+        windows = rgs[0].requests[0].windows.at(self.resource)
+        assert [(w.start, w.end) for w in windows] == [cached_interval]
+
+    def test_computed_intervals_are_saved_to_disk_cache(self, tmp_path):
+        disk_cache = RiseSetDiskCache(str(tmp_path))
+        mock_pool = Mock()
+        mock_pool.map_async.side_effect = Exception('no worker processes in this test')
+        with patch('adaptive_scheduler.kernel_mappings.get_context') as mock_context:
+            mock_context.return_value.Pool.return_value.__enter__ = Mock(return_value=mock_pool)
+            mock_context.return_value.Pool.return_value.__exit__ = Mock(return_value=False)
+            rgs = self._filter(disk_cache)
+
+        assert len(disk_cache) == 1
+        cache_key = make_cache_key(self.resource, self.configuration.target.get_rise_set_fingerprint(), None, 0, 1.0)
+        cached_intervals = disk_cache.get(cache_key)
+        windows = rgs[0].requests[0].windows.at(self.resource)
+        assert [(w.start, w.end) for w in windows] == cached_intervals.toTupleList()
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+from __future__ import division
+
+from adaptive_scheduler.rise_set_pool import RiseSetWorkerPool, compute_rise_set_in_worker, init_worker
+from adaptive_scheduler.kernel_mappings import (construct_visibilities, get_rise_set_timepoint_intervals,
+                                                make_cache_key, compute_rise_sets_in_worker_pool, local_cache,
+                                                filter_on_visibility, RiseSetTimedOut, compute_rise_sets_in_new_pool,
+                                                RISE_SET_RESULT_TIMEOUT)
+from adaptive_scheduler.models import ICRSTarget, Request, Window, Windows, Configuration, RequestGroup, Proposal
+from adaptive_scheduler.monitoring.seeing import DummySeeingMonitor
+from multiprocessing import TimeoutError
+from datetime import datetime
+import time
+
+from mock import Mock, patch
+import fakeredis
+
+
+class TestRiseSetWorkerPool(object):
+
+    def setup(self):
+        self.start = datetime(2011, 11, 1, 0, 0, 0)
+        self.end = datetime(2011, 11, 3, 0, 0, 0)
+        self.resource = '1m0a.doma.bpl'
+        self.tels = {
+            self.resource: dict(name=self.resource, tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0, zenith_blind_spot=0.0,
+                                events=[])
+        }
+        target = ICRSTarget(ra=310.35795833333333, dec=45.280338888888885)
+        self.rise_set_target = target.in_rise_set_format()
+        self.cache_key = make_cache_key(self.resource, target.get_rise_set_fingerprint(), None, 0, 1.0)
+        self.task = (self.cache_key, self.resource, self.rise_set_target, None, 0, 1.0, None)
+
+    def _expected_intervals(self):
+        visibility = construct_visibilities(self.tels, self.start, self.end)[self.resource]
+        return get_rise_set_timepoint_intervals(self.rise_set_target, visibility, None, 0, 1.0)
+
+    def test_worker_computes_same_intervals_as_main_process(self):
+        init_worker(self.tels, self.start, self.end)
+        cache_key, intervals = compute_rise_set_in_worker(self.task)
+
+        assert cache_key == self.cache_key
+        assert intervals.toTupleList() == self._expected_intervals().toTupleList()
+
+    def test_worker_returns_none_on_failure(self):
+        init_worker(self.tels, self.start, self.end)
+        cache_key, intervals = compute_rise_set_in_worker((self.cache_key, 'unknown.resource', self.rise_set_target,
+                                                           None, 0, 1.0, None))
+
+        assert cache_key == self.cache_key
+        assert intervals is None
+
+    def test_pool_streams_results_from_warm_workers(self):
+        pool = RiseSetWorkerPool(processes=1, task_timeout=120)
+        pool.configure(self.tels, self.start, self.end)
+        try:
+            results = dict(pool.imap_rise_sets([self.task]))
+            assert pool.is_running
+            # The same worker process is reused for subsequent calls
+            results_again = dict(pool.imap_rise_sets([self.task]))
+        finally:
+            pool.shutdown()
+
+        assert not pool.is_running
+        expected = self._expected_intervals().toTupleList()
+        assert results[self.cache_key].toTupleList() == expected
+        assert results_again[self.cache_key].toTupleList() == expected
+
+    def test_pool_is_not_started_until_needed(self):
+        pool = RiseSetWorkerPool(processes=1)
+        pool.configure(self.tels, self.start, self.end)
+
+        assert list(pool.imap_rise_sets([])) == []
+        assert not pool.is_running
+
+    def test_pool_only_restarts_when_visibility_inputs_change(self):
+        pool = RiseSetWorkerPool(processes=1)
+        pool.configure(self.tels, self.start, self.end)
+        running_pool = Mock()
+        pool._pool = running_pool
+
+        # Network events do not change rise_set results
+        self.tels[self.resource]['events'] = ['an event']
+        pool.configure(self.tels, self.start, self.end)
+        assert pool._pool is running_pool
+
+        pool.configure(self.tels, self.start, datetime(2011, 11, 4))
+        assert pool._pool is None
+        running_pool.close.assert_called_once()
+
+    def test_pool_is_torn_down_when_a_task_times_out(self):
+        pool = RiseSetWorkerPool(processes=1, task_timeout=1)
+        pool.configure(self.tels, self.start, self.end)
+        running_pool = Mock()
+        running_pool.imap_unordered.return_value.next.side_effect = TimeoutError()
+        pool._pool = running_pool
+
+        assert list(pool.imap_rise_sets([self.task])) == []
+        running_pool.terminate.assert_called_once()
+        assert not pool.is_running
+
+    def test_new_pool_waits_for_results_within_the_target_limit(self):
+        visibility = construct_visibilities(self.tels, self.start, self.end)[self.resource]
+        to_compute = {self.cache_key: (self.resource, self.rise_set_target, visibility, None, 0, 1.0)}
+
+        with patch('adaptive_scheduler.kernel_mappings.get_context') as mock_context:
+            running_pool = mock_context.return_value.Pool.return_value.__enter__.return_value
+            running_pool.imap_unordered.return_value.next.side_effect = TimeoutError()
+            timed_out = compute_rise_sets_in_new_pool(to_compute)
+
+        assert timed_out == set()
+        running_pool.imap_unordered.return_value.next.assert_called_once_with(RISE_SET_RESULT_TIMEOUT)
+        running_pool.terminate.assert_called_once()
+
+    def test_worker_pool_results_are_cached(self):
+        rise_set_pool = Mock(processes=1)
+        intervals = self._expected_intervals()
+        rise_set_pool.imap_rise_sets.return_value = iter([(self.cache_key, intervals)])
+        visibility = construct_visibilities(self.tels, self.start, self.end)[self.resource]
+        to_compute = {self.cache_key: (self.resource, self.rise_set_target, visibility, None, 0, 1.0)}
+
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance') as mock_redis:
+            compute_rise_sets_in_worker_pool(rise_set_pool, to_compute)
+
+        rise_set_pool.imap_rise_sets.assert_called_once_with([self.task])
+        assert local_cache.pop(self.cache_key) is intervals
+        mock_redis.set.assert_called_once()
+
+    def test_worker_gives_up_on_a_slow_target(self):
+        init_worker(self.tels, self.start, self.end, target_timeout=0.2)
+        start = time.time()
+        try:
+            with patch('adaptive_scheduler.rise_set_pool.get_rise_set_timepoint_intervals',
+                       side_effect=lambda *args: time.sleep(5)):
+                cache_key, intervals = compute_rise_set_in_worker(self.task)
+        finally:
+            init_worker(self.tels, self.start, self.end)
+
+        assert time.time() - start < 2
+        assert cache_key == self.cache_key
+        assert isinstance(intervals, RiseSetTimedOut)
+
+
+class TestRiseSetQuarantine(object):
+
+    def setup(self):
+        self.start = datetime(2011, 11, 1, 0, 0, 0)
+        self.end = datetime(2011, 11, 3, 0, 0, 0)
+        self.resource = '1m0a.doma.bpl'
+        self.tels = {
+            self.resource: dict(name=self.resource, tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0, zenith_blind_spot=0.0)
+        }
+        self.target = ICRSTarget(ra=310.35795833333333, dec=45.280338888888885)
+        self.cache_key = make_cache_key(self.resource, self.target.get_rise_set_fingerprint(), None, 0, 1.0)
+        self.redis = fakeredis.FakeStrictRedis()
+        self.rise_set_pool = Mock(processes=1)
+        local_cache.clear()
+
+    def teardown(self):
+        local_cache.clear()
+
+    def _make_request_group(self):
+        configuration = Configuration(
+            id=5, target=self.target, type='expose', instrument_type='1M0-SCICAM-SBIG', priority=1,
+            instrument_configs=[dict(exposure_count=1, bin_x=2, bin_y=2, exposure_time=30,
+                                     optical_elements={'filter': 'B'})],
+            acquisition_config=dict(mode='OFF'),
+            guiding_config=dict(mode='ON', optional=True, optical_elements={}, exposure_time=10),
+            constraints={'max_airmass': None, 'min_lunar_distance': 0, 'max_lunar_phase': 1.0}
+        )
+        windows = Windows()
+        windows.append(Window({'start': self.start, 'end': self.end}, self.resource))
+        request = Request(configurations=[configuration], windows=windows, request_id=1, duration=60)
+        return RequestGroup(operator='single', requests=[request], proposal=Proposal(id='prop', tac_priority=1),
+                            expires=datetime(2050, 1, 1), rg_id=1, is_staff=False, observation_type='NORMAL',
+                            ipp_value=1.0, name='rg 1', submitter='')
+
+    def _filter(self):
+        self.rise_set_pool.imap_rise_sets.side_effect = lambda tasks: iter(
+            [(task[0], RiseSetTimedOut()) for task in tasks])
+        visibilities = construct_visibilities(self.tels, self.start, self.end)
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.kernel_mappings.BATCH_SIDEREAL_VISIBILITY', False), \
+                patch('adaptive_scheduler.kernel_mappings.get_rise_set_timepoint_intervals') as mock_compute:
+            rgs = filter_on_visibility([self._make_request_group()], visibilities, {}, DummySeeingMonitor(),
+                                       self.start, self.end, self.start, rise_set_pool=self.rise_set_pool)
+        # Timed out targets are never recomputed in the main process
+        mock_compute.assert_not_called()
+        return rgs
+
+    def _tasks_sent_to_pool(self):
+        return self.rise_set_pool.imap_rise_sets.call_args[0][0]
+
+    def test_timed_out_target_is_retried_in_the_next_run(self):
+        rgs = self._filter()
+
+        assert not rgs[0].requests[0].has_windows()
+        assert self.cache_key not in local_cache
+        assert len(self._tasks_sent_to_pool()) == 1
+
+    def test_target_is_quarantined_after_timing_out_repeatedly(self):
+        self._filter()
+        self._filter()
+        assert len(self._tasks_sent_to_pool()) == 1
+
+        rgs = self._filter()
+        assert self._tasks_sent_to_pool() == []
+        assert not rgs[0].requests[0].has_windows()
+
+        # A fresh process checks the quarantine in redis rather than recomputing
+        local_cache.clear()
+        self._filter()
+        assert self._tasks_sent_to_pool() == []
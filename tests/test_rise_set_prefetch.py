@@ -0,0 +1,198 @@
+#!/usr/bin/python
+from __future__ import division
+
+from adaptive_scheduler.rise_set_prefetch import (RiseSetPrefetcher, get_prefetch_tasks, group_prefetch_tasks,
+                                                  prefetch_rise_sets_in_worker)
+from adaptive_scheduler.rise_set_pool import init_worker, get_worker_visibility
+from adaptive_scheduler.models import (ICRSTarget, OrbitalElementsTarget, Request, Window, Windows, Configuration,
+                                       RequestGroup, Proposal)
+from adaptive_scheduler.kernel_mappings import (make_request_cache_key, redis_cache_key, semester_cache_name,
+                                                save_to_redis_cache, get_rise_set_timepoint_intervals,
+                                                RISE_SET_TARGET_TIMEOUT)
+from adaptive_scheduler.batch_visibility import SiderealVisibilityBatch
+from time_intervals.intervals import Intervals
+from datetime import datetime
+import pickle
+
+from mock import patch
+import fakeredis
+
+
+class TestRiseSetPrefetcher(object):
+
+    def setup(self):
+        self.start = datetime(2011, 11, 1, 0, 0, 0)
+        self.end = datetime(2011, 11, 3, 0, 0, 0)
+        self.resource = '1m0a.doma.bpl'
+        self.tels = {
+            self.resource: dict(name=self.resource, tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0, zenith_blind_spot=0.0)
+        }
+        self.semester_name = semester_cache_name(self.start, self.end)
+        self.redis = fakeredis.FakeStrictRedis()
+
+    def _make_configuration(self, target):
+        return Configuration(
+            id=5,
+            target=target,
+            type='expose',
+            instrument_type='1M0-SCICAM-SBIG',
+            priority=1,
+            instrument_configs=[dict(exposure_count=1, bin_x=2, bin_y=2, exposure_time=30,
+                                     optical_elements={'filter': 'B'})],
+            acquisition_config=dict(mode='OFF'),
+            guiding_config=dict(mode='ON', optional=True, optical_elements={}, exposure_time=10),
+            constraints={'max_airmass': None, 'min_lunar_distance': 0, 'max_lunar_phase': 1.0}
+        )
+
+    def _make_request_group(self, rg_id, target):
+        windows = Windows()
+        windows.append(Window({'start': self.start, 'end': self.end}, self.resource))
+        request = Request(configurations=[self._make_configuration(target)], windows=windows, request_id=rg_id,
+                          duration=60)
+        return RequestGroup(operator='single', requests=[request], proposal=Proposal(id='prop', tac_priority=1),
+                            expires=datetime(2050, 1, 1), rg_id=rg_id, is_staff=False, observation_type='NORMAL',
+                            ipp_value=1.0, name='rg {}'.format(rg_id), submitter='')
+
+    def test_tasks_are_only_created_for_distinct_uncached_targets(self):
+        rgs = [self._make_request_group(1, ICRSTarget(ra=10.0, dec=20.0)),
+               self._make_request_group(2, ICRSTarget(ra=10.0, dec=20.0)),
+               self._make_request_group(3, ICRSTarget(ra=30.0, dec=20.0)),
+               self._make_request_group(4, OrbitalElementsTarget({'scheme': 'MPC_COMET', 'eccentricity': 1.5}))]
+        cached_request = rgs[2].requests[0]
+        cached_key = make_request_cache_key(cached_request, cached_request.configurations[0], self.resource)
+        with patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            save_to_redis_cache(cached_key, Intervals([]), self.semester_name)
+
+        with patch('adaptive_scheduler.rise_set_prefetch.redis_instance', new=self.redis):
+            tasks = get_prefetch_tasks(rgs, self.semester_name)
+
+        assert len(tasks) == 1
+        semester_name, task = tasks[0]
+        request = rgs[0].requests[0]
+        assert semester_name == self.semester_name
+        assert task[0] == make_request_cache_key(request, request.configurations[0], self.resource)
+        assert task[1] == self.resource
+        assert task[-1] is None
+
+    def test_worker_saves_intervals_under_the_next_semester(self):
+        rg = self._make_request_group(1, ICRSTarget(ra=310.35795833333333, dec=45.280338888888885))
+        with patch('adaptive_scheduler.rise_set_prefetch.redis_instance', new=self.redis):
+            tasks = get_prefetch_tasks([rg], self.semester_name)
+        init_worker(self.tels, self.start, self.end)
+
+        with patch('adaptive_scheduler.rise_set_prefetch.BATCH_SIDEREAL_VISIBILITY', new=False), \
+                patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            work_items = group_prefetch_tasks(tasks)
+            assert prefetch_rise_sets_in_worker(work_items[0]) == 1
+
+        cache_key = tasks[0][1][0]
+        intervals = pickle.loads(self.redis.get(redis_cache_key(cache_key, self.semester_name)))
+        assert len(intervals.toTupleList()) > 0
+        assert self.redis.ttl(redis_cache_key(cache_key, self.semester_name)) > 0
+
+    def test_sidereal_targets_are_prefetched_in_batches_in_batch_mode(self):
+        rgs = [self._make_request_group(index, ICRSTarget(ra=300.0 + 10 * index, dec=45.0)) for index in range(1, 4)]
+        rgs.append(self._make_request_group(4, OrbitalElementsTarget({
+            'scheme': 'MPC_MINOR_PLANET', 'epochofel': 55000.0, 'orbinc': 10.0, 'longascnode': 50.0,
+            'argofperih': 100.0, 'meandist': 2.5, 'eccentricity': 0.1, 'meananom': 20.0})))
+        with patch('adaptive_scheduler.rise_set_prefetch.redis_instance', new=self.redis):
+            tasks = get_prefetch_tasks(rgs, self.semester_name)
+        init_worker(self.tels, self.start, self.end)
+
+        with patch('adaptive_scheduler.rise_set_prefetch.BATCH_SIDEREAL_VISIBILITY', new=True), \
+                patch('adaptive_scheduler.rise_set_prefetch.PREFETCH_BATCH_SIZE', new=2), \
+                patch('adaptive_scheduler.kernel_mappings.redis_instance', new=self.redis):
+            work_items = group_prefetch_tasks(tasks)
+            assert sorted(len(item_tasks) for _, item_tasks in work_items) == [1, 1, 2]
+            assert sum(prefetch_rise_sets_in_worker(work_item) for work_item in work_items) == 4
+
+        # The sidereal intervals are the batch computed ones the scheduler caches in batch mode
+        visibility = get_worker_visibility(self.resource)
+        batch = SiderealVisibilityBatch(visibility)
+        for rg in rgs[:3]:
+            request = rg.requests[0]
+            configuration = request.configurations[0]
+            rise_set_target = configuration.target.in_rise_set_format()
+            up_intervals, ha_intervals = batch.get_intervals([rise_set_target], None, 0)[0]
+            expected = get_rise_set_timepoint_intervals(rise_set_target, visibility, None, 0, 1.0,
+                                                        up_intervals=up_intervals, ha_intervals=ha_intervals)
+            cache_key = make_request_cache_key(request, configuration, self.resource)
+            intervals = pickle.loads(self.redis.get(redis_cache_key(cache_key, self.semester_name)))
+            assert intervals.toTupleList() == expected.toTupleList()
+
+    def test_prefetch_is_only_due_in_the_final_days_of_the_semester(self):
+        prefetcher = RiseSetPrefetcher(lead_days=7)
+        semester_details = {'start': datetime(2011, 11, 1), 'end': datetime(2012, 5, 1)}
+
+        assert not prefetcher.is_due(datetime(2012, 4, 23), semester_details)
+        assert prefetcher.is_due(datetime(2012, 4, 25), semester_details)
+        assert not prefetcher.is_due(datetime(2012, 5, 1), semester_details)
+
+    def test_prefetch_runs_in_the_background_until_finished(self):
+        prefetcher = RiseSetPrefetcher(lead_days=7)
+        semester_details = {'start': datetime(2011, 11, 1), 'end': datetime(2012, 5, 1)}
+        rg = self._make_request_group(1, ICRSTarget(ra=10.0, dec=20.0))
+
+        with patch('adaptive_scheduler.rise_set_prefetch.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.rise_set_prefetch.get_context') as mock_context:
+            mock_pool = mock_context.return_value.Pool.return_value
+            mock_pool.map_async.return_value.ready.return_value = False
+            assert prefetcher.prefetch([rg], self.tels, datetime(2012, 5, 1), datetime(2012, 11, 1)) == 1
+
+            mock_pool.map_async.assert_called_once()
+            # Prefetch workers give up on pathological targets just like the scheduling pool's workers do
+            initargs = mock_context.return_value.Pool.call_args[1]['initargs']
+            assert initargs[-1] == RISE_SET_TARGET_TIMEOUT
+            assert prefetcher.is_running
+            assert not prefetcher.is_due(datetime(2012, 4, 25), semester_details)
+
+            mock_pool.map_async.return_value.ready.return_value = True
+            # A finished prefetch is only collected by poll
+            assert prefetcher.is_running
+            mock_pool.join.assert_not_called()
+            assert not prefetcher.poll()
+            assert not prefetcher.is_running
+            mock_pool.join.assert_called_once()
+            assert prefetcher.prefetched_semester == semester_cache_name(datetime(2012, 5, 1), datetime(2012, 11, 1))
+
+    def test_a_semester_is_only_prefetched_once(self):
+        prefetcher = RiseSetPrefetcher(lead_days=7)
+        rg = self._make_request_group(1, ICRSTarget(ra=10.0, dec=20.0))
+
+        with patch('adaptive_scheduler.rise_set_prefetch.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.rise_set_prefetch.get_context') as mock_context, \
+                patch('adaptive_scheduler.rise_set_prefetch.get_prefetch_tasks',
+                      wraps=get_prefetch_tasks) as mock_get_tasks:
+            mock_result = mock_context.return_value.Pool.return_value.map_async.return_value
+            mock_result.ready.return_value = True
+            mock_result.successful.return_value = False
+            assert prefetcher.prefetch([rg], self.tels, datetime(2012, 5, 1), datetime(2012, 11, 1)) == 1
+            assert not prefetcher.poll()
+            # A failed prefetch is retried
+            assert prefetcher.prefetch([rg], self.tels, datetime(2012, 5, 1), datetime(2012, 11, 1)) == 1
+            mock_result.successful.return_value = True
+            assert not prefetcher.poll()
+
+            assert prefetcher.prefetch([rg], self.tels, datetime(2012, 5, 1), datetime(2012, 11, 1)) == 0
+            assert mock_get_tasks.call_count == 2
+
+    def test_cached_keys_are_checked_in_pipelines(self):
+        rgs = [self._make_request_group(index, ICRSTarget(ra=index, dec=20.0)) for index in range(1, 6)]
+        with patch('adaptive_scheduler.rise_set_prefetch.redis_instance', new=self.redis), \
+                patch('adaptive_scheduler.rise_set_prefetch.EXISTS_CHUNK_SIZE', new=2), \
+                patch.object(self.redis, 'exists') as mock_exists, \
+                patch.object(self.redis, 'pipeline', wraps=self.redis.pipeline) as mock_pipeline:
+            tasks = get_prefetch_tasks(rgs, self.semester_name)
+
+        assert len(tasks) == 5
+        assert mock_pipeline.call_count == 3
+        mock_exists.assert_not_called()
+
+    def test_nothing_is_started_without_tasks(self):
+        prefetcher = RiseSetPrefetcher()
+        with patch('adaptive_scheduler.rise_set_prefetch.get_context') as mock_context:
+            assert prefetcher.prefetch([], self.tels, datetime(2012, 5, 1), datetime(2012, 11, 1)) == 0
+
+        mock_context.assert_not_called()
+        assert not prefetcher.is_running
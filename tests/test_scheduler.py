@@ -1456,6 +1456,35 @@ class TestSchedulerRunner(object):
         assert 0 == self.network_interface_mock.cancel.call_count
         assert 0 == self.network_interface_mock.save.call_count
 
+    def test_scheduler_runner_precomputes_visibility_while_waiting(self):
+        sched_params = SchedulerParameters(run_once=False, sleep_seconds=60)
+        scheduler_runner = SchedulerRunner(sched_params, Mock(), self.network_interface_mock, {}, Mock())
+        scheduler_runner.semester_details = self.scheduler_runner.semester_details
+        scheduler_runner.visibility_precomputer = Mock()
+
+        with patch('adaptive_scheduler.scheduler.time') as mock_time:
+            mock_time.monotonic.return_value = 1000.0
+            scheduler_runner.wait_for_next_run()
+
+        mock_time.sleep.assert_not_called()
+        scheduler_runner.visibility_precomputer.run_until.assert_called_once_with(
+            1060.0, scheduler_runner.semester_details)
+
+    def test_scheduler_runner_collects_a_finished_prefetch_before_checking_if_one_is_due(self):
+        scheduler_runner = SchedulerRunner(SchedulerParameters(run_once=True), Mock(), self.network_interface_mock,
+                                           {}, Mock())
+        scheduler_runner.semester_details = self.scheduler_runner.semester_details
+        scheduler_runner.rise_set_prefetcher = Mock()
+        scheduler_runner.rise_set_prefetcher.is_due.return_value = False
+
+        scheduler_runner.prefetch_next_semester([], datetime.utcnow())
+
+        assert [call[0] for call in scheduler_runner.rise_set_prefetcher.method_calls] == ['poll', 'is_due']
+        scheduler_runner.rise_set_prefetcher.prefetch.assert_not_called()
+
+    def test_scheduler_runner_does_not_precompute_visibility_when_run_once(self):
+        assert self.scheduler_runner.visibility_precomputer is None
+
 
 class TestSchedulerRunnerUseOfRunTimes(object):
 
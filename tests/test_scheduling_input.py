@@ -272,3 +272,15 @@ class TestSchedulingInputUtils(object):
         assert 0 == len(model_rgs)
         assert 2 == len(invalid_rgs)
         assert 0 == len(invalid_rs)
+
+    def test_a_partial_list_of_request_groups_leaves_the_other_cached_models(self):
+        mock_model_builder = Mock()
+        mock_model_cache = Mock()
+        mock_model_cache.build_request_group = Mock(return_value=(Mock(), []))
+
+        utils = SchedulingInputUtils(mock_model_builder)
+        utils.json_rgs_to_scheduler_model_rgs([{'id': 'dummy1'}], model_cache=mock_model_cache, partial=True)
+        assert 0 == mock_model_cache.finish_cycle.call_count
+
+        utils.json_rgs_to_scheduler_model_rgs([{'id': 'dummy1'}], model_cache=mock_model_cache)
+        assert 1 == mock_model_cache.finish_cycle.call_count
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+from __future__ import division
+
+from adaptive_scheduler.site_ephemeris import get_site_ephemeris, clear_site_ephemeris_cache
+from adaptive_scheduler.kernel_mappings import construct_visibilities, get_rise_set_timepoint_intervals
+from adaptive_scheduler.models import ICRSTarget
+from rise_set.angle import Angle
+from rise_set.utils import intersect_intervals
+from datetime import datetime, timedelta
+
+from mock import patch
+import pytest
+
+
+class TestSiteEphemeris(object):
+
+    def setup(self):
+        clear_site_ephemeris_cache()
+        self.start = datetime(2011, 11, 1, 0, 0, 0)
+        self.end = datetime(2011, 11, 8, 0, 0, 0)
+        self.resource = '1m0a.doma.bpl'
+        self.tels = {
+            self.resource: dict(name=self.resource, tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0, zenith_blind_spot=0.0)
+        }
+        self.visibility = construct_visibilities(self.tels, self.start, self.end)[self.resource]
+        self.targets = [ICRSTarget(ra=ra, dec=dec).in_rise_set_format()
+                        for ra, dec in [(310.35795833333333, 45.280338888888885), (0.0, 0.0), (300.0, -20.0)]]
+
+    def teardown(self):
+        clear_site_ephemeris_cache()
+
+    def test_ephemeris_is_shared_between_equivalent_visibilities(self):
+        other_visibility = construct_visibilities(self.tels, self.start, self.end)[self.resource]
+        later_visibility = construct_visibilities(self.tels, self.start, self.end + timedelta(days=1))[self.resource]
+
+        assert get_site_ephemeris(self.visibility) is get_site_ephemeris(other_visibility)
+        assert get_site_ephemeris(self.visibility) is not get_site_ephemeris(later_visibility)
+
+    def test_moon_up_intervals_are_only_computed_once(self):
+        ephemeris = get_site_ephemeris(self.visibility)
+        target_intervals = self.visibility.get_target_intervals(self.targets[0])
+        with patch.object(self.visibility, 'get_target_intervals',
+                          wraps=self.visibility.get_target_intervals) as mock_get_target_intervals:
+            ephemeris.get_moon_phase_intervals(target_intervals, 0.5)
+            ephemeris.get_moon_phase_intervals(target_intervals, 0.4)
+
+        mock_get_target_intervals.assert_called_once_with(target='moon', up=True)
+
+    @pytest.mark.parametrize('max_moon_phase', [0.3, 0.5, 0.8])
+    def test_moon_phase_intervals_match_rise_set(self, max_moon_phase):
+        ephemeris = get_site_ephemeris(self.visibility)
+        for target in self.targets:
+            target_intervals = self.visibility.get_target_intervals(target)
+            expected = self.visibility.get_moon_phase_intervals(target_intervals, max_moon_phase)
+            received = ephemeris.get_moon_phase_intervals(target_intervals, max_moon_phase)
+            assert received == expected
+
+    @pytest.mark.parametrize('min_moon_distance', [15.0, 30.0, 60.0])
+    def test_moon_distance_intervals_match_rise_set(self, min_moon_distance):
+        ephemeris = get_site_ephemeris(self.visibility)
+        for target in self.targets:
+            target_intervals = self.visibility.get_target_intervals(target)
+            expected = self.visibility.get_moon_distance_intervals(target, target_intervals,
+                                                                   Angle(degrees=min_moon_distance))
+            received = ephemeris.get_moon_distance_intervals(target, target_intervals,
+                                                             Angle(degrees=min_moon_distance))
+            assert received == expected
+
+    def test_rise_set_timepoint_intervals_use_the_ephemeris(self):
+        target = self.targets[0]
+        with patch('adaptive_scheduler.kernel_mappings.get_site_ephemeris', wraps=get_site_ephemeris) as mock_get:
+            intervals = get_rise_set_timepoint_intervals(target, self.visibility, None, 30.0, 0.5)
+        mock_get.assert_called_once_with(self.visibility)
+
+        up_intervals = self.visibility.get_target_intervals(target)
+        up_intervals = self.visibility.get_moon_distance_intervals(target, up_intervals, Angle(degrees=30.0))
+        up_intervals = self.visibility.get_moon_phase_intervals(up_intervals, 0.5)
+        expected = intersect_intervals(self.visibility.get_dark_intervals(), up_intervals)
+        assert intervals.toTupleList() == expected
+
+    def _total_seconds(self, intervals):
+        return sum((end - start).total_seconds() for start, end in intervals)
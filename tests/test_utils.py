@@ -9,7 +9,12 @@ from adaptive_scheduler.utils import (merge_dicts, normalise, unnormalise,
                                       datetime_to_epoch, epoch_to_datetime,
                                       datetime_to_normalised_epoch,
                                       normalised_epoch_to_datetime, split_location,
-                                      estimate_runtime, safe_unidecode)
+                                      estimate_runtime, safe_unidecode, rise_set_target_fingerprint,
+                                      time_limit, TimeLimitExceeded, iso_string_to_datetime)
+from rise_set.angle import Angle
+from rise_set.sky_coordinates import RightAscension, Declination
+import time
+import pytest
 
 
 class TestUnidecode:
@@ -36,6 +41,48 @@ class TestUnidecode:
         assert '[?]' not in decoded_str
 
 
+class TestRiseSetTargetFingerprint(object):
+    def test_fingerprint_is_a_fixed_size_digest(self):
+        fingerprint = rise_set_target_fingerprint({'ra': RightAscension(degrees=10.0), 'dec': Declination(20.0)})
+
+        assert len(fingerprint) == 32
+        int(fingerprint, 16)
+
+    def test_equal_values_give_equal_fingerprints(self):
+        target = {'ra': RightAscension(degrees=10.0), 'dec': Declination(20.0), 'epoch': 2000, 'parallax': 0}
+        same_target = {'parallax': 0.0, 'epoch': 2000.0, 'dec': Angle(degrees=20.0), 'ra': Angle(degrees=10.0)}
+
+        assert rise_set_target_fingerprint(target) == rise_set_target_fingerprint(same_target)
+
+    def test_different_values_give_different_fingerprints(self):
+        target = {'ra': RightAscension(degrees=10.0), 'dec': Declination(20.0)}
+
+        assert rise_set_target_fingerprint(target) != rise_set_target_fingerprint(
+            {'ra': RightAscension(degrees=10.0), 'dec': Declination(20.000001)})
+        assert rise_set_target_fingerprint(target) != rise_set_target_fingerprint(dict(target, request_id=1))
+
+
+class TestTimeLimit(object):
+
+    def test_slow_block_is_interrupted(self):
+        start = time.time()
+        with pytest.raises(TimeLimitExceeded):
+            with time_limit(0.1):
+                time.sleep(5)
+        assert time.time() - start < 2
+
+    def test_fast_block_is_not_interrupted(self):
+        with time_limit(5):
+            result = sum(range(10))
+        # The timer is cancelled once the block finishes
+        time.sleep(0.1)
+        assert result == 45
+
+    def test_no_limit(self):
+        with time_limit(None):
+            time.sleep(0.01)
+
+
 class TestMergeDicts(object):
     def setup(self):
         self.d1 = {
@@ -154,6 +201,20 @@ class TestDateEpochConversions(object):
         normed_epoch_value = datetime_to_normalised_epoch(dt_value, dt_start)
         assert normalised_epoch_to_datetime(normed_epoch_value, start) == dt_value
 
+    def test_iso_strings_are_parsed_like_strptime(self):
+        for iso_string in ['2012-03-03T09:05:00Z', '2012-03-03T09:05:00.123Z', '2012-03-03T09:05:00.123456Z',
+                           '2012-03-03T09:05:00.1Z']:
+            date_format = '%Y-%m-%dT%H:%M:%S.%fZ' if '.' in iso_string else '%Y-%m-%dT%H:%M:%SZ'
+            assert iso_string_to_datetime(iso_string) == datetime.strptime(iso_string, date_format)
+
+    def test_iso_strings_of_other_forms_are_rejected(self):
+        for iso_string in ['2012-03-03T09:05:00', '2012-03-03T09:05:00+00:00Z', '2012-03-03 09:05:00Z',
+                           '2012-03-03T09:05Z', '2012-03-03T09:05:00.Z']:
+            with pytest.raises(ValueError):
+                iso_string_to_datetime(iso_string)
+        with pytest.raises(TypeError):
+            iso_string_to_datetime(datetime(2012, 3, 3))
+
 
 class TestRuntimeEstimate(object):
 
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+from __future__ import division
+
+from adaptive_scheduler.visibility_cache import VisibilityCache, intervals_size_bytes, coverage_cache_key
+from time_intervals.intervals import Intervals
+from datetime import datetime, timedelta
+
+from mock import patch
+
+
+def make_intervals(count, start=datetime(2011, 11, 1)):
+    return Intervals([(start + timedelta(hours=2 * i), start + timedelta(hours=2 * i + 1)) for i in range(count)])
+
+
+class TestVisibilityCache(object):
+
+    def setup(self):
+        self.intervals = make_intervals(4)
+        self.entry_size = intervals_size_bytes(self.intervals)
+        self.cache = VisibilityCache(max_bytes=2 * self.entry_size)
+
+    def test_size_is_tracked_as_entries_change(self):
+        self.cache['a'] = self.intervals
+        self.cache['b'] = make_intervals(4)
+        assert self.cache.size_bytes == 2 * self.entry_size
+
+        self.cache['a'] = make_intervals(1)
+        assert self.cache.size_bytes == self.entry_size + intervals_size_bytes(make_intervals(1))
+
+        del self.cache['b']
+        assert self.cache.size_bytes == intervals_size_bytes(make_intervals(1))
+
+        self.cache.clear()
+        assert self.cache.size_bytes == 0
+        assert len(self.cache) == 0
+
+    def test_least_recently_used_intervals_are_evicted(self):
+        for key in ['a', 'b', 'c']:
+            self.cache[key] = make_intervals(4)
+        # Reading 'a' makes 'b' the least recently used, but checking for 'b' does not count as using it
+        self.cache['a']
+        assert 'b' in self.cache
+        assert len(self.cache) == 3
+        assert len(list(self.cache.items())) == 3
+
+        assert self.cache.trim() == 1
+        assert 'b' not in self.cache
+        assert 'a' in self.cache and 'c' in self.cache
+        assert self.cache.size_bytes == 2 * self.entry_size
+
+    def test_values_other_than_intervals_are_never_evicted(self):
+        self.cache['current_semester'] = '2011B'
+        for key in ['a', 'b', 'c', 'd']:
+            self.cache[key] = make_intervals(4)
+        self.cache['coverage_c'] = (datetime(2011, 11, 1), datetime(2011, 11, 4))
+
+        assert self.cache.trim() == 2
+        assert self.cache['current_semester'] == '2011B'
+        assert 'coverage_c' in self.cache
+        assert set(self.cache.keys()) == {'current_semester', 'coverage_c', 'c', 'd'}
+
+    def test_coverage_is_evicted_with_its_intervals(self):
+        coverage = (datetime(2011, 11, 1), datetime(2011, 11, 4))
+        for index in range(1000):
+            self.cache[index] = make_intervals(4)
+            self.cache[coverage_cache_key(index)] = coverage
+
+        assert self.cache.trim() == 998
+        assert set(self.cache.keys()) == {998, 999, coverage_cache_key(998), coverage_cache_key(999)}
+        assert self.cache.size_bytes == 2 * self.entry_size
+
+        del self.cache[998]
+        assert set(self.cache.keys()) == {999, coverage_cache_key(999)}
+
+    def test_an_unbounded_cache_is_never_trimmed(self):
+        cache = VisibilityCache()
+        for key in range(10):
+            cache[key] = make_intervals(4)
+
+        assert cache.trim() == 0
+        assert len(cache) == 10
+
+    def test_metrics_are_sent_and_reset_after_each_run(self):
+        for key in ['a', 'b', 'c']:
+            self.cache[key] = make_intervals(4)
+        self.cache.record_lookup('local', True)
+        self.cache.record_lookup('local', True)
+        self.cache.record_lookup('local', False)
+        self.cache.record_lookup('redis', False)
+        self.cache.record_compute(3, 1.5)
+
+        with patch.object(self.cache, 'send_metric') as mock_send:
+            self.cache.finish_run()
+
+        metrics = {call[0][0]: call[0][1] for call in mock_send.call_args_list}
+        assert metrics['rise_set_cache.local.hits'] == 2
+        assert metrics['rise_set_cache.local.misses'] == 1
+        assert metrics['rise_set_cache.local.hit_rate'] == 2 / 3
+        assert metrics['rise_set_cache.disk.hits'] == 0
+        assert metrics['rise_set_cache.redis.misses'] == 1
+        assert metrics['rise_set_cache.computed'] == 3
+        assert metrics['rise_set_cache.compute_seconds'] == 1.5
+        assert metrics['rise_set_cache.evictions'] == 1
+        assert metrics['rise_set_cache.entries'] == 2
+        assert metrics['rise_set_cache.size_bytes'] == 2 * self.entry_size
+
+        assert self.cache.hits['local'] == 0
+        assert self.cache.misses['redis'] == 0
+        assert self.cache.computed == 0
+        assert self.cache.compute_seconds == 0.0
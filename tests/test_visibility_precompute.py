@@ -0,0 +1,166 @@
+#!/usr/bin/python
+from __future__ import division
+
+from adaptive_scheduler.visibility_precompute import VisibilityPrecomputer, modified_since
+from adaptive_scheduler.kernel_mappings import (construct_visibilities, get_rise_set_timepoint_intervals,
+                                                make_request_cache_key, local_cache)
+from adaptive_scheduler.models import (ICRSTarget, Request, Window, Windows, Configuration, RequestGroup, Proposal)
+from adaptive_scheduler.utils import OptimizationType
+from datetime import datetime
+
+from mock import Mock, patch
+import fakeredis
+
+
+class TestVisibilityPrecomputer(object):
+
+    def setup(self):
+        self.start = datetime(2011, 11, 1, 0, 0, 0)
+        self.end = datetime(2011, 11, 4, 0, 0, 0)
+        self.resource = '1m0a.doma.bpl'
+        self.network_model = {
+            self.resource: dict(name=self.resource, tel_class='1m0', latitude=34.433157, longitude=-119.86308,
+                                elevation=7.0, horizon=25, ha_limit_neg=-12.0, ha_limit_pos=12.0,
+                                zenith_blind_spot=0.0)
+        }
+        self.semester_details = {'id': '2011B', 'start': datetime(2011, 8, 1), 'end': datetime(2012, 2, 1)}
+        self.sched_params = Mock(telescope_classes=[], horizon_days=7.0, ignore_ipp=False)
+        self.network_interface = Mock()
+        self.network_interface.observation_portal_interface.get_last_changed.return_value = datetime(2011, 11, 1, 2)
+        self.precomputer = VisibilityPrecomputer(self.network_interface, self.network_model, self.sched_params)
+        self.precomputer.mark_checked(datetime(2011, 11, 1, 1))
+        self.redis = fakeredis.FakeStrictRedis()
+        self.cache_keys = set()
+
+    def teardown(self):
+        for cache_key in self.cache_keys:
+            local_cache.pop(cache_key, None)
+
+    def _make_request_group(self, rg_id, optimization_type=OptimizationType.TIME):
+        configuration = Configuration(
+            id=5, target=ICRSTarget(ra=310.35795833333333, dec=45.280338888888885), type='expose',
+            instrument_type='1M0-SCICAM-SBIG', priority=1,
+            instrument_configs=[dict(exposure_count=1, bin_x=2, bin_y=2, exposure_time=30,
+                                     optical_elements={'filter': 'B'})],
+            acquisition_config=dict(mode='OFF'),
+            guiding_config=dict(mode='ON', optional=True, optical_elements={}, exposure_time=10),
+            constraints={'max_airmass': None, 'min_lunar_distance': 0, 'max_lunar_phase': 1.0}
+        )
+        windows = Windows()
+        windows.append(Window({'start': self.start, 'end': self.end}, self.resource))
+        request = Request(configurations=[configuration], windows=windows, request_id=rg_id, duration=60,
+                          optimization_type=optimization_type)
+        return RequestGroup(operator='single', requests=[request], proposal=Proposal(id='prop', tac_priority=1),
+                            expires=datetime(2050, 1, 1), rg_id=rg_id, is_staff=False, observation_type='NORMAL',
+                            ipp_value=1.0, name='rg {}'.format(rg_id), submitter='')
+
+    def test_modified_since(self):
+        checked_time = datetime(2011, 11, 1, 1)
+        assert modified_since({'modified': '2011-11-01T01:30:00Z'}, checked_time)
+        assert not modified_since({'modified': '2011-11-01T00:30:00Z'}, checked_time)
+        assert modified_since({}, checked_time)
+
+    def test_nothing_is_fetched_until_a_run_has_finished(self):
+        precomputer = VisibilityPrecomputer(self.network_interface, self.network_model, self.sched_params)
+
+        assert precomputer.precompute_changes(self.semester_details) == 0
+        self.network_interface.observation_portal_interface.get_last_changed.assert_not_called()
+
+    def test_nothing_is_fetched_without_changes(self):
+        self.precomputer.mark_checked(datetime(2011, 11, 1, 3))
+
+        assert self.precomputer.precompute_changes(self.semester_details) == 0
+        self.network_interface.get_all_request_groups.assert_not_called()
+
+    def test_only_request_groups_modified_since_the_last_check_are_precomputed(self):
+        self.network_interface.get_all_request_groups.return_value = [
+            {'id': 1, 'modified': '2011-11-01T00:30:00Z'}, {'id': 2, 'modified': '2011-11-01T01:30:00Z'}]
+        rg = self._make_request_group(2)
+
+        with patch('adaptive_scheduler.visibility_precompute.ModelBuilder'), \
+                patch('adaptive_scheduler.visibility_precompute.SchedulingInputUtils') as mock_utils, \
+                patch('adaptive_scheduler.visibility_precompute.datetime') as mock_datetime, \
+                patch('adaptive_scheduler.visibility_precompute.fill_rise_set_cache',
+                      return_value=set()) as mock_fill:
+            mock_datetime.utcnow.return_value = self.start
+            mock_utils.return_value.json_rgs_to_scheduler_model_rgs.return_value = ([rg], [], [])
+            assert self.precomputer.precompute_changes(self.semester_details) == 1
+
+        json_rgs = mock_utils.return_value.json_rgs_to_scheduler_model_rgs.call_args[0][0]
+        assert [json_rg['id'] for json_rg in json_rgs] == [2]
+        assert mock_fill.call_args[1]['include_unbound_orbits'] is False
+        assert self.precomputer.last_checked == self.start
+        # The scheduler's own last_changed check is left for the next run
+        self.network_interface.schedulable_request_set_has_changed.assert_not_called()
+
+    def test_the_runners_model_builder_and_model_cache_are_reused(self):
+        self.network_interface.get_all_request_groups.return_value = [{'id': 2, 'modified': '2011-11-01T01:30:00Z'}]
+        input_factory = Mock()
+        precomputer = VisibilityPrecomputer(self.network_interface, self.network_model, self.sched_params,
+                                            input_factory=input_factory)
+        precomputer.mark_checked(datetime(2011, 11, 1, 1))
+
+        with patch('adaptive_scheduler.visibility_precompute.ModelBuilder') as mock_builder, \
+                patch('adaptive_scheduler.visibility_precompute.SchedulingInputUtils') as mock_utils:
+            mock_utils.return_value.json_rgs_to_scheduler_model_rgs.return_value = ([], [], [])
+            precomputer.precompute_changes(self.semester_details)
+
+        mock_builder.assert_not_called()
+        mock_utils.assert_called_once_with(input_factory.model_builder)
+        call_kwargs = mock_utils.return_value.json_rgs_to_scheduler_model_rgs.call_args[1]
+        assert call_kwargs['model_cache'] is input_factory.model_cache
+        # The models of request groups which haven't changed stay in the cache for the next cycle
+        assert call_kwargs['partial'] is True
+
+    def test_fetches_back_off_while_request_groups_keep_changing(self):
+        self.network_interface.get_all_request_groups.return_value = []
+        last_changed = self.network_interface.observation_portal_interface.get_last_changed
+        now = datetime(2011, 11, 1, 3)
+
+        def fetch_count_at(monotonic_time):
+            with patch('adaptive_scheduler.visibility_precompute.time') as mock_time:
+                mock_time.monotonic.return_value = monotonic_time
+                self.precomputer.get_changed_request_groups(now, self.semester_details)
+            return self.network_interface.get_all_request_groups.call_count
+
+        last_changed.return_value = datetime(2011, 11, 1, 2)
+        assert fetch_count_at(0.0) == 1
+        last_changed.return_value = datetime(2011, 11, 1, 4)
+        assert fetch_count_at(20.0) == 1
+        assert fetch_count_at(30.0) == 2
+        last_changed.return_value = datetime(2011, 11, 1, 5)
+        assert fetch_count_at(60.0) == 2
+        assert fetch_count_at(90.0) == 3
+        # A poll without changes resets the backoff
+        last_changed.return_value = datetime(2011, 11, 1, 2)
+        assert fetch_count_at(100.0) == 3
+        last_changed.return_value = datetime(2011, 11, 1, 6)
+        assert fetch_count_at(100.0) == 4
+        assert fetch_count_at(130.0) == 5
+
+    def test_airmasses_are_cached_for_airmass_optimized_requests(self):
+        rgs = [self._make_request_group(1), self._make_request_group(2, OptimizationType.AIRMASS)]
+        visibilities = construct_visibilities(self.network_model, self.start, self.end)
+        for rg in rgs:
+            request = rg.requests[0]
+            configuration = request.configurations[0]
+            cache_key = make_request_cache_key(request, configuration, self.resource)
+            self.cache_keys.add(cache_key)
+            local_cache[cache_key] = get_rise_set_timepoint_intervals(
+                configuration.target.in_rise_set_format(), visibilities[self.resource], None, 0, 1.0)
+
+        with patch('adaptive_scheduler.models.redis_instance', new=self.redis):
+            self.precomputer.cache_airmasses(rgs, self.start, self.semester_details['start'])
+
+        assert not self.redis.exists('1_{}_airmass_at_times'.format(self.resource))
+        assert self.redis.exists('2_{}_airmass_at_times'.format(self.resource))
+        assert self.redis.ttl('2_{}_airmass_at_times'.format(self.resource)) > 0
+
+    def test_polling_stops_at_the_deadline(self):
+        with patch.object(self.precomputer, 'precompute_changes', side_effect=[RuntimeError('portal down'), 0]) as mock_precompute, \
+                patch('adaptive_scheduler.visibility_precompute.time') as mock_time:
+            mock_time.monotonic.side_effect = [100.0, 135.0]
+            self.precomputer.run_until(130.0, self.semester_details)
+
+        assert mock_precompute.call_count == 2
+        mock_time.sleep.assert_called_once_with(30.0)